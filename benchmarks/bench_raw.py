@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Compares the raw XML fast path of bfair._raw with suds for building a
+getMarketPricesCompressed request and unmarshalling its response.
+
+The suds side needs the exchange WSDL (from the network, the WSDL cache or
+BFAIR_WSDL_DIR); it is skipped if the WSDL cannot be loaded.  The reply is
+injected into suds, so no request is sent.
+"""
+
+import sys
+import timeit
+
+from os import path
+
+ROOT_DIR = path.join(path.dirname(path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT_DIR)
+
+from bfair import _raw, _soap
+from tests.test_raw import ESCAPED_PRICES, RESPONSE
+
+
+class Header(object):
+    clientStamp = 0
+    sessionToken = "x" * 44
+
+
+def bench(label, fn, number=2000):
+    t = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print("%-32s: %8.1f us/call" % (label, t * 1e6))
+
+
+def main():
+    reply = RESPONSE % dict(token="x" * 44, error="OK", prices=ESCAPED_PRICES)
+    op = _raw.getMarketPricesCompressed
+    bench("raw: render request", lambda: op.render(Header(), marketId=97383))
+    bench("raw: parse response", lambda: op.parse(reply))
+
+    try:
+        client = _soap.get_client(_soap.BFExchangeServiceUrl)
+    except Exception as e:
+        print("suds: WSDL not available (%s)" % e)
+        return
+    header = client.factory.create("ns1:APIRequestHeader")
+    header.clientStamp = 0
+    header.sessionToken = Header.sessionToken
+
+    def suds_call():
+        req = client.factory.create("ns1:GetMarketPricesCompressedReq")
+        req.header = header
+        req.marketId = 97383
+        return client.service.getMarketPricesCompressed(
+            req, __inject={"reply": reply})
+    bench("suds: create, marshal, parse", suds_call, number=200)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Measures the throughput of Session calls against the in-process fake
+services of tests/fakes.py, which answer after a fixed latency.
+"""
+
+import sys
+import time
+
+from os import path
+
+ROOT_DIR = path.join(path.dirname(path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT_DIR)
+
+import bfair.session
+
+from bfair.session import AsyncSession, Session
+from tests import fakes
+
+
+LATENCY = 0.02
+CALLS = 200
+
+
+class Patch(object):
+    setattr = staticmethod(setattr)
+
+
+def install(**handlers):
+    with open(path.join(ROOT_DIR, "tests", "data", "market_prices.dump")) as f:
+        payloads = f.read().splitlines()
+
+    def market_prices(req, rsp):
+        rsp.marketPrices = payloads[req.marketId % len(payloads)]
+    handlers.setdefault("getMarketPricesCompressed", market_prices)
+    exchange = fakes.FakeService(latency=LATENCY, **handlers)
+    fakes.install(Patch(), exchange_service=exchange)
+    return exchange
+
+
+def report(label, elapsed):
+    print("%-40s: %8.1f calls/s" % (label, CALLS / elapsed))
+
+
+def bench_serial():
+    install()
+    session = Session("user", "password", thread_safe=True, rate_limits={})
+    t0 = time.time()
+    for i in xrange(CALLS):
+        session.get_market_prices(i)
+    report("Session.get_market_prices", time.time() - t0)
+
+
+def bench_async(max_workers):
+    install()
+    session = Session("user", "password", thread_safe=True, rate_limits={})
+    t0 = time.time()
+    with AsyncSession(session, max_workers=max_workers) as pending:
+        results = [pending.get_market_prices(i) for i in xrange(CALLS)]
+        for r in results:
+            r.get()
+    report("AsyncSession(max_workers=%d)" % max_workers, time.time() - t0)
+
+
+def bench_many(max_workers):
+    install()
+    session = Session("user", "password", thread_safe=True, rate_limits={})
+    t0 = time.time()
+    session.get_market_prices_many(xrange(CALLS), max_workers=max_workers)
+    report("get_market_prices_many(max_workers=%d)" % max_workers,
+           time.time() - t0)
+
+
+def main():
+    print("%d calls, %.0f ms latency per call" % (CALLS, LATENCY * 1000))
+    bench_serial()
+    for max_workers in (4, 16, 64):
+        bench_async(max_workers)
+    for max_workers in (16, 64):
+        bench_many(max_workers)
+
+
+if __name__ == "__main__":
+    main()
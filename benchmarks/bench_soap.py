@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Measures the time to import bfair.session and the time to the first call
+that needs the WSDL (creating a request object).
+
+Each measurement runs in a fresh interpreter.  Run it twice to compare a cold
+WSDL cache with a warm one; set BFAIR_WSDL_DIR to use local copies of the
+WSDLs.
+"""
+
+import os
+import subprocess
+import sys
+
+
+IMPORT = """
+import time
+t0 = time.time()
+import bfair.session
+print("%.4f" % (time.time() - t0))
+"""
+
+FIRST_CALL = """
+import time
+t0 = time.time()
+from bfair._soap import BFGlobalFactory, BFExchangeFactory
+BFGlobalFactory.create("ns1:KeepAliveReq")
+BFExchangeFactory.create("ns1:GetMarketPricesCompressedReq")
+print("%.4f" % (time.time() - t0))
+"""
+
+
+def run(script):
+    with open(os.devnull, "w") as devnull:
+        out = subprocess.check_output([sys.executable, "-c", script],
+                                      stderr=devnull)
+    return float(out.strip())
+
+
+def main(repeat=5):
+    t_import = min(run(IMPORT) for _ in range(repeat))
+    print("import bfair.session : %8.1f ms" % (t_import * 1000))
+    try:
+        t_call = min(run(FIRST_CALL) for _ in range(repeat))
+    except subprocess.CalledProcessError:
+        print("first call           :   WSDL not available")
+    else:
+        print("first call           : %8.1f ms" % (t_call * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Measures the decoders in bfair._util against the recorded payloads in
+tests/data.
+
+Reference timings (CPython 2.7, per payload of market_prices.dump):
+
+    uncompress_market_prices
+        regex/izip decoder (29 prices, best level only) : 0.43 ms
+        single-pass decoder (81 prices, full ladder)    : 0.31 ms
+        columnar=True                                   : 0.29 ms
+    uncompress_complete_market_depth (complete_market_prices.dump)
+        AvailabilityInfo objects                        : 0.73 ms
+        columnar=True                                   : 0.61 ms
+"""
+
+import sys
+import timeit
+
+from os import path
+
+ROOT_DIR = path.join(path.dirname(path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT_DIR)
+
+from bfair import _util
+from bfair.book import MarketBook
+
+
+DATA_DIR = path.join(ROOT_DIR, "tests", "data")
+
+
+def load(name):
+    with open(path.join(DATA_DIR, name)) as f:
+        return f.read().splitlines()
+
+
+def bench(label, fn, payloads, number=20, repeat=5):
+    t = min(timeit.repeat(lambda: [fn(p) for p in payloads],
+                          number=number, repeat=repeat))
+    t = t / number / len(payloads)
+    print("%-48s: %8.3f ms/payload" % (label, t * 1000))
+
+
+def main():
+    markets = load("markets.dump")
+    market_prices = load("market_prices.dump")
+    complete_market_prices = load("complete_market_prices.dump")
+
+    bench("uncompress_markets", _util.uncompress_markets, markets, number=2)
+    bench("uncompress_markets.iter",
+          lambda p: sum(1 for _ in _util.uncompress_markets.iter(p)),
+          markets, number=2)
+    bench("uncompress_market_prices", _util.uncompress_market_prices,
+          market_prices)
+    bench("uncompress_complete_market_depth",
+          _util.uncompress_complete_market_depth, complete_market_prices)
+
+    books = {}
+    def update_book(payload):
+        book = books.setdefault(payload, MarketBook())
+        return book.update(payload)
+    bench("MarketBook.update (unchanged payload)", update_book, market_prices)
+
+    try:
+        import numpy
+    except ImportError:
+        return
+    bench("uncompress_market_prices(columnar=True)",
+          lambda p: _util.uncompress_market_prices(p, columnar=True),
+          market_prices)
+    bench("uncompress_complete_market_depth(columnar=True)",
+          lambda p: _util.uncompress_complete_market_depth(p, columnar=True),
+          complete_market_prices)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Fast path for the exchange operations whose result is a single compressed
+string.  Requests are rendered from pre-built XML fragments and the response
+is scanned with expat for the few elements that are needed, without building
+suds objects.
+"""
+
+from StringIO import StringIO
+from datetime import datetime
+from xml.parsers import expat
+from xml.sax.saxutils import escape
+
+from suds import WebFault
+from suds.transport import TransportError
+
+from bfair import _soap
+
+
+__all__ = (
+    "getAllMarkets", "getMarketPricesCompressed",
+    "getCompleteMarketPricesCompressed",
+)
+
+
+BFExchangeServiceEndpoint = "https://api.betfair.com/exchange/v5/BFExchangeService"
+BFExchangeServiceNamespace = "http://www.betfair.com/publicapi/v5/BFExchangeService/"
+
+_ENVELOPE_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<soapenv:Envelope'
+    ' xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"'
+    ' xmlns:bfex="%s">'
+    '<soapenv:Body><bfex:%%s><bfex:request>' % BFExchangeServiceNamespace
+)
+_ENVELOPE_TAIL = '</bfex:request></bfex:%s></soapenv:Body></soapenv:Envelope>'
+_HEADER = ('<header><clientStamp>%s</clientStamp>'
+           '<sessionToken>%s</sessionToken></header>')
+
+
+def _text(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return escape(str(value))
+
+
+def _element(name, value):
+    return "<%s>%s</%s>" % (name, _text(value), name)
+
+
+def _array(item):
+    def render(name, values):
+        items = "".join(_element(item, v) for v in values)
+        return "<%s>%s</%s>" % (name, items, name)
+    return render
+
+
+class Node(object):
+    """Attribute bag for the elements of a response.
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        # Elements that are missing from the response are None, as in suds.
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return None
+
+    def __repr__(self):
+        return "Node(%s)" % ", ".join("%s=%r" % kv
+                                      for kv in sorted(self.__dict__.items()))
+
+
+class RawOperation(object):
+    """An exchange operation that is sent and parsed without suds.
+
+    Parameters
+    ----------
+    name : `str`
+        Name of the SOAP operation.
+    fields : sequence of ``(name, render)``
+        Request fields in schema order.  `render` takes the element name and
+        the value and returns the XML of the element.
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self._head = _ENVELOPE_HEAD % name
+        self._tail = _ENVELOPE_TAIL % name
+        self._headers = {
+            "Content-Type": "text/xml; charset=utf-8",
+            "SOAPAction": '"%s"' % name,
+        }
+
+    def __call__(self, header, **values):
+        """Sends the request and returns the parsed response.  As with
+        suds, a SOAP fault raises WebFault and any other response than a 200
+        raises TransportError.
+        """
+        status, reason, _, data = _soap.connection_pool.request(
+            "POST", BFExchangeServiceEndpoint, self.render(header, **values),
+            self._headers)
+        if status not in (200, 500):
+            raise TransportError(reason, status, StringIO(data))
+        try:
+            rsp = self.parse(data)
+        except expat.ExpatError:
+            if status == 200:
+                raise
+            # An error page of a proxy rather than a SOAP fault.
+            raise TransportError(reason, status, StringIO(data))
+        if rsp.fault is not None:
+            raise WebFault(rsp.fault, None)
+        if status != 200:
+            raise TransportError(reason, status, StringIO(data))
+        return rsp
+
+    def render(self, header, **values):
+        parts = [self._head, _HEADER % (_text(header.clientStamp or 0),
+                                        _text(header.sessionToken or ""))]
+        for name, render in self.fields:
+            value = values.get(name)
+            if value is None or value == []:
+                continue
+            parts.append(render(name, value))
+        parts.append(self._tail)
+        return "".join(parts)
+
+    def parse(self, data):
+        """Extracts the header, the fields of the result and any SOAP fault
+        from a response.
+        """
+        parser = expat.ParserCreate(namespace_separator=" ")
+        parser.returns_unicode = False
+        parser.buffer_text = True
+        stack = []
+        text = []
+        nil = []
+        values = []
+        header_parent = []
+
+        def start(name, attrs):
+            local = name.rpartition(" ")[2]
+            if local == "header" and not header_parent:
+                header_parent.append(len(stack))
+            stack.append(local)
+            nil.append(any(k.endswith("nil") and v in ("1", "true")
+                           for k, v in attrs.iteritems()))
+            del text[:]
+
+        def end(name):
+            local = stack.pop()
+            value = None if nil.pop() else "".join(text)
+            values.append((len(stack), stack[-1] if stack else None, local,
+                           value))
+            del text[:]
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = text.append
+        parser.Parse(data, True)
+
+        header, result, fault = Node(), Node(), None
+        depth = header_parent[0] if header_parent else None
+        for level, parent, local, value in values:
+            if local == "faultstring":
+                fault = Node(faultstring=value)
+            elif depth is None:
+                continue
+            elif parent == "header" and level == depth + 1:
+                setattr(header, local, value)
+            elif level == depth and local != "header":
+                setattr(result, local, value)
+        result.header = header
+        result.fault = fault
+        return result
+
+
+getMarketPricesCompressed = RawOperation("getMarketPricesCompressed", (
+    ("currencyCode", _element),
+    ("marketId", _element),
+))
+
+getCompleteMarketPricesCompressed = RawOperation(
+    "getCompleteMarketPricesCompressed", (
+        ("currencyCode", _element),
+        ("marketId", _element),
+    ))
+
+getAllMarkets = RawOperation("getAllMarkets", (
+    ("locale", _element),
+    ("eventTypeIds", _array("int")),
+    ("countries", _array("Country")),
+    ("fromDate", _element),
+    ("toDate", _element),
+))
@@ -14,8 +14,17 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import logging
+import os
+import stat
+import threading
+
 from os import path
+from suds.cache import ObjectCache
 from suds.client import Client
+from suds.sudsobject import Object
+
+from bfair._transport import ConnectionPool, PooledTransport
 
 
 __all__ = (
@@ -24,27 +33,206 @@ __all__ = (
     "ConvertCurrencyErrorEnum", "GetBetErrorEnum", "GetAllMarketsErrorEnum",
     "GetCompleteMarketPricesErrorEnum", "GetInPlayMarketsErrorEnum",
     "GetMarketPricesErrorEnum", "GetMarketErrorEnum",
+    "GetMarketTradedVolumeErrorEnum", "PlaceBetsErrorEnum",
+    "CancelBetsErrorEnum", "CancelBetsByMarketErrorEnum",
+    "UpdateBetsErrorEnum", "GetMUBetsErrorEnum", "GetCurrentBetsErrorEnum",
+    "RequestPool",
 )
 
 
 BFGlobalServiceUrl = "https://api.betfair.com/global/v3/BFGlobalService.wsdl"
-BFGlobalServiceClient = Client(BFGlobalServiceUrl)
-BFGlobalService = BFGlobalServiceClient.service
-BFGlobalFactory = BFGlobalServiceClient.factory
-
 BFExchangeServiceUrl = "https://api.betfair.com/exchange/v5/BFExchangeService.wsdl"
-BFExchangeServiceClient = Client(BFExchangeServiceUrl)
-BFExchangeService = BFExchangeServiceClient.service
-BFExchangeFactory = BFExchangeServiceClient.factory
+
+# Parsed WSDL definitions are pickled to CACHE_DIR so that only the very first
+# process of a user pays for downloading and parsing the service descriptions.
+# Pickles are code, so the directory must be private to the user.
+CACHE_DIR = os.environ.get("BFAIR_CACHE_DIR",
+                           path.join(path.expanduser("~"), ".cache", "bfair"))
+CACHE_DAYS = 30
+
+# Optional directory with local copies of BFGlobalService.wsdl and
+# BFExchangeService.wsdl.  When a local copy exists it is used instead of the
+# remote WSDL.
+WSDL_DIR = os.environ.get("BFAIR_WSDL_DIR")
+
+
+# Persistent connections shared by BFGlobalService and BFExchangeService.
+connection_pool = ConnectionPool(
+    max_connections=int(os.environ.get("BFAIR_MAX_CONNECTIONS", 8)),
+    acquire_timeout=float(os.environ.get("BFAIR_ACQUIRE_TIMEOUT", 90)))
+
+# Operations whose requests must not be sent twice: the exchange may have
+# executed a request whose response was lost.
+NON_IDEMPOTENT = (
+    "placeBets", "updateBets", "cancelBets", "cancelBetsByMarket",
+)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_dir(directory):
+    """Creates `directory` with mode 0700 if it does not exist and returns
+    it, or returns None if it is not safe to load pickles from it because
+    another user owns it or can write to it.
+    """
+    try:
+        os.makedirs(directory, 0700)
+    except OSError:
+        pass
+    try:
+        st = os.stat(directory)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        logger.warning("Not caching WSDL in %s: it is not a private "
+                       "directory of the current user", directory)
+        return None
+    return directory
+
+
+def _wsdl_url(url):
+    if WSDL_DIR:
+        local = path.abspath(path.join(WSDL_DIR, url.rsplit("/", 1)[-1]))
+        if path.exists(local):
+            return "file://" + local
+    return url
+
+
+def get_client(url):
+    """Returns the suds `Client` for `url`.  Clients are created on first use
+    and shared for the lifetime of the process.
+    """
+    try:
+        return _clients[url]
+    except KeyError:
+        pass
+    with _clients_lock:
+        client = _clients.get(url)
+        if client is None:
+            location = _cache_dir(CACHE_DIR)
+            if location is not None:
+                cache = ObjectCache(location=location, days=CACHE_DAYS)
+                client = Client(_wsdl_url(url), cache=cache, cachingpolicy=1,
+                                transport=PooledTransport(
+                                    connection_pool, NON_IDEMPOTENT))
+            else:
+                client = Client(_wsdl_url(url), cache=None,
+                                transport=PooledTransport(
+                                    connection_pool, NON_IDEMPOTENT))
+            _clients[url] = client
+    return client
+
+
+class _Lazy(object):
+    """Proxy that creates the wrapped object on first attribute access.
+    """
+
+    __slots__ = ("_factory", "_obj")
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_obj", None)
+
+    def _resolve(self):
+        obj = self._obj
+        if obj is None:
+            obj = self._factory()
+            object.__setattr__(self, "_obj", obj)
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __repr__(self):
+        if self._obj is None:
+            return "<lazy %r>" % self._factory
+        return repr(self._obj)
+
+
+def _snapshot(value):
+    """Returns a function that restores `value` to its current state and
+    returns it.  suds objects and lists are restored in place, recursively.
+    """
+    if isinstance(value, list):
+        items = [_snapshot(v) for v in value]
+        return lambda: [restore() for restore in items]
+    if isinstance(value, Object):
+        keys = list(value.__keylist__)
+        attrs = [(k, _snapshot(getattr(value, k))) for k in keys]
+
+        def restore():
+            for k in value.__keylist__[len(keys):]:
+                delattr(value, k)
+            for k, restore_attr in attrs:
+                setattr(value, k, restore_attr())
+            return value
+        return restore
+    return lambda: value
+
+
+class RequestPool(object):
+    """Hands out prebuilt request objects instead of creating a new one with
+    `Factory.create` on every call.
+
+    `Factory.create` resolves the type in the schema each time it is called.
+    The pool creates one object per factory, type and thread and resets it to
+    its initial state when it is requested again.  An object is therefore only
+    valid until the next `create` of the same type in the same thread.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def create(self, factory, name):
+        """Returns a request object of type `name` as `factory.create(name)`
+        would.
+        """
+        try:
+            requests = self._local.requests
+        except AttributeError:
+            requests = self._local.requests = {}
+        key = (factory, name)
+        restore = requests.get(key)
+        if restore is None:
+            obj = factory.create(name)
+            if isinstance(obj, Object):
+                requests[key] = _snapshot(obj)
+            return obj
+        return restore()
+
+
+def _enum(factory, name):
+    return _Lazy(lambda: factory.create(name))
+
+
+BFGlobalService = _Lazy(lambda: get_client(BFGlobalServiceUrl).service)
+BFGlobalFactory = _Lazy(lambda: get_client(BFGlobalServiceUrl).factory)
+
+BFExchangeService = _Lazy(lambda: get_client(BFExchangeServiceUrl).service)
+BFExchangeFactory = _Lazy(lambda: get_client(BFExchangeServiceUrl).factory)
 
 # Error enumerations
-APIErrorEnum = BFGlobalFactory.create("ns1:APIErrorEnum")
-LoginErrorEnum = BFGlobalFactory.create("ns1:LoginErrorEnum")
-GetEventsErrorEnum = BFGlobalFactory.create("ns1:GetEventsErrorEnum")
-ConvertCurrencyErrorEnum = BFGlobalFactory.create("ns1:ConvertCurrencyErrorEnum")
-GetBetErrorEnum = BFExchangeFactory.create("ns1:GetBetErrorEnum")
-GetAllMarketsErrorEnum = BFExchangeFactory.create("ns1:GetAllMarketsErrorEnum")
-GetCompleteMarketPricesErrorEnum = BFExchangeFactory.create("ns1:GetCompleteMarketPricesErrorEnum")
-GetInPlayMarketsErrorEnum = BFExchangeFactory.create("ns1:GetInPlayMarketsErrorEnum")
-GetMarketPricesErrorEnum = BFExchangeFactory.create("ns1:GetMarketPricesErrorEnum")
-GetMarketErrorEnum = BFExchangeFactory.create("ns1:GetMarketErrorEnum")
+APIErrorEnum = _enum(BFGlobalFactory, "ns1:APIErrorEnum")
+LoginErrorEnum = _enum(BFGlobalFactory, "ns1:LoginErrorEnum")
+GetEventsErrorEnum = _enum(BFGlobalFactory, "ns1:GetEventsErrorEnum")
+ConvertCurrencyErrorEnum = _enum(BFGlobalFactory, "ns1:ConvertCurrencyErrorEnum")
+GetBetErrorEnum = _enum(BFExchangeFactory, "ns1:GetBetErrorEnum")
+GetAllMarketsErrorEnum = _enum(BFExchangeFactory, "ns1:GetAllMarketsErrorEnum")
+GetCompleteMarketPricesErrorEnum = _enum(BFExchangeFactory, "ns1:GetCompleteMarketPricesErrorEnum")
+GetInPlayMarketsErrorEnum = _enum(BFExchangeFactory, "ns1:GetInPlayMarketsErrorEnum")
+GetMarketPricesErrorEnum = _enum(BFExchangeFactory, "ns1:GetMarketPricesErrorEnum")
+GetMarketErrorEnum = _enum(BFExchangeFactory, "ns1:GetMarketErrorEnum")
+GetMarketTradedVolumeErrorEnum = _enum(BFExchangeFactory, "ns1:GetMarketTradedVolumeErrorEnum")
+PlaceBetsErrorEnum = _enum(BFExchangeFactory, "ns1:PlaceBetsErrorEnum")
+CancelBetsErrorEnum = _enum(BFExchangeFactory, "ns1:CancelBetsErrorEnum")
+CancelBetsByMarketErrorEnum = _enum(BFExchangeFactory, "ns1:CancelBetsByMarketErrorEnum")
+UpdateBetsErrorEnum = _enum(BFExchangeFactory, "ns1:UpdateBetsErrorEnum")
+GetMUBetsErrorEnum = _enum(BFExchangeFactory, "ns1:GetMUBetsErrorEnum")
+GetCurrentBetsErrorEnum = _enum(BFExchangeFactory, "ns1:GetCurrentBetsErrorEnum")
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import threading
+import time
+
+from itertools import count
+
+
+__all__ = (
+    "RateLimiter", "PRIORITY_BETS", "PRIORITY_SESSION", "PRIORITY_DATA",
+    "RATE_LIMITS", "DEFAULT_RATE_LIMITS",
+)
+
+
+# Priority classes; lower values are served first.
+PRIORITY_BETS = 0
+PRIORITY_SESSION = 1
+PRIORITY_DATA = 2
+
+PRIORITIES = {
+    "placeBets": PRIORITY_BETS,
+    "updateBets": PRIORITY_BETS,
+    "cancelBets": PRIORITY_BETS,
+    "cancelBetsByMarket": PRIORITY_BETS,
+    "login": PRIORITY_SESSION,
+    "logout": PRIORITY_SESSION,
+    "keepAlive": PRIORITY_SESSION,
+}
+
+# Budgets as ``operation: (calls, seconds)``.  The budget for "*" is shared by
+# all operations; Betfair charges for more than 20 data requests per second.
+DEFAULT_RATE_LIMITS = {
+    "*": (20, 1.0),
+}
+
+# Per product id.  The limits of the Free Access API are those of the Betfair
+# API 6 documentation.
+RATE_LIMITS = {
+    82: dict(DEFAULT_RATE_LIMITS, **{
+        "getAllMarkets": (5, 60.0),
+        "getMarket": (5, 60.0),
+        "getMarketPrices": (10, 60.0),
+        "getMarketPricesCompressed": (60, 60.0),
+        "getCompleteMarketPricesCompressed": (60, 60.0),
+        "getDetailAvailableMktDepth": (60, 60.0),
+        "getMarketTradedVolume": (60, 60.0),
+        "getMarketTradedVolumeCompressed": (60, 60.0),
+        "getMarketProfitAndLoss": (60, 60.0),
+        "getCurrentBets": (60, 60.0),
+        "getMUBets": (60, 60.0),
+        "getBetHistory": (1, 60.0),
+        "getAccountFunds": (1, 60.0),
+        "getAccountStatement": (1, 60.0),
+        "placeBets": (1000, 60.0),
+        "updateBets": (1000, 60.0),
+        "cancelBets": (1000, 60.0),
+    }),
+}
+
+
+class _Bucket(object):
+
+    __slots__ = ("capacity", "rate", "tokens", "stamp")
+
+    def __init__(self, calls, seconds):
+        self.capacity = float(calls)
+        self.rate = calls / float(seconds)
+        self.tokens = self.capacity
+        self.stamp = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self):
+        """Returns the number of seconds until a token is available.
+        """
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    """Token buckets that keep the calls of a session within the per-operation
+    budgets of a Betfair product.
+
+    A call that would exceed a budget is queued until a token is available.
+    Queued calls that draw on the same budget are admitted in order of
+    priority class and then in order of arrival, so that bet placement and
+    cancellation go ahead of data polling.
+    """
+
+    def __init__(self, limits, priorities=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        limits : `dict`
+            Maps operation names to ``(calls, seconds)``.  The budget for
+            ``"*"`` applies to all operations together.
+        priorities : `dict` or `None`
+            Maps operation names to priority classes.  Operations that are
+            not listed have PRIORITY_DATA.  Default is PRIORITIES.
+        """
+        self.limits = dict(limits)
+        self.priorities = PRIORITIES if priorities is None else priorities
+        self._buckets = dict((op, _Bucket(*limit))
+                             for op, limit in self.limits.iteritems())
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = count()
+        self.calls = 0
+        self.delayed = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.wait_time = 0.0
+
+    def acquire(self, operation, priority=None):
+        """Blocks until `operation` can be called within its budgets and
+        returns the number of seconds that the call was held back.
+        """
+        buckets = [b for b in (self._buckets.get(operation),
+                               self._buckets.get("*")) if b is not None]
+        if priority is None:
+            priority = self.priorities.get(operation, PRIORITY_DATA)
+        waiter = (priority, next(self._seq), buckets)
+        t0 = None
+        with self._cond:
+            self.calls += 1
+            if not buckets:
+                return 0.0
+            self._waiters.append(waiter)
+            try:
+                while True:
+                    now = time.time()
+                    for bucket in buckets:
+                        bucket.refill(now)
+                    delay = max(bucket.delay() for bucket in buckets)
+                    if not delay and not self._is_blocked(waiter):
+                        break
+                    if t0 is None:
+                        t0 = now
+                        self.delayed += 1
+                        self.queued += 1
+                        self.max_queued = max(self.max_queued, self.queued)
+                    # Without a delay the call waits for a call of higher
+                    # priority, which notifies when it is admitted.
+                    self._cond.wait(delay or None)
+                for bucket in buckets:
+                    bucket.tokens -= 1.0
+            finally:
+                self._waiters.remove(waiter)
+                if t0 is not None:
+                    self.queued -= 1
+                    self.wait_time += time.time() - t0
+                self._cond.notify_all()
+        return time.time() - t0 if t0 is not None else 0.0
+
+    def stats(self):
+        """Returns a dict with the number of calls, the number of calls that
+        were held back, the current and maximum number of queued calls and
+        the total and mean time that calls were held back.
+        """
+        with self._cond:
+            calls = self.calls
+            return {
+                "calls": calls,
+                "delayed": self.delayed,
+                "queue_depth": self.queued,
+                "max_queue_depth": self.max_queued,
+                "wait_time": self.wait_time,
+                "mean_wait_time": self.wait_time / calls if calls else 0.0,
+            }
+
+    def _is_blocked(self, waiter):
+        """Returns True if a call that is queued ahead of `waiter` needs a
+        token that `waiter` would take.
+
+        A call ahead only holds back `waiter` on the buckets that they share,
+        and only if taking a token from such a bucket now leaves it short
+        when the call ahead is due, e.g. not for a shared "*" budget while
+        the call ahead waits for a budget of its own operation.
+        """
+        priority, seq, buckets = waiter
+        now = time.time()
+        reserved = {}
+        for other in sorted(self._waiters):
+            if other[:2] >= (priority, seq):
+                break
+            shared = [b for b in other[2] if b in buckets]
+            if not shared:
+                continue
+            for bucket in other[2]:
+                bucket.refill(now)
+            delay = max(bucket.delay() for bucket in other[2])
+            for bucket in shared:
+                reserved[bucket] = reserved.get(bucket, 0) + 1
+                if bucket.tokens - 1.0 + bucket.rate * delay < \
+                        reserved[bucket]:
+                    return True
+        return False
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import errno
+import httplib
+import select
+import socket
+import threading
+import time
+import urllib2
+
+from StringIO import StringIO
+from urlparse import urlsplit
+
+from suds.transport import Reply, Transport, TransportError
+
+
+__all__ = (
+    "ConnectionPool", "PooledTransport",
+)
+
+
+def _is_stale(e):
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return isinstance(e, socket.error) and e.errno in (errno.EPIPE,
+                                                       errno.ECONNRESET)
+
+
+def _is_dropped(conn):
+    # An idle connection only becomes readable when the server closes it.
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, ValueError):
+        return False
+
+
+class ConnectionPool(object):
+    """Bounded pool of persistent HTTP and HTTPS connections.
+
+    Connections are kept open after a request and reused by the next request
+    to the same host, which saves a TCP connect and TLS handshake per call.
+    At most `max_connections` connections are open at any time; a request
+    that finds all of them busy waits for one to be released, for at most
+    `acquire_timeout` seconds if given.
+
+    A request that fails on a reused connection because the server closed it
+    is sent once more on a new connection.  Requests that are not
+    idempotent are only sent again if they failed while being sent; once the
+    request is out the server may have executed it.
+    """
+
+    def __init__(self, max_connections=8, timeout=90, acquire_timeout=None):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = {}
+        self._open = 0
+        self._cond = threading.Condition()
+        self.requests = 0
+        self.reused = 0
+        self.wait_time = 0.0
+
+    def request(self, method, url, body=None, headers=None, idempotent=True):
+        """Sends an HTTP request and returns ``(status, reason, headers,
+        body)`` of the response.  With `idempotent` False the request is not
+        sent again after it failed waiting for the response.
+        """
+        scheme, netloc, path, query, _ = urlsplit(url)
+        if query:
+            path = "?".join((path, query))
+        key = (scheme, netloc)
+        conn, reused = self._acquire(key)
+        sent = False
+        try:
+            conn.request(method, path, body, headers or {})
+            sent = True
+            rsp = conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            self._release(key, conn, False)
+            if not reused or not _is_stale(e) or (sent and not idempotent):
+                raise
+            # The server closed the idle connection; retry once on a new
+            # connection.
+            conn, reused = self._acquire(key, fresh=True)
+            try:
+                rsp = self._send(conn, method, path, body, headers)
+            except:
+                self._release(key, conn, False)
+                raise
+        try:
+            data = rsp.read()
+        except:
+            # A body that could not be read leaves the connection unusable.
+            self._release(key, conn, False)
+            raise
+        self._release(key, conn, not rsp.will_close)
+        return rsp.status, rsp.reason, dict(rsp.getheaders()), data
+
+    def stats(self):
+        """Returns a dict with the number of open and idle connections, the
+        number of requests, the fraction of requests that reused a
+        connection and the total and mean time spent waiting for a
+        connection.
+        """
+        with self._cond:
+            requests = self.requests
+            return {
+                "open": self._open,
+                "idle": sum(len(conns) for conns in self._idle.itervalues()),
+                "requests": requests,
+                "reuse_ratio": float(self.reused) / requests if requests else 0.0,
+                "wait_time": self.wait_time,
+                "mean_wait_time": self.wait_time / requests if requests else 0.0,
+            }
+
+    def close(self):
+        """Closes the idle connections.
+        """
+        with self._cond:
+            for conns in self._idle.itervalues():
+                for conn in conns:
+                    conn.close()
+                self._open -= len(conns)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers or {})
+        return conn.getresponse()
+
+    def _acquire(self, key, fresh=False):
+        t0 = time.time()
+        conn = None
+        with self._cond:
+            while True:
+                idle = self._idle.get(key)
+                if idle and not fresh:
+                    conn = idle.pop()
+                    if not _is_dropped(conn):
+                        break
+                    conn.close()
+                    conn = None
+                    self._open -= 1
+                    continue
+                if self._open < self.max_connections:
+                    self._open += 1
+                    break
+                # Make room by closing a connection that is idle, which may
+                # belong to another host.
+                for conns in self._idle.itervalues():
+                    if conns:
+                        conns.pop().close()
+                        self._open -= 1
+                        break
+                else:
+                    if self.acquire_timeout is None:
+                        self._cond.wait()
+                        continue
+                    remaining = t0 + self.acquire_timeout - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout(
+                            "no connection available after %.1f seconds" %
+                            self.acquire_timeout)
+                    self._cond.wait(remaining)
+            self.requests += 1
+            self.reused += conn is not None
+            self.wait_time += time.time() - t0
+        if conn is not None:
+            return conn, True
+        try:
+            if key[0] == "https":
+                conn = httplib.HTTPSConnection(key[1], timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(key[1], timeout=self.timeout)
+            conn.connect()
+            # Requests are small and latency sensitive.
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        return conn, False
+
+    def _release(self, key, conn, reusable):
+        with self._cond:
+            if reusable:
+                self._idle.setdefault(key, []).append(conn)
+            else:
+                conn.close()
+                self._open -= 1
+            self._cond.notify()
+
+
+class PooledTransport(Transport):
+    """suds transport that sends HTTP(S) requests over a `ConnectionPool`.
+    Other URLs, such as file URLs of local WSDLs, are opened with urllib2.
+
+    Requests of the SOAP operations in `non_idempotent`, such as the
+    placement of bets, are never sent twice by the pool.
+    """
+
+    def __init__(self, pool=None, non_idempotent=()):
+        Transport.__init__(self)
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.non_idempotent = frozenset(non_idempotent)
+
+    def open(self, request):
+        if not request.url.startswith(("http:", "https:")):
+            return urllib2.urlopen(request.url)
+        status, reason, headers, data = self.pool.request(
+            "GET", request.url, headers=request.headers)
+        if status != 200:
+            raise TransportError(reason, status, StringIO(data))
+        return StringIO(data)
+
+    def send(self, request):
+        action = request.headers.get("SOAPAction", "").strip('"')
+        status, reason, headers, data = self.pool.request(
+            "POST", request.url, request.message, request.headers,
+            idempotent=action not in self.non_idempotent)
+        if status in (202, 204):
+            return None
+        if status != 200:
+            raise TransportError(reason, status, StringIO(data))
+        return Reply(status, headers, data)
@@ -14,8 +14,6 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-from itertools import izip
-
 def _mk_class(name, attrs):
     """Creates a class similar to a namedtuple.  These classes are compatible
     with SQLAlchemy, however.
@@ -23,13 +21,16 @@ def _mk_class(name, attrs):
     class_ = type(name, (object,), {attr: None for attr in attrs})
     class_.__slots__ = attrs
 
-    def __init__(self, *args, **kwargs):
-        for attr, val in izip(self.__slots__, args):
-            setattr(self, attr, val)
-        for k, v in kwargs.iteritems():
-            if k not in self.__slots__:
-                raise ValueError("%s : Invalid attribute" % k)
-            setattr(self, k, v)
+    # __init__ is generated with one keyword argument per attribute because
+    # it is called for every decoded price.  Surplus positional arguments are
+    # ignored.
+    src = "def __init__(self, %s, *_args, **kwargs):\n" % (
+        ", ".join("%s=None" % attr for attr in attrs))
+    src += "".join("    self.%s = %s\n" % (attr, attr) for attr in attrs)
+    src += "    if kwargs: raise ValueError(\"%s : Invalid attribute\" % kwargs.keys()[0])\n"
+    namespace = {}
+    exec src in namespace
+    __init__ = namespace["__init__"]
 
     def __repr__(self):
         s = ", ".join("=".join((a, repr(getattr(self, a)))) for a in self.__slots__)
@@ -186,6 +187,33 @@ RunnerPrice = _mk_class(
 )
 
 
+# Columnar alternative to a list of RunnerPrice.  Every attribute is a NumPy
+# array with one row per runner.  The back and lay ladders are 2-D arrays that
+# are padded to the deepest ladder in the market; column i holds depth i + 1.
+# Missing prices are NaN and missing amounts are 0.
+RunnerPriceColumns = _mk_class(
+    "RunnerPriceColumns", (
+        "selectionId",
+        "sortOrder",
+        "totalAmountMatched",
+        "lastPriceMatched",
+        "handicap",
+        "reductionFactor",
+        "vacant",
+        "farBSP",
+        "nearBSP",
+        "actualBSP",
+        "backPrice",        # Prices available to back
+        "backAmount",
+        "backDepth",        # Number of back levels per runner
+        "layPrice",         # Prices available to lay
+        "layAmount",
+        "layDepth",         # Number of lay levels per runner
+    )
+)
+RunnerPriceColumns.__len__ = lambda self: len(self.selectionId)
+
+
 Price = _mk_class(
     "Price", (
         "price",
@@ -195,6 +223,68 @@ Price = _mk_class(
     )
 )
 
+CompleteMarketPrices = _mk_class(
+    "CompleteMarketPrices", (
+        "marketId",
+        "delay",
+        "removedRunners",
+        "runnerPrices",     # List of CompleteRunnerPrice
+    )
+)
+
+CompleteRunnerPrice = _mk_class(
+    "CompleteRunnerPrice", (
+        "selectionId",
+        "sortOrder",
+        "totalAmountMatched",
+        "lastPriceMatched",
+        "handicap",
+        "reductionFactor",
+        "vacant",
+        "asianLineId",
+        "farBSP",
+        "nearBSP",
+        "actualBSP",
+        "prices",           # List of AvailabilityInfo or an array with
+                            # one row of AvailabilityInfo fields per price
+    )
+)
+
+AvailabilityInfo = _mk_class(
+    "AvailabilityInfo", (
+        "odds",
+        "totalAvailableBackAmount",
+        "totalAvailableLayAmount",
+        "totalBspBackAmount",
+        "totalBspLayAmount",
+    )
+)
+
+
+MarketPricesDelta = _mk_class(
+    "MarketPricesDelta", (
+        "marketId",
+        "marketStatus",     # New market status or None if unchanged
+        "runners",          # List of RunnerPrice with changed runner fields
+        "ladderChanges",    # List of LadderChange
+        "removedRunners",   # Selection ids that are no longer priced
+    )
+)
+MarketPricesDelta.__nonzero__ = lambda self: bool(
+    self.marketStatus or self.runners or self.ladderChanges or
+    self.removedRunners)
+
+LadderChange = _mk_class(
+    "LadderChange", (
+        "selectionId",
+        "side",             # "back" or "lay"
+        "price",
+        "oldAmount",        # 0.0 if the level was added
+        "newAmount",        # 0.0 if the level was removed
+    )
+)
+
+
 Runner = _mk_class(
     "Runner", (
         "asianLineId",
@@ -286,6 +376,35 @@ CancelBet = _mk_class(
     )
 )
 
+CancelBetResult = _mk_class(
+    "CancelBetResult", (
+        "betId",
+        "resultCode",
+        "sizeCancelled",
+        "sizeMatched",
+        "success",
+    )
+)
+
+UpdateBetResult = _mk_class(
+    "UpdateBetResult", (
+        "betId",
+        "newBetId",
+        "newPrice",
+        "newSize",
+        "resultCode",
+        "sizeCancelled",
+        "success",
+    )
+)
+
+CancelBetsByMarketResult = _mk_class(
+    "CancelBetsByMarketResult", (
+        "marketId",
+        "resultCode",
+    )
+)
+
 Match = _mk_class(
     "Match", (
         "betStatus",
@@ -299,6 +418,49 @@ Match = _mk_class(
     )
 )
 
+MUBet = _mk_class(
+    "MUBet", (
+        "asianLineId",
+        "betCategoryType",
+        "betId",
+        "betPersistenceType",
+        "betStatus",
+        "betType",
+        "bspLiability",
+        "handicap",
+        "marketId",
+        "matchedDate",
+        "placedDate",
+        "price",
+        "selectionId",
+        "size",
+        "transactionId",
+    )
+)
+
+BetLite = _mk_class(
+    "BetLite", (
+        "betCategoryType",
+        "betId",
+        "betPersistenceType",
+        "betStatus",
+        "bspLiability",
+        "marketId",
+        "matchedSize",
+        "remainingSize",
+    )
+)
+
+MatchLite = _mk_class(
+    "MatchLite", (
+        "betStatus",
+        "matchedDate",
+        "priceMatched",
+        "sizeMatched",
+        "transactionId",
+    )
+)
+
 MarketInfo = _mk_class(
     "MarketInfo", (
         'countryISO3',
@@ -16,8 +16,11 @@
 
 import re
 import functools
+import sys
+import threading
+import time
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from itertools import izip
 from datetime import datetime
 
@@ -37,6 +40,7 @@ def untested(logger):
         def wrapper(*args, **kwargs):
             logger.warning("%s: has not been tested.  Use at your own risk", fn.__name__)
             return fn(*args, **kwargs)
+        return wrapper
     return decorator
 
 
@@ -63,71 +67,51 @@ def as_bool(s):
     if not s: return False
     return s.lower() in ["true", "y", "1"]
 
+_unescape = functools.partial(re.compile(r"\\(.)").sub, r"\1")
+
 def as_string(s):
+    """Returns a string with escaped separators restored.
+    """
     if not s: return ""
-    return s.replace(r"\\", "")
-
-
-
-class DecompressPrice(object):
-
-    tokenise = lambda self, data: data.split("~")
-    decoders = (
-        as_float,   # price
-        as_float,   # amountAvailable
-        None,       # betType ("B" or "L")
-        as_int,     # depth
-    )
-
-    def __call__(self, data):
-        L = [
-            decode(fld) if decode else fld
-            for decode, fld in izip(self.decoders, self.tokenise(data))
-        ]
-        return Price(*L)
-
+    if "\\" in s:
+        s = _unescape(s)
+    return s
 
-class DecompressRunnerPrice(object):
 
-    tokenise = staticmethod(lambda data: data.split("~"))
-    decoders = (
-        as_int,   # selectionId
-        as_int,   # sortOrder
-        as_float, # totalAmountMatched
-        as_float, # lastPriceMatched
-        as_float, # handicap
-        as_float, # reductionFactor
-        as_bool,  # vacant
-        as_float, # farBSP
-        as_float, # nearBSP
-        as_float, # actualBSP
-    )
+_split_unescaped = {
+    ":": re.compile(r"(?<!\\):").split,
+    "~": re.compile(r"(?<!\\)~").split,
+}
 
-    def __call__(self, data, lay_prices, back_prices):
-        data = self.tokenise(data)
-        data = [decode(fld) for fld, decode in izip(data, self.decoders)]
-        # Extend with asianLineId, which is not available from compressed
-        # market prices.
-        data += [ lay_prices, back_prices, None ]
-        data = RunnerPrice(*data)
-        return data
 
+def split_unescaped(data, sep):
+    """Splits `data` on `sep`, ignoring separators that are escaped with a
+    backslash.  The regular expression is only used if `data` contains a
+    backslash.
+    """
+    if "\\" in data:
+        return _split_unescaped[sep](data)
+    return data.split(sep)
 
-class DecompressRunners(object):
 
-    tokenise = lambda self, data: data.split("|")
-    decode_runner_price = DecompressRunnerPrice()
-    decode_price = DecompressPrice()
+def tokenise_market_prices(data):
+    """Splits a compressed market prices string into its fields.
 
-    def __call__(self, data):
-        data = self.tokenise(data)
-        prices = [ self.decode_price(fld) for fld in data[1:] if fld ]
-        # Prices that are available to Lay are made up of unmatched "Back" bets whereas
-        # prices that are available to Back are made up of unmatched "Lay" bets
-        lay_prices = [p for p in prices if p.betType == "B"]
-        back_prices = [p for p in prices if p.betType == "L"]
-        rp = self.decode_runner_price(data[0], lay_prices, back_prices)
-        return rp
+    Returns a tuple ``(info, runners)``.  `info` is the list of market fields
+    and `runners` is a list of ``(fields, back, lay)`` tuples with the runner
+    fields and the flattened ``price~amount~betType~depth`` fields of the
+    prices available to back and to lay.
+    """
+    records = split_unescaped(data.strip(), ":")
+    info = split_unescaped(records[0], "~")
+    runners = []
+    for record in records[1:]:
+        record = record.split("|")
+        fields = record[0].split("~")
+        back = record[1].split("~") if len(record) > 1 else []
+        lay = record[2].split("~") if len(record) > 2 else []
+        runners.append((fields, back, lay))
+    return info, runners
 
 
 class DecompressRemovedRunners(object):
@@ -138,10 +122,10 @@ class DecompressRemovedRunners(object):
         return self.tokenise(data)
 
 
-class DecompressMarketPricesInfo(object):
+class DecompressMarketPrices(object):
 
-    tokenise = re.compile(r"(?<!\\)~").split
-    decoders = (
+    tokenise = staticmethod(tokenise_market_prices)
+    info_decoders = (
         as_int,      # marketId
         None,        # currency
         None,        # marketStatus
@@ -154,25 +138,192 @@ class DecompressMarketPricesInfo(object):
         None,        # removedRunners
         as_bool,     # bspMarket
     )
+    runner_decoders = (
+        as_int,   # selectionId
+        as_int,   # sortOrder
+        as_float, # totalAmountMatched
+        as_float, # lastPriceMatched
+        as_float, # handicap
+        as_float, # reductionFactor
+        as_bool,  # vacant
+        as_float, # farBSP
+        as_float, # nearBSP
+        as_float, # actualBSP
+    )
 
-    def __call__(self, data):
-        data = self.tokenise(data)
-        data = [decode(fld) if decode else fld 
-                for fld, decode in izip(data, self.decoders)]
-        return data
+    runner_dtypes = (
+        "i8", # selectionId
+        "i4", # sortOrder
+        "f8", # totalAmountMatched
+        "f8", # lastPriceMatched
+        "f8", # handicap
+        "f8", # reductionFactor
+        "?",  # vacant
+        "f8", # farBSP
+        "f8", # nearBSP
+        "f8", # actualBSP
+    )
 
+    def __call__(self, data, columnar=False):
+        """Decodes compressed market prices.
+
+        If `columnar` is True then `runnerPrices` of the result is a
+        `RunnerPriceColumns` of NumPy arrays instead of a list of
+        `RunnerPrice`.  The columnar mode requires NumPy.
+        """
+        info, runners = self.tokenise(data)
+        mp = self.decode_info(info)
+        if columnar:
+            mp.runnerPrices = self.decode_columns(runners)
+        else:
+            mp.runnerPrices = [self.decode_runner(*runner) for runner in runners]
+        return mp
+
+    def decode_info(self, fields):
+        return MarketPrices(*[decode(fld) if decode else fld
+                              for fld, decode in izip(fields, self.info_decoders)])
+
+    def decode_runner(self, fields, back, lay):
+        rp = RunnerPrice(*[decode(fld)
+                           for fld, decode in izip(fields, self.runner_decoders)])
+        # Prices that are available to Back are made up of unmatched "Lay"
+        # bets and are listed first; prices that are available to Lay are made
+        # up of unmatched "Back" bets.
+        rp.bestPricesToBack = self.decode_prices(back)
+        rp.bestPricesToLay = self.decode_prices(lay)
+        return rp
 
-class DecompressMarketPrices(object):
+    @staticmethod
+    def decode_prices(fields):
+        # The fields are price~amountAvailable~betType~depth repeated for each
+        # level; izip drops the empty field after the trailing separator.
+        return [Price(float(price), float(amount), bet_type, int(depth))
+                for price, amount, bet_type, depth in izip(
+                    fields[0::4], fields[1::4], fields[2::4], fields[3::4])]
+
+    def decode_columns(self, runners):
+        import numpy as np
+
+        n = len(runners)
+        columns = []
+        for i, (decode, dtype) in enumerate(izip(self.runner_decoders,
+                                                 self.runner_dtypes)):
+            values = (decode(r[0][i] if i < len(r[0]) else "") for r in runners)
+            columns.append(np.fromiter(values, dtype, n))
+        columns.extend(self.decode_ladder(np, [r[1] for r in runners]))
+        columns.extend(self.decode_ladder(np, [r[2] for r in runners]))
+        return RunnerPriceColumns(*columns)
+
+    @staticmethod
+    def decode_ladder(np, sections):
+        levels = np.fromiter((len(fields) // 4 for fields in sections), "i4",
+                             len(sections))
+        depth = levels.max() if len(levels) else 0
+        prices = np.full((len(sections), depth), np.nan)
+        amounts = np.zeros((len(sections), depth))
+        # Gather all levels into flat lists so that NumPy converts the numeric
+        # strings in one call, then scatter them into the padded ladders.
+        flat_prices, flat_amounts = [], []
+        for fields in sections:
+            flat_prices.extend(fields[0:len(fields) - 3:4])
+            flat_amounts.extend(fields[1:len(fields) - 2:4])
+        rows = np.repeat(np.arange(len(sections)), levels)
+        cols = np.arange(len(rows)) - np.repeat(np.cumsum(levels) - levels,
+                                                levels)
+        prices[rows, cols] = np.array(flat_prices, dtype=float)
+        amounts[rows, cols] = np.array(flat_amounts, dtype=float)
+        return prices, amounts, levels
+
+
+def tokenise_complete_market_prices(data):
+    """Splits a compressed complete market prices string into its fields.
+
+    Returns a tuple ``(info, runners)``.  `info` is the list of market fields
+    and `runners` is a list of ``(fields, prices)`` tuples with the runner
+    fields and the flattened fields of all prices of the runner.
+    """
+    records = split_unescaped(data.strip(), ":")
+    info = split_unescaped(records[0], "~")
+    runners = []
+    for record in records[1:]:
+        fields, _, prices = record.partition("|")
+        runners.append((fields.split("~"), prices.split("~")))
+    return info, runners
 
-    tokenize = re.compile(r"(?<!\\):").split
-    decode_info = DecompressMarketPricesInfo()
-    decode_prices = DecompressRunners()
 
-    def __call__(self, data):
-        data = self.tokenize(data.strip())
-        mp = self.decode_info(data[0])
-        mp.append([ self.decode_prices(fld) for fld in data[1:] ])
-        return MarketPrices(*mp)
+class DecompressCompleteMarketPrices(object):
+
+    tokenise = staticmethod(tokenise_complete_market_prices)
+    info_decoders = (
+        as_int,      # marketId
+        as_int,      # delay
+        None,        # removedRunners
+    )
+    runner_decoders = (
+        as_int,   # selectionId
+        as_int,   # sortOrder
+        as_float, # totalAmountMatched
+        as_float, # lastPriceMatched
+        as_float, # handicap
+        as_float, # reductionFactor
+        as_bool,  # vacant
+        as_int,   # asianLineId
+        as_float, # farBSP
+        as_float, # nearBSP
+        as_float, # actualBSP
+    )
+
+    def __call__(self, data, columnar=False):
+        """Decodes compressed complete market prices.
+
+        If `columnar` is True then the prices of each runner are returned as
+        a NumPy array of shape (n, 5) with the AvailabilityInfo fields in the
+        columns instead of a list of `AvailabilityInfo`.  The columnar mode
+        requires NumPy.
+        """
+        info, runners = self.tokenise(data)
+        cmp = CompleteMarketPrices(*[
+            decode(fld) if decode else fld
+            for fld, decode in izip(info, self.info_decoders)])
+        sections = [prices for _, prices in runners]
+        if columnar:
+            prices = self.decode_columns(sections)
+        else:
+            prices = [self.decode_prices(fields) for fields in sections]
+        cmp.runnerPrices = [
+            self.decode_runner(fields, p)
+            for (fields, _), p in izip(runners, prices)
+        ]
+        return cmp
+
+    def decode_runner(self, fields, prices):
+        rp = CompleteRunnerPrice(*[
+            decode(fld) for fld, decode in izip(fields, self.runner_decoders)])
+        rp.prices = prices
+        return rp
+
+    @staticmethod
+    def decode_prices(fields):
+        # The fields are price~backAmount~layAmount~bspBackAmount~bspLayAmount
+        # repeated for each price; izip drops the empty trailing field.
+        return [AvailabilityInfo(float(odds), float(back), float(lay),
+                                 float(bsp_back), float(bsp_lay))
+                for odds, back, lay, bsp_back, bsp_lay in izip(
+                    fields[0::5], fields[1::5], fields[2::5], fields[3::5],
+                    fields[4::5])]
+
+    @staticmethod
+    def decode_columns(sections):
+        import numpy as np
+
+        # Convert the prices of all runners in one call and return a view of
+        # the rows of each runner.
+        flat, offsets = [], []
+        for fields in sections:
+            flat.extend(fields[:len(fields) - len(fields) % 5])
+            offsets.append(len(flat) // 5)
+        prices = np.array(flat, dtype=float).reshape(-1, 5)
+        return np.split(prices, offsets[:-1])
 
 
 class DecompressOneMarket(object):
@@ -206,12 +357,210 @@ class DecompressOneMarket(object):
 
 class DecompressMarkets(object):
 
-    tokenise = re.compile(r"(?<!\\):").split
+    separator = re.compile(r"(?<!\\):")
+    tokenise = separator.split
     decode = DecompressOneMarket()
 
     def __call__(self, data):
         return [self.decode(f) for f in DecompressMarkets.tokenise(data.strip()) if f]
 
+    def iter(self, data):
+        """Yields the markets in `data` one at a time.
+
+        Unlike calling the decoder, the payload is neither copied nor split
+        into a list of records; each record is sliced out of `data` only when
+        the next market is requested.
+        """
+        start = 0
+        for match in self.separator.finditer(data):
+            record = data[start:match.start()].strip()
+            if record:
+                yield self.decode(record)
+            start = match.end()
+        record = data[start:].strip()
+        if record:
+            yield self.decode(record)
+
+
+class PayloadCache(object):
+    """Remembers the last raw payload and its decoded value per key so that a
+    payload that is identical to the previous one for the same key is not
+    decoded again.
+
+    The raw payload is its own fingerprint: comparing two strings of
+    different length is free and equal strings are compared with memcmp,
+    which is cheaper than hashing them.
+
+    At most `max_entries` keys are remembered; the least recently used key is
+    forgotten first.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def decode(self, key, data, decoder, **kwargs):
+        """Returns ``(value, modified)``.  `value` is ``decoder(data,
+        **kwargs)`` or the value of the previous call for `key` if `data` did
+        not change, in which case `modified` is False.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # Re-inserting moves the entry to the most recently used end.
+                self._entries[key] = entry
+                if entry[0] == data:
+                    self.hits += 1
+                    return entry[1], False
+        value = decoder(data, **kwargs)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (data, value)
+            self.misses += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value, True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+class _Flight(object):
+
+    __slots__ = ("done", "value", "exc_info")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """Lets concurrent calls with the same key share one call of the
+    underlying function and its result.
+
+    The first caller for a key makes the call; callers that arrive while it
+    is in flight wait for it and receive the same value or exception.  With a
+    positive `freshness` a result is also returned to callers that arrive up
+    to `freshness` seconds after it was produced.
+    """
+
+    def __init__(self, freshness=0.0):
+        self.freshness = freshness
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._results = {}
+        self._prune_at = 64
+        self.calls = 0
+        self.shared = 0
+        self.fresh = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Returns ``func(*args, **kwargs)``, or the result of a call for the
+        same `key` that is in flight or fresh.
+        """
+        leader = False
+        with self._lock:
+            if self.freshness > 0:
+                result = self._results.get(key)
+                if result is not None and \
+                        time.time() - result[0] <= self.freshness:
+                    self.fresh += 1
+                    return result[1]
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.shared += 1
+            else:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+                leader = True
+        if not leader:
+            flight.done.wait()
+            if flight.exc_info is not None:
+                exc_type, exc_value, tb = flight.exc_info
+                raise exc_type, exc_value, tb
+            return flight.value
+        try:
+            flight.value = func(*args, **kwargs)
+        except:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if self.freshness > 0 and flight.exc_info is None:
+                    self._store(key, flight.value)
+            flight.done.set()
+        return flight.value
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.calls = self.shared = self.fresh = 0
+
+    def _store(self, key, value):
+        now = time.time()
+        self._results[key] = (now, value)
+        if len(self._results) >= self._prune_at:
+            for k, (t, _) in self._results.items():
+                if now - t > self.freshness:
+                    del self._results[k]
+            self._prune_at = max(64, 2 * len(self._results))
+
+
+class LatencyStats(object):
+    """Latencies of the requests of batched operations such as placeBets,
+    per operation.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def add(self, operation, seconds, size=1):
+        """Records a request of `operation` with `size` items that took
+        `seconds`.
+        """
+        with self._lock:
+            stats = self._stats.get(operation)
+            if stats is None:
+                stats = self._stats[operation] = {
+                    "requests": 0, "items": 0, "total_time": 0.0,
+                    "max_time": 0.0, "last_time": 0.0}
+            stats["requests"] += 1
+            stats["items"] += size
+            stats["total_time"] += seconds
+            stats["max_time"] = max(stats["max_time"], seconds)
+            stats["last_time"] = seconds
+
+    def stats(self):
+        """Returns a dict that maps operations to dicts with the number of
+        requests and items and the total, mean, maximum and last request
+        time.
+        """
+        with self._lock:
+            result = {}
+            for operation, stats in self._stats.iteritems():
+                stats = dict(stats)
+                stats["mean_time"] = stats["total_time"] / stats["requests"]
+                result[operation] = stats
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
 
 uncompress_markets = DecompressMarkets()
 uncompress_market_prices = DecompressMarketPrices()
+uncompress_complete_market_depth = DecompressCompleteMarketPrices()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from bfair._types import *
+from bfair._util import tokenise_market_prices, uncompress_market_prices
+
+
+__all__ = (
+    "MarketBook",
+)
+
+
+class _RunnerState(object):
+
+    __slots__ = ("record", "runner")
+
+    def __init__(self, record, runner):
+        self.record = record
+        self.runner = runner
+
+
+class MarketBook(object):
+    """Maintains the prices of a single market from successive compressed
+    market prices, as returned by getMarketPricesCompressed, and reports what
+    changed between updates.
+
+    Runners whose compressed record did not change keep their `RunnerPrice`
+    object, and price levels that did not change keep their `Price` object.
+    The book is fed by polling `Session.get_market_prices_compressed`::
+
+        book = MarketBook(market_id)
+        while True:
+            delta = book.update(session.get_market_prices_compressed(market_id))
+    """
+
+    decoder = uncompress_market_prices
+
+    def __init__(self, market_id=None):
+        self.market_id = market_id
+        self.prices = None
+        self._runners = {}
+
+    def update(self, data):
+        """Applies compressed market prices to the book.
+
+        Parameters
+        ----------
+        data : `str`
+            Compressed market prices of the market of this book.
+
+        Returns
+        -------
+        A MarketPricesDelta with the changes since the previous update.
+        """
+        info, records = tokenise_market_prices(data)
+        prices = self.decoder.decode_info(info)
+        if self.market_id is None:
+            self.market_id = prices.marketId
+        elif prices.marketId != self.market_id:
+            raise ValueError("Prices of market %s cannot update the book of "
+                             "market %s" % (prices.marketId, self.market_id))
+
+        delta = MarketPricesDelta(prices.marketId, None, [], [], [])
+        if self.prices is None or self.prices.marketStatus != prices.marketStatus:
+            delta.marketStatus = prices.marketStatus
+
+        previous = self._runners
+        runners = {}
+        prices.runnerPrices = []
+        for record in records:
+            selection_id = int(record[0][0])
+            state = previous.pop(selection_id, None)
+            if state is None or state.record != record:
+                state = self._update_runner(selection_id, record, state, delta)
+            runners[selection_id] = state
+            prices.runnerPrices.append(state.runner)
+
+        for selection_id, state in previous.iteritems():
+            delta.removedRunners.append(selection_id)
+            self._diff_ladder(selection_id, "back",
+                              state.runner.bestPricesToBack, [], delta)
+            self._diff_ladder(selection_id, "lay",
+                              state.runner.bestPricesToLay, [], delta)
+
+        self._runners = runners
+        self.prices = prices
+        return delta
+
+    def _update_runner(self, selection_id, record, state, delta):
+        decoder = self.decoder
+        fields, back, lay = record
+        runner = decoder.decode_runner(fields, [], [])
+        if state is None:
+            old = None
+            old_back = old_lay = []
+            old_record = (None, [], [])
+        else:
+            old = state.runner
+            old_back = old.bestPricesToBack
+            old_lay = old.bestPricesToLay
+            old_record = state.record
+
+        if old is None or fields != old_record[0]:
+            delta.runners.append(runner)
+
+        if back == old_record[1]:
+            runner.bestPricesToBack = old_back
+        else:
+            runner.bestPricesToBack = self._diff_ladder(
+                selection_id, "back", old_back, decoder.decode_prices(back),
+                delta)
+        if lay == old_record[2]:
+            runner.bestPricesToLay = old_lay
+        else:
+            runner.bestPricesToLay = self._diff_ladder(
+                selection_id, "lay", old_lay, decoder.decode_prices(lay),
+                delta)
+        return _RunnerState(record, runner)
+
+    @staticmethod
+    def _diff_ladder(selection_id, side, old, new, delta):
+        """Records the changes from ladder `old` to ladder `new` in `delta`
+        and returns `new` with unchanged levels replaced by the `Price`
+        objects of `old`.
+        """
+        by_price = {p.price: p for p in old}
+        ladder = []
+        for p in new:
+            o = by_price.pop(p.price, None)
+            if o is None:
+                delta.ladderChanges.append(LadderChange(
+                    selection_id, side, p.price, 0.0, p.amountAvailable))
+            elif o.amountAvailable != p.amountAvailable:
+                delta.ladderChanges.append(LadderChange(
+                    selection_id, side, p.price, o.amountAvailable,
+                    p.amountAvailable))
+            elif o.depth == p.depth:
+                p = o
+            ladder.append(p)
+        for o in by_price.itervalues():
+            delta.ladderChanges.append(LadderChange(
+                selection_id, side, o.price, o.amountAvailable, 0.0))
+        return ladder
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import calendar
+import cPickle as pickle
+import sqlite3
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+
+__all__ = (
+    "MetadataCache", "MetadataStore", "DEFAULT_TTLS",
+)
+
+
+# Seconds for which results are cached, per Session method.
+DEFAULT_TTLS = {
+    "get_event_types": 3600.0,
+    "get_event_info": 300.0,
+    "get_market_info": 600.0,
+    "get_market_info_lite": 30.0,
+    "get_markets": 60.0,
+}
+
+# Methods whose first argument is a market id.
+MARKET_METHODS = ("get_market_info", "get_market_info_lite")
+
+
+def _market_id(key):
+    method, args, kwargs = key
+    if method not in MARKET_METHODS:
+        return None
+    if args:
+        return args[0]
+    return dict(kwargs).get("market_id")
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _last_refresh(value):
+    """Returns the most recent `lastRefresh` of `value` or of the items of
+    `value` in seconds since the epoch, or None.
+    """
+    items = value if isinstance(value, list) else [value]
+    result = None
+    for item in items:
+        t = getattr(item, "lastRefresh", None)
+        if isinstance(t, datetime):
+            t = calendar.timegm(t.utctimetuple()) + t.microsecond / 1e6
+        elif t is not None:
+            t = t / 1000.0
+        if t is not None and (result is None or t > result):
+            result = t
+    return result
+
+
+def _sizeof(value, depth=3):
+    """Returns an estimate of the memory used by `value` and the objects that
+    it refers to, up to `depth` levels deep.
+    """
+    size = sys.getsizeof(value)
+    if depth:
+        if isinstance(value, (list, tuple)):
+            size += sum(_sizeof(v, depth - 1) for v in value)
+        elif hasattr(value, "__dict__"):
+            size += sum(_sizeof(v, depth - 1)
+                        for v in value.__dict__.itervalues())
+    return size
+
+
+class MetadataCache(object):
+    """Cache for the mostly static results of Session methods such as
+    `get_event_types` and `get_market_info`.
+
+    Results expire after the time to live of their method and the least
+    recently used results are evicted when the cache holds more than
+    `max_entries` results or, if given, more than an estimated `max_bytes`.
+    Cached results are shared between callers and should not be modified.
+
+    A cache can be shared by several sessions.
+    """
+
+    def __init__(self, ttls=None, max_entries=1024, max_bytes=None,
+                 store=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        ttls : `dict` or `None`
+            Maps Session method names to the number of seconds for which
+            their results are cached.  Methods that are not listed are not
+            cached.  Default is DEFAULT_TTLS.
+        max_entries : `int`
+            Maximum number of cached results.
+        max_bytes : `int` or `None`
+            Maximum estimated size of the cached results in bytes.
+        store : `MetadataStore` or `None`
+            Persistent store to which results are written through.  Results
+            that are not in memory are looked up in the store, so that a
+            restarted process starts with the results of its predecessor.
+        """
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.store = store
+        self._market_status = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.restored = 0
+
+    def key(self, method, args, kwargs):
+        return (method, _freeze(args),
+                tuple(sorted((k, _freeze(v)) for k, v in kwargs.iteritems())))
+
+    def get(self, key):
+        """Returns the cached result for `key` or None.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                expires, value, size = entry
+                if time.time() <= expires:
+                    # Re-inserting moves the entry to the most recently used
+                    # end.
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return value
+                self.bytes -= size
+                self.expirations += 1
+        if self.store is not None:
+            row = self.store.load(key)
+            if row is not None:
+                value, fetched = row
+                expires = fetched + self.ttls.get(key[0], 0)
+                if time.time() <= expires:
+                    self._insert(key, value, expires)
+                    with self._lock:
+                        self.hits += 1
+                        self.restored += 1
+                    return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def get_stale(self, key):
+        """Returns the stored result for `key`, however old it is, or None.
+        """
+        if self.store is None:
+            return None
+        row = self.store.load(key)
+        if row is None:
+            return None
+        with self._lock:
+            self.restored += 1
+        return row[0]
+
+    def put(self, key, value):
+        ttl = self.ttls.get(key[0])
+        if not ttl or value is None:
+            return
+        if self.store is not None:
+            self.store.save(key, value)
+        self._insert(key, value, time.time() + ttl)
+
+    def begin_refresh(self, key):
+        """Returns True if no refresh of `key` is in progress and marks that
+        one is.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def _insert(self, key, value, expires):
+        size = _sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[key] = (expires, value, size)
+            self.bytes += size
+            while self._entries and (
+                    len(self._entries) > self.max_entries or
+                    self.max_bytes is not None and
+                    self.bytes > self.max_bytes):
+                _, (_, _, size) = self._entries.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    def invalidate(self, method=None, *args, **kwargs):
+        """Removes cached results.
+
+        Without arguments all results are removed, with only `method` the
+        results of that method and otherwise the result of the call
+        ``method(*args, **kwargs)``.
+        """
+        if args or kwargs:
+            keys = [self.key(method, args, kwargs)]
+        else:
+            with self._lock:
+                keys = [k for k in self._entries if method in (None, k[0])]
+            if self.store is not None:
+                self.store.delete_method(method)
+        return self._remove(keys)
+
+    def invalidate_market(self, market_id):
+        """Removes the cached market information of `market_id`.
+        """
+        with self._lock:
+            keys = [k for k in self._entries if _market_id(k) == market_id]
+        if self.store is not None:
+            self.store.delete_market(market_id)
+        return self._remove(keys)
+
+    def market_status(self, market_id, status):
+        """Records the status of a market, as reported by a price poll, and
+        invalidates its market information if the status changed.  The
+        statuses of at most `max_entries` markets are kept.
+        """
+        with self._lock:
+            previous = self._market_status.pop(market_id, None)
+            self._market_status[market_id] = status
+            while len(self._market_status) > self.max_entries:
+                self._market_status.popitem(last=False)
+        if previous is not None and previous != status:
+            self.invalidate_market(market_id)
+
+    def stats(self):
+        """Returns a dict with the number of entries, their estimated size in
+        bytes (if `max_bytes` is set) and the counts of hits, misses,
+        evictions, expirations, invalidations and results read from the
+        store.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "restored": self.restored,
+            }
+
+    def _remove(self, keys):
+        if self.store is not None:
+            self.store.delete(keys)
+        removed = 0
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.bytes -= entry[2]
+                    removed += 1
+            self.invalidations += removed
+        return removed
+
+
+class MetadataStore(object):
+    """sqlite file in which a `MetadataCache` keeps its results across
+    restarts.
+
+    Every result is stored with the time at which it was fetched and with the
+    most recent `lastRefresh` of the objects in it.  A result is not replaced
+    by one with an older `lastRefresh`, e.g. from a refresh that was started
+    before the current result was stored.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock:
+            # The store is a cache, so durability is traded for speed.
+            self._db.execute("PRAGMA synchronous = OFF")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata ("
+                "key TEXT PRIMARY KEY, method TEXT, market_id INTEGER, "
+                "fetched REAL, last_refresh REAL, value BLOB)")
+            self._db.commit()
+
+    def save(self, key, value):
+        """Stores `value` for `key`.  Returns False if a value with a more
+        recent `lastRefresh` is already stored.
+        """
+        last_refresh = _last_refresh(value)
+        data = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            row = self._db.execute(
+                "SELECT last_refresh FROM metadata WHERE key = ?",
+                (repr(key),)).fetchone()
+            if row is not None and None not in (row[0], last_refresh) and \
+                    row[0] > last_refresh:
+                return False
+            self._db.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+                (repr(key), key[0], _market_id(key), time.time(),
+                 last_refresh, data))
+            self._db.commit()
+        return True
+
+    def load(self, key):
+        """Returns ``(value, fetched)`` for `key` or None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, fetched FROM metadata WHERE key = ?",
+                (repr(key),)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(str(row[0])), row[1]
+
+    def delete(self, keys):
+        with self._lock:
+            self._db.executemany("DELETE FROM metadata WHERE key = ?",
+                                 [(repr(key),) for key in keys])
+            self._db.commit()
+
+    def delete_method(self, method=None):
+        """Deletes the results of `method`, or all results if `method` is
+        None.
+        """
+        with self._lock:
+            if method is None:
+                self._db.execute("DELETE FROM metadata")
+            else:
+                self._db.execute("DELETE FROM metadata WHERE method = ?",
+                                 (method,))
+            self._db.commit()
+
+    def delete_market(self, market_id):
+        with self._lock:
+            self._db.execute("DELETE FROM metadata WHERE market_id = ?",
+                             (market_id,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from bisect import bisect_left, insort
+
+
+__all__ = (
+    "MarketCatalog",
+)
+
+
+# Sorted indexes are rebuilt instead of updated in place when a merge changes
+# more entries than this.
+_REBUILD_THRESHOLD = 64
+
+
+def _ancestors(market):
+    return [e for e in market.eventHierarchy or []
+            if e and e != market.marketId]
+
+
+class _SortedIndex(object):
+    """List of ``(value, marketId)`` pairs that is kept sorted, or rebuilt
+    from `markets` on first use after a large change.
+    """
+
+    def __init__(self, attr):
+        self.attr = attr
+        self._items = []
+
+    def add(self, market):
+        if self._items is not None:
+            insort(self._items, (getattr(market, self.attr), market.marketId))
+
+    def remove(self, market):
+        if self._items is not None:
+            item = (getattr(market, self.attr), market.marketId)
+            i = bisect_left(self._items, item)
+            if i < len(self._items) and self._items[i] == item:
+                del self._items[i]
+
+    def invalidate(self):
+        self._items = None
+
+    def items(self, markets):
+        if self._items is None:
+            self._items = sorted((getattr(m, self.attr), m.marketId)
+                                 for m in markets.itervalues())
+        return self._items
+
+
+class MarketCatalog(object):
+    """Markets, as returned by `Session.get_markets`, with indexes on their
+    event hierarchy, country, time, menu path and in-play and BSP flags.
+
+    A catalog is built once and then kept up to date by merging the result of
+    later `get_markets` calls::
+
+        catalog = MarketCatalog(session.get_markets())
+        ...
+        catalog.merge(session.get_markets())
+        uk_football = catalog.find(ancestor=1, country="GBR",
+                                   start=datetime.utcnow())
+    """
+
+    def __init__(self, markets=()):
+        self._markets = {}
+        self._by_ancestor = {}
+        self._by_country = {}
+        self._in_play = set()
+        self._bsp = set()
+        self._by_time = _SortedIndex("marketTime")
+        self._by_menu_path = _SortedIndex("menuPath")
+        self.merge(markets)
+
+    def __len__(self):
+        return len(self._markets)
+
+    def __iter__(self):
+        return self._markets.itervalues()
+
+    def __contains__(self, market_id):
+        return market_id in self._markets
+
+    def get(self, market_id, default=None):
+        return self._markets.get(market_id, default)
+
+    def merge(self, markets, complete=True):
+        """Merges markets into the catalog.
+
+        A market replaces the market with the same id only if its
+        `lastRefresh` is newer, or if either has no `lastRefresh`.  Indexes
+        are only updated for the fields that changed.
+
+        Parameters
+        ----------
+        markets : iterable of `Market`
+            Markets, as returned by `Session.get_markets`.
+        complete : `bool`
+            If True `markets` are all the markets that the catalog should
+            hold and markets that are not among them are removed.  Pass
+            False when merging the result of a filtered request.
+
+        Returns
+        -------
+        A tuple ``(added, updated, removed)`` of lists of market ids.
+        """
+        added, updated, seen = [], [], set()
+        changes = []
+        for market in markets:
+            market_id = market.marketId
+            seen.add(market_id)
+            old = self._markets.get(market_id)
+            if old is None:
+                self._add(market)
+                changes.append((None, market))
+                added.append(market_id)
+            elif old is not market and not (
+                    market.lastRefresh is not None and
+                    old.lastRefresh is not None and
+                    market.lastRefresh <= old.lastRefresh):
+                self._replace(old, market, changes)
+                updated.append(market_id)
+        removed = []
+        if complete:
+            removed = [market_id for market_id in self._markets
+                       if market_id not in seen]
+            for market_id in removed:
+                market = self._markets[market_id]
+                self._remove(market)
+                changes.append((market, None))
+        self._update_sorted(changes)
+        return added, updated, removed
+
+    def find(self, ancestor=None, country=None, start=None, end=None,
+             menu_path=None, turning_in_play=None, bsp=None):
+        """Returns the markets that match all of the given criteria.
+
+        Parameters
+        ----------
+        ancestor : `int` or `None`
+            Id of an event or event type in the event hierarchy of the
+            markets.
+        country : `str` or `None`
+            ISO3 country code of the markets; "" for international markets.
+        start, end : `datetime` or `None`
+            Range ``start <= marketTime < end`` of the markets.
+        menu_path : `str` or `None`
+            Prefix of the menu path of the markets.
+        turning_in_play, bsp : `bool` or `None`
+            Value of `turningInPlay` and `bspMarket` of the markets.
+
+        Returns
+        -------
+        A list of `Market` objects sorted by market id.
+        """
+        candidates = []
+        if ancestor is not None:
+            candidates.append(self._by_ancestor.get(ancestor, ()))
+        if country is not None:
+            candidates.append(self._by_country.get(country, ()))
+        if start is not None or end is not None:
+            candidates.append(self._time_range(start, end))
+        if menu_path is not None:
+            candidates.append(self._menu_path_prefix(menu_path))
+        if turning_in_play:
+            candidates.append(self._in_play)
+        if bsp:
+            candidates.append(self._bsp)
+        if candidates:
+            candidates.sort(key=len)
+            ids = set(candidates[0])
+            for other in candidates[1:]:
+                ids.intersection_update(other)
+        else:
+            ids = set(self._markets)
+        if turning_in_play is False:
+            ids -= self._in_play
+        if bsp is False:
+            ids -= self._bsp
+        return [self._markets[market_id] for market_id in sorted(ids)]
+
+    def _time_range(self, start, end):
+        items = self._by_time.items(self._markets)
+        lo = 0 if start is None else bisect_left(items, (start,))
+        hi = len(items) if end is None else bisect_left(items, (end,))
+        return [market_id for _, market_id in items[lo:hi]]
+
+    def _menu_path_prefix(self, prefix):
+        items = self._by_menu_path.items(self._markets)
+        ids = []
+        for i in xrange(bisect_left(items, (prefix,)), len(items)):
+            menu_path, market_id = items[i]
+            if not (menu_path or "").startswith(prefix):
+                break
+            ids.append(market_id)
+        return ids
+
+    def _add(self, market):
+        market_id = market.marketId
+        self._markets[market_id] = market
+        for event_id in _ancestors(market):
+            self._by_ancestor.setdefault(event_id, set()).add(market_id)
+        self._by_country.setdefault(market.countryISO3, set()).add(market_id)
+        if market.turningInPlay:
+            self._in_play.add(market_id)
+        if market.bspMarket:
+            self._bsp.add(market_id)
+
+    def _remove(self, market):
+        market_id = market.marketId
+        del self._markets[market_id]
+        for event_id in _ancestors(market):
+            self._discard(self._by_ancestor, event_id, market_id)
+        self._discard(self._by_country, market.countryISO3, market_id)
+        self._in_play.discard(market_id)
+        self._bsp.discard(market_id)
+
+    def _replace(self, old, new, changes):
+        if _ancestors(old) != _ancestors(new) or \
+                old.countryISO3 != new.countryISO3 or \
+                old.turningInPlay != new.turningInPlay or \
+                old.bspMarket != new.bspMarket:
+            self._remove(old)
+            self._add(new)
+        else:
+            self._markets[new.marketId] = new
+        if old.marketTime != new.marketTime or old.menuPath != new.menuPath:
+            changes.append((old, new))
+
+    def _update_sorted(self, changes):
+        for index in (self._by_time, self._by_menu_path):
+            if len(changes) > _REBUILD_THRESHOLD:
+                index.invalidate()
+                continue
+            for old, new in changes:
+                if old is not None:
+                    index.remove(old)
+                if new is not None:
+                    index.add(new)
+
+    @staticmethod
+    def _discard(index, key, market_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(market_id)
+            if not ids:
+                del index[key]
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import Queue
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+
+__all__ = (
+    "EventCrawler", "EventNode",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class EventNode(object):
+    """Node of the event hierarchy.
+
+    `event` is the `EventType` or `BFEvent` of the node and `info` the
+    `EventInfo` returned by `Session.get_event_info` for it.  The markets of
+    the node are the `MarketSummary` objects in `info.marketItems`.
+    """
+
+    __slots__ = ("event_id", "event", "info", "parent", "children")
+
+    def __init__(self, event_id, event=None, parent=None):
+        self.event_id = event_id
+        self.event = event
+        self.info = None
+        self.parent = parent
+        self.children = []
+
+    @property
+    def markets(self):
+        return self.info.marketItems if self.info else []
+
+    def __repr__(self):
+        return "<EventNode(%r, %d children, %d markets)>" % (
+            self.event_id, len(self.children), len(self.markets))
+
+
+class EventCrawler(object):
+    """Walks the event hierarchy breadth first with `Session.get_event_info`
+    and keeps it as a tree of `EventNode` objects.
+
+    Up to `max_workers` calls are in flight at the same time, so the session
+    must be created with ``thread_safe=True``.  The calls go through the
+    rate limiter of the session.  An event that appears under several parents
+    is fetched once.
+    """
+
+    def __init__(self, session, max_workers=8, locale=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        session : `Session`
+            Session that is used for the calls.
+        max_workers : `int`
+            Maximum number of calls that are in flight at the same time.
+            ValueError is raised if it is larger than 1 and `session` is not
+            thread safe.
+        locale : `str` or `None`
+            Language of the event and market names.
+        """
+        if max_workers > 1 and not session.thread_safe:
+            raise ValueError("EventCrawler requires a session that is "
+                             "created with thread_safe=True")
+        self.session = session
+        self.max_workers = max_workers
+        self.locale = locale
+        self.roots = []
+        self.nodes = {}
+        self.errors = {}
+        self.calls = 0
+
+    def crawl(self, event_type_ids=None):
+        """Crawls the complete hierarchy below the event types.
+
+        Parameters
+        ----------
+        event_type_ids : sequence of `int` or `None`
+            Ids of the event types to crawl.  None crawls the active event
+            types.
+
+        Returns
+        -------
+        A list with the `EventNode` of each event type.
+        """
+        if event_type_ids is None:
+            event_types = self.session.get_event_types(locale=self.locale)
+            roots = [EventNode(et.id, et) for et in event_types]
+        else:
+            roots = [EventNode(event_id) for event_id in event_type_ids]
+        self.roots = roots
+        self.nodes = dict((node.event_id, node) for node in roots)
+        self.errors = {}
+        self._visit(roots)
+        return self.roots
+
+    def recrawl(self, markets=None):
+        """Brings the tree up to date by revisiting only the events under
+        which markets were added or removed.
+
+        Parameters
+        ----------
+        markets : sequence of `Market` or `None`
+            Current markets, as returned by `Session.get_markets`.  If None
+            the markets are requested from the session.
+
+        Returns
+        -------
+        A list of the nodes that were visited.
+        """
+        if markets is None:
+            markets = self.session.get_markets(
+                event_ids=[node.event_id for node in self.roots])
+        known = dict((ms.marketId, node) for node in self.nodes.itervalues()
+                     for ms in node.markets)
+        root_ids = set(node.event_id for node in self.roots)
+        dirty = set()
+        for market in markets:
+            if market.marketId in known:
+                continue
+            path = [e for e in market.eventHierarchy or []
+                    if e and e != market.marketId]
+            if not path or path[0] not in root_ids:
+                continue
+            # The deepest event that is already known lists the new market
+            # or the event that leads to it.
+            for event_id in reversed(path):
+                if event_id in self.nodes:
+                    dirty.add(event_id)
+                    break
+        current = set(market.marketId for market in markets)
+        for market_id, node in known.iteritems():
+            if market_id not in current:
+                dirty.add(node.event_id)
+        nodes = [self.nodes[event_id] for event_id in dirty]
+        cache = getattr(self.session, "metadata_cache", None)
+        if cache is not None:
+            for node in nodes:
+                cache.invalidate("get_event_info", *self._args(node.event_id))
+        return self._visit(nodes)
+
+    def iter_markets(self):
+        """Yields ``(node, market_summary)`` for every market in the tree.
+        """
+        for node in self.nodes.itervalues():
+            for market in node.markets:
+                yield node, market
+
+    def _args(self, event_id):
+        return (event_id, self.locale) if self.locale else (event_id,)
+
+    def _visit(self, nodes):
+        """Fetches the info of `nodes` and of all new nodes below them in
+        breadth first order.  Returns the visited nodes.
+        """
+        visited = []
+        if not nodes:
+            return visited
+        results = Queue.Queue()
+
+        def fetch(node):
+            try:
+                info = self.session.get_event_info(*self._args(node.event_id))
+                results.put((node, info, None))
+            except Exception as e:
+                results.put((node, None, e))
+
+        queue = deque(nodes)
+        in_flight = 0
+        pool = ThreadPool(self.max_workers)
+        try:
+            while queue or in_flight:
+                while queue and in_flight < self.max_workers:
+                    pool.apply_async(fetch, (queue.popleft(),))
+                    in_flight += 1
+                node, info, error = results.get()
+                in_flight -= 1
+                self.calls += 1
+                visited.append(node)
+                if error is not None:
+                    logger.error("{getEvents} failed for event {%s}: %s",
+                                 node.event_id, error)
+                    self.errors[node.event_id] = error
+                    continue
+                self.errors.pop(node.event_id, None)
+                queue.extend(self._update(node, info))
+        finally:
+            pool.close()
+        return visited
+
+    def _update(self, node, info):
+        """Replaces the info of `node` and returns its new child nodes.
+        """
+        node.info = info
+        if node.parent is not None and not info.eventItems and \
+                not info.marketItems:
+            # The event is gone or empty.
+            self._remove(node)
+            return []
+        children = dict((child.event_id, child) for child in node.children)
+        node.children = []
+        new = []
+        for event in info.eventItems:
+            child = children.pop(event.eventId, None)
+            if child is None:
+                child = self.nodes.get(event.eventId)
+                if child is None:
+                    child = EventNode(event.eventId, event, node)
+                    self.nodes[event.eventId] = child
+                    new.append(child)
+            child.event = event
+            node.children.append(child)
+        for child in children.itervalues():
+            if child.parent is node:
+                self._remove(child)
+        return new
+
+    def _remove(self, node):
+        if node.parent is not None and node in node.parent.children:
+            node.parent.children.remove(node)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if self.nodes.get(node.event_id) is node:
+                del self.nodes[node.event_id]
+            stack.extend(child for child in node.children
+                         if child.parent is node)
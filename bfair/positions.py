@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+#
+#  Copyright 2011 Tjerk Santegoeds
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import threading
+
+
+__all__ = (
+    "PositionTracker", "Position", "TrackedBet",
+)
+
+
+class Position(object):
+    """Stakes and liabilities of the bets on a selection or a market.
+
+    `if_win` and `if_lose` are the matched profit and loss if the selection
+    wins or loses; they are only meaningful for the position of a selection.
+    """
+
+    __slots__ = ("matched_back", "matched_lay", "unmatched_back",
+                 "unmatched_lay", "matched_liability", "unmatched_liability",
+                 "if_win", "if_lose")
+
+    def __init__(self):
+        for attr in self.__slots__:
+            setattr(self, attr, 0.0)
+
+    def _add(self, values, sign):
+        for attr, value in zip(self.__slots__, values):
+            setattr(self, attr, getattr(self, attr) + sign * value)
+
+    @property
+    def liability(self):
+        return self.matched_liability + self.unmatched_liability
+
+    def __repr__(self):
+        return "<Position(%s)>" % ", ".join(
+            "%s=%r" % (attr, getattr(self, attr)) for attr in self.__slots__)
+
+
+class TrackedBet(object):
+    """State of a bet in a `PositionTracker`.
+
+    `matched_win` is the sum of ``size * (price - 1)`` over the matched
+    portions of the bet.  `stamp` is the `PositionTracker.checkpoint` at
+    which the bet was last changed.
+    """
+
+    __slots__ = ("bet_id", "market_id", "selection_id", "bet_type", "price",
+                 "matched", "matched_win", "unmatched", "stamp")
+
+    def __init__(self, bet_id, market_id, selection_id, bet_type, price):
+        self.bet_id = bet_id
+        self.market_id = market_id
+        self.selection_id = selection_id
+        self.bet_type = bet_type
+        self.price = price
+        self.matched = 0.0
+        self.matched_win = 0.0
+        self.unmatched = 0.0
+        self.stamp = 0
+
+    def values(self):
+        """Returns the contribution of the bet to a `Position`, in the order
+        of `Position.__slots__`.
+        """
+        if self.bet_type == "L":
+            return (0.0, self.matched, 0.0, self.unmatched, self.matched_win,
+                    self.unmatched * (self.price - 1.0), -self.matched_win,
+                    self.matched)
+        return (self.matched, 0.0, self.unmatched, 0.0, self.matched,
+                self.unmatched, self.matched_win, -self.matched)
+
+    def __repr__(self):
+        return "<TrackedBet(%s)>" % ", ".join(
+            "%s=%r" % (attr, getattr(self, attr)) for attr in self.__slots__)
+
+
+class PositionTracker(object):
+    """Matched and unmatched stakes and liabilities per market and selection,
+    kept up to date without full fetches.
+
+    The tracker is filled once with `refresh` and then updated from the
+    results of `Session.place_bets`, `cancel_bets` and `update_bets` and by
+    `update`, which polls the cheap lite calls::
+
+        tracker = PositionTracker(session)
+        tracker.refresh()
+        tracker.placed(bets, session.place_bets(bets))
+        ...
+        tracker.update()
+        exposure = tracker.position(market_id).liability
+
+    A change of a bet only touches the positions of its selection and
+    market.  Bets that are settled drop out of `getMUBets` and of the
+    tracker on the next `refresh`.
+    """
+
+    def __init__(self, session=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        session : `Session` or `None`
+            Session that is used by `refresh` and `update`.
+        """
+        self.session = session
+        self._lock = threading.RLock()
+        self._bets = {}
+        self._by_market = {}
+        self._selections = {}
+        self._markets = {}
+        self._stamp = 0
+
+    def __len__(self):
+        return len(self._bets)
+
+    def __contains__(self, bet_id):
+        return bet_id in self._bets
+
+    def bet(self, bet_id):
+        """Returns the `TrackedBet` of `bet_id` or None.
+        """
+        return self._bets.get(bet_id)
+
+    def bets(self, market_id=None):
+        """Returns the tracked bets, of one market or of all markets.
+        """
+        with self._lock:
+            if market_id is None:
+                return self._bets.values()
+            return [self._bets[bet_id]
+                    for bet_id in self._by_market.get(market_id, ())]
+
+    def position(self, market_id, selection_id=None):
+        """Returns the `Position` of a market or of a selection of a market.
+        The position is updated in place as bets change, also if there are
+        no bets on it yet.
+        """
+        with self._lock:
+            if selection_id is None:
+                return self._markets.setdefault(market_id, Position())
+            return self._selections.setdefault((market_id, selection_id),
+                                               Position())
+
+    def checkpoint(self):
+        """Returns a stamp that is passed as `since` to `apply_current_bets`
+        to protect the bets that change after it.
+        """
+        with self._lock:
+            return self._stamp
+
+    def refresh(self, market_id=None):
+        """Replaces the bets, of one market or of all markets, by those
+        returned by `Session.get_matched_and_unmatched_bets`.
+        """
+        mu_bets = self.session.get_matched_and_unmatched_bets(
+            market_id=market_id or 0)
+        self.load(mu_bets, market_id)
+
+    def load(self, mu_bets, market_id=None):
+        """Replaces the bets, of one market or of all markets, by `mu_bets`.
+
+        Parameters
+        ----------
+        mu_bets : iterable of `MUBet`
+            Bets as returned by `Session.get_matched_and_unmatched_bets`.
+        market_id : `int` or `None`
+            Market of the bets.  None replaces all bets.
+        """
+        with self._lock:
+            if market_id is None:
+                bet_ids = list(self._bets)
+            else:
+                bet_ids = list(self._by_market.get(market_id, ()))
+            for bet_id in bet_ids:
+                self._remove(self._bets[bet_id])
+            self._merge(mu_bets)
+
+    def update(self, market_id=None):
+        """Brings the tracker up to date with `Session.get_current_bets_lite`
+        and fetches details only for the bets that changed.
+
+        Returns
+        -------
+        A list with the ids of the bets that changed.
+        """
+        session = self.session
+        since = self.checkpoint()
+        lites = session.get_current_bets_lite(market_id=market_id or 0)
+        changed, unknown = self.apply_current_bets(lites, market_id, since)
+        for bet_id in changed:
+            self.apply_matches(bet_id, session.get_bet_matches_lite(bet_id))
+        if unknown:
+            # Bets that were placed elsewhere.
+            with self._lock:
+                self._merge(session.get_matched_and_unmatched_bets(
+                    bet_ids=unknown))
+        return changed + unknown
+
+    def apply_current_bets(self, bet_lites, market_id=None, since=None):
+        """Applies the remaining sizes of unmatched bets, as returned by
+        ``Session.get_current_bets_lite(bet_status="U")``, for one market or
+        for all markets.
+
+        Bets that were added or changed after `since`, the `checkpoint`
+        taken before the request was sent, e.g. by a concurrent `placed`,
+        are newer than `bet_lites` and left as they are.
+
+        Returns
+        -------
+        A tuple ``(changed, unknown)``.  `changed` are the ids of tracked
+        bets whose matched size changed or that are no longer unmatched;
+        their matches should be applied with `apply_matches`.  `unknown` are
+        the ids of bets that are not tracked.
+        """
+        changed, unknown, seen = [], [], set()
+        with self._lock:
+            for lite in bet_lites:
+                seen.add(lite.betId)
+                bet = self._bets.get(lite.betId)
+                if bet is None:
+                    unknown.append(lite.betId)
+                    continue
+                if since is not None and bet.stamp > since:
+                    continue
+                if lite.matchedSize > bet.matched:
+                    changed.append(bet.bet_id)
+                if lite.remainingSize != bet.unmatched:
+                    self._set(bet, unmatched=lite.remainingSize)
+            for bet in self.bets(market_id):
+                if since is not None and bet.stamp > since:
+                    continue
+                if bet.unmatched and bet.bet_id not in seen:
+                    changed.append(bet.bet_id)
+                    self._set(bet, unmatched=0.0)
+        return changed, unknown
+
+    def apply_matches(self, bet_id, matches):
+        """Replaces the matched portions of a bet by `matches`, as returned
+        by `Session.get_bet_matches_lite`.
+        """
+        with self._lock:
+            bet = self._bets.get(bet_id)
+            if bet is not None:
+                self._set(bet,
+                          matched=sum(m.sizeMatched for m in matches),
+                          matched_win=sum(m.sizeMatched * (m.priceMatched - 1)
+                                          for m in matches))
+
+    def placed(self, bets, results):
+        """Adds bets from their `PlaceBet` and the `PlaceBetResult` returned
+        by `Session.place_bets`.
+        """
+        with self._lock:
+            for bet, result in zip(bets, results):
+                if result is None or not result.success:
+                    continue
+                tracked = TrackedBet(result.betId, bet.marketId,
+                                     bet.selectionId, bet.betType, bet.price)
+                matched = result.sizeMatched or 0.0
+                self._add(tracked)
+                self._set(tracked, matched=matched,
+                          matched_win=matched * (
+                              (result.averagePriceMatched or bet.price) - 1),
+                          unmatched=max(0.0, bet.size - matched))
+
+    def cancelled(self, results):
+        """Applies the `CancelBetResult` objects returned by
+        `Session.cancel_bets`.
+        """
+        with self._lock:
+            for result in results:
+                bet = self._bets.get(getattr(result, "betId", None))
+                if bet is None or not result.success:
+                    continue
+                changes = {"unmatched": 0.0}
+                matched = result.sizeMatched or 0.0
+                if matched > bet.matched:
+                    # Matched before the cancellation; at the bet price or
+                    # better.
+                    changes["matched"] = matched
+                    changes["matched_win"] = bet.matched_win + \
+                        (matched - bet.matched) * (bet.price - 1)
+                self._set(bet, **changes)
+
+    def updated(self, results):
+        """Applies the `UpdateBetResult` objects returned by
+        `Session.update_bets`.  A change of price or an increase of size
+        creates a new bet with the id `newBetId`.
+        """
+        with self._lock:
+            for result in results:
+                bet = self._bets.get(getattr(result, "betId", None))
+                if bet is None or not result.success:
+                    continue
+                cancelled = result.sizeCancelled or 0.0
+                if cancelled:
+                    self._set(bet, unmatched=max(0.0,
+                                                 bet.unmatched - cancelled))
+                if result.newBetId and result.newBetId != bet.bet_id:
+                    new = TrackedBet(result.newBetId, bet.market_id,
+                                     bet.selection_id, bet.bet_type,
+                                     result.newPrice or bet.price)
+                    self._add(new)
+                    self._set(new, unmatched=result.newSize or 0.0)
+
+    def _merge(self, mu_bets):
+        """Replaces the bets of `mu_bets`.
+        """
+        states = {}
+        for mu in mu_bets:
+            state = states.get(mu.betId)
+            if state is None:
+                state = TrackedBet(mu.betId, mu.marketId, mu.selectionId,
+                                   mu.betType, mu.price)
+                states[mu.betId] = state
+            if mu.betStatus == "M":
+                state.matched += mu.size
+                state.matched_win += mu.size * (mu.price - 1)
+            else:
+                state.unmatched += mu.size
+                state.price = mu.price
+        for state in states.itervalues():
+            old = self._bets.get(state.bet_id)
+            if old is not None:
+                self._remove(old)
+            self._add(state)
+
+    def _add(self, bet):
+        self._stamp += 1
+        bet.stamp = self._stamp
+        self._bets[bet.bet_id] = bet
+        self._by_market.setdefault(bet.market_id, set()).add(bet.bet_id)
+        self._apply(bet, 1)
+
+    def _remove(self, bet):
+        self._apply(bet, -1)
+        del self._bets[bet.bet_id]
+        bet_ids = self._by_market[bet.market_id]
+        bet_ids.discard(bet.bet_id)
+        if not bet_ids:
+            del self._by_market[bet.market_id]
+
+    def _set(self, bet, **changes):
+        self._stamp += 1
+        bet.stamp = self._stamp
+        self._apply(bet, -1)
+        for attr, value in changes.iteritems():
+            setattr(bet, attr, value)
+        self._apply(bet, 1)
+
+    def _apply(self, bet, sign):
+        values = bet.values()
+        key = (bet.market_id, bet.selection_id)
+        for index, k in ((self._selections, key),
+                         (self._markets, bet.market_id)):
+            position = index.get(k)
+            if position is None:
+                position = index[k] = Position()
+            position._add(values, sign)
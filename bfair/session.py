@@ -14,23 +14,36 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import contextlib
+import functools
+import heapq
+import json
 import logging
+import os
 import threading
+import time
 
-from datetime import datetime
-from itertools import izip
+from datetime import timedelta
+from itertools import count, izip
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 from bfair._types import *
 from bfair._soap import *
+from bfair import _raw
+from bfair._throttle import RateLimiter, RATE_LIMITS, DEFAULT_RATE_LIMITS
 from bfair._util import (
+    uncompress_complete_market_depth,
     uncompress_market_prices,
     uncompress_markets,
     not_implemented, untested,
+    LatencyStats, PayloadCache, SingleFlight,
 )
 
 
 __all__ = (
-    "ServiceError", "Session", "FREE_API"
+    "ServiceError", "Session", "AsyncSession", "SessionPool", "FREE_API",
+    "NOT_MODIFIED",
 )
 
 logger = logging.getLogger(__name__)
@@ -42,42 +55,228 @@ class ServiceError(Exception):
 
 FREE_API = 82
 
+# Returned by Session.get_market_prices(only_modified=True) if the prices did
+# not change since the previous call.
+NOT_MODIFIED = type("NotModified", (object,), {
+    "__repr__": lambda self: "NOT_MODIFIED",
+    "__nonzero__": lambda self: False,
+})()
 
-class HeartBeat(threading.Thread):
+
+# Maximum number of bets per placeBets, cancelBets and updateBets request.
+MAX_PLACE_BETS = 60
+MAX_CANCEL_BETS = 40
+MAX_UPDATE_BETS = 15
+
+# Maximum number of records per getMUBets and getCurrentBetsLite request.
+MAX_RECORDS = 200
+
+# Betfair ends sessions that are idle for 20 minutes, so older saved tokens are
+# not tried.
+SESSION_TIMEOUT = 20 * 60.0
+
+# Minimum number of seconds between writes of a rotated token to the token
+# file.
+_TOKEN_SAVE_INTERVAL = 60.0
+
+
+def _is_no_session(rsp):
+    header = getattr(rsp, "header", None)
+    return getattr(header, "errorCode", None) == APIErrorEnum.NO_SESSION
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+def _operation_name(soapfunc):
+    try:
+        return soapfunc.method.name
+    except AttributeError:
+        return soapfunc.__name__
+
+
+def _coalesced(func):
+    """Lets concurrent calls of a read-only method with the same arguments
+    share one request if the session coalesces reads.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.single_flight is None:
+            return func(self, *args, **kwargs)
+        key = (func.__name__, args, tuple(sorted(kwargs.iteritems())))
+        try:
+            hash(key)
+        except TypeError:
+            return func(self, *args, **kwargs)
+        return self.single_flight.do(key, func, self, *args, **kwargs)
+    return wrapper
+
+
+def _refresh_in_background(cache, key, call):
+    if not cache.begin_refresh(key):
+        return
+
+    def refresh():
+        try:
+            cache.put(key, call())
+        except Exception:
+            logger.warning("Refreshing {%s} failed", key[0], exc_info=True)
+        finally:
+            cache.end_refresh(key)
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+
+def _cached(func):
+    """Returns results of the method from the metadata cache of the session,
+    if it has one.  Expired results from the persistent store of the cache
+    are returned as well and refreshed in the background.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        cache = self.metadata_cache
+        if cache is None or func.__name__ not in cache.ttls:
+            return func(self, *args, **kwargs)
+        key = cache.key(func.__name__, args, kwargs)
+        try:
+            value = cache.get(key)
+        except TypeError:
+            return func(self, *args, **kwargs)
+        if value is not None:
+            return value
+        value = cache.get_stale(key)
+        if value is not None:
+            _refresh_in_background(
+                cache, key, lambda: func(self, *args, **kwargs))
+            return value
+        value = func(self, *args, **kwargs)
+        cache.put(key, value)
+        return value
+    return wrapper
+
+
+def _freeze(args):
+    """Returns a hashable version of an optional sequence argument.
+    """
+    return tuple(args) if args else None
+
+
+class HeartBeat(object):
+    """Keep-alive registration of a session with a `HeartBeatScheduler`.
+
+    `keepalive_func` is called when the session has been idle for `interval`
+    minutes.
+    """
 
     def __init__(self, keepalive_func, interval=19):
-        super(HeartBeat, self).__init__()
-        self.daemon = True
-        self.event = threading.Event()
         self.interval = interval
         self.keepalive_func = keepalive_func
-        self.tstamp = None
-
-    def run(self):
-        self.tstamp = datetime.now()
-        while True:
-            time_out = float(self.interval - self.elapsed_mins())
-            self.event.wait(time_out)
-            if self.event.is_set(): break
-            if self.elapsed_mins() > self.interval:
-                self.keepalive_func()
-                self.reset()
+        self.stopped = False
+        self.tstamp = time.time()
 
     def elapsed_mins(self):
-        return (datetime.now() - self.tstamp).seconds / 60
+        return (time.time() - self.tstamp) / 60.0
+
+    def due(self):
+        """Returns the time at which the keep-alive is due.
+        """
+        return self.tstamp + self.interval * 60.0
 
     def reset(self):
-        self.tstamp = datetime.now()
+        # A single attribute store, so that any thread can reset the heartbeat
+        # without locking.
+        self.tstamp = time.time()
 
     def stop(self):
-        self.event.set()
+        self.stopped = True
+
+
+class HeartBeatScheduler(object):
+    """Sends the keep-alives of any number of sessions from a single thread.
+
+    Heartbeats are kept in a heap ordered by the time at which they are
+    due.  Resetting a heartbeat does not touch the heap; when an entry comes
+    up for a heartbeat that was reset in the meantime, it is pushed back to
+    its new due time instead.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self, keepalive_func, interval=19):
+        """Returns a started `HeartBeat` for `keepalive_func`.
+        """
+        heartbeat = HeartBeat(keepalive_func, interval)
+        with self._cond:
+            self._push(heartbeat)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="HeartBeatScheduler")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return heartbeat
+
+    def __len__(self):
+        with self._cond:
+            return sum(1 for _, _, hb in self._heap if not hb.stopped)
+
+    def _push(self, heartbeat):
+        heapq.heappush(self._heap, (heartbeat.due(), next(self._seq),
+                                    heartbeat))
+
+    def _next(self):
+        """Blocks until a heartbeat is due and returns it.
+        """
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due, _, heartbeat = self._heap[0]
+                if heartbeat.stopped:
+                    heapq.heappop(self._heap)
+                    continue
+                now = time.time()
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                if heartbeat.due() > now:
+                    self._push(heartbeat)
+                    continue
+                return heartbeat
+
+    def _run(self):
+        while True:
+            heartbeat = self._next()
+            try:
+                heartbeat.keepalive_func()
+            except Exception:
+                logger.exception("{keepAlive} failed")
+            heartbeat.reset()
+            with self._cond:
+                if not heartbeat.stopped:
+                    self._push(heartbeat)
+
+
+# Drives the keep-alives of all sessions.
+heartbeat_scheduler = HeartBeatScheduler()
 
 
 class Session(object):
     """
     """
 
-    def __init__(self, username, password, product_id=FREE_API, vendor_id=0):
+    def __init__(self, username, password, product_id=FREE_API, vendor_id=0,
+                 reuse_unchanged=False, raw_xml=False, thread_safe=False,
+                 rate_limits=None, coalesce=False, freshness=0.0,
+                 metadata_cache=None, token_file=None, standby=False):
         """Constructor.
 
         Parameters
@@ -95,15 +294,85 @@ class Session(object):
         vendor_id : `int`
             Vendor id that is used to establish a session.  Default is 0 for
             personal usages.
+        reuse_unchanged : `bool`
+            If True `get_market_prices` and `get_markets` return the
+            previously decoded result when the compressed payload is
+            identical to that of the previous call with the same arguments.
+            The results are then shared between calls and should not be
+            modified.  Hits and misses are counted in `payload_cache`, which
+            remembers the payloads of the 1024 most recently used requests.
+        raw_xml : `bool`
+            If True `get_market_prices`, `get_market_depth` and
+            `get_markets` build their requests from XML templates and
+            extract the compressed result from the response XML directly
+            instead of going through suds.
+        thread_safe : `bool`
+            If True every call gets its own copy of the request header so that
+            threads can share the session.  Methods that send requests from
+            worker threads, such as `place_bets`, do so while they run
+            regardless of this flag.  The session token is always
+            rotated atomically; a response only replaces the token if its
+            call was issued after the call that set the current token.
+        rate_limits : `dict` or `None`
+            Budgets as ``{operation: (calls, seconds)}`` within which calls
+            are kept by queueing them; ``"*"`` applies to all operations.
+            Bet placement and cancellation are served before data requests.
+            Default is None, which uses the budgets of `product_id` from
+            RATE_LIMITS.  An empty dict disables rate limiting.  Metrics are
+            available from `rate_limiter.stats()`.
+        coalesce : `bool`
+            If True concurrent calls of a read-only method with the same
+            arguments share one request and its result, which should then not
+            be modified.  Counts are kept in `single_flight`.
+        freshness : `float`
+            Number of seconds for which the result of a coalesced call is
+            also returned to later calls with the same arguments.  Implies
+            `coalesce`.  Default is 0.
+        metadata_cache : `MetadataCache` or `None`
+            Cache for the results of `get_event_types`, `get_event_info`,
+            `get_market_info`, `get_market_info_lite` and `get_markets`.
+            With a `MetadataStore` the cache survives restarts.  The market
+            information of a market is invalidated when `get_market_prices`
+            reports a change of its status.
+        token_file : `str` or `None`
+            File to which the session token is saved, so that `login` of a
+            restarted process resumes the session instead of logging in
+            again.  The file holds the token but not the password.
+        standby : `bool`
+            If True a second session is logged in in the background and its
+            token is taken over as soon as a call fails with NO_SESSION.  The
+            call is then retried instead of waiting for a new login.
         """
         super(Session, self).__init__()
         self._request_header = BFGlobalFactory.create("ns1:APIRequestHeader")
         self._request_header.clientStamp = 0
+        self._requests = RequestPool()
+        self._token_lock = threading.Lock()
+        self._token_seq = 0
+        self._call_seq = count(1)
         self._heartbeat = None
+        self._standby = None
+        self._token_saved = 0.0
+        self._save_lock = threading.Lock()
+        self._fan_outs = 0
+        self._fan_out_lock = threading.Lock()
         self.username = username
         self.password = password
         self.product_id = product_id
         self.vendor_id = vendor_id
+        self.payload_cache = PayloadCache() if reuse_unchanged else None
+        self.raw_xml = raw_xml
+        self.thread_safe = thread_safe
+        if rate_limits is None:
+            rate_limits = RATE_LIMITS.get(product_id, DEFAULT_RATE_LIMITS)
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.single_flight = None
+        if coalesce or freshness > 0:
+            self.single_flight = SingleFlight(freshness)
+        self.metadata_cache = metadata_cache
+        self.token_file = token_file
+        self.standby = standby
+        self.bet_latency = LatencyStats()
 
     def __enter__(self):
         self.login()
@@ -115,37 +384,66 @@ class Session(object):
 
     def login(self):
         """Establishes a secure session with the Betfair server.
+
+        With a `token_file` the saved session is resumed if it is still
+        valid.
         """
-        req = BFGlobalFactory.create("ns1:LoginReq")
+        if self.token_file and self._resume():
+            self._start()
+            return
+        req = self._requests.create(BFGlobalFactory, "ns1:LoginReq")
         req.username = self.username
         req.password = self.password
         req.productId = self.product_id
         req.vendorSoftwareId = self.vendor_id
         req.ipAddress = 0
         req.locationId = 0
-        self._heartbeat = HeartBeat(self.keep_alive)
         rsp = self._soapcall(BFGlobalService.login, req)
-        try:
-            if rsp.errorCode != APIErrorEnum.OK:
-                error_code = rsp.errorCode
-                if error_code == LoginErrorEnum.API_ERROR:
-                    error_code = rsp.header.errorCode
-                logger.error("{login} failed with error {%s}", error_code)
-                raise ServiceError(error_code)
-        except:
-            self._heartbeat = None
-            raise
-        self._heartbeat.start()
+        if rsp.errorCode != APIErrorEnum.OK:
+            error_code = rsp.errorCode
+            if error_code == LoginErrorEnum.API_ERROR:
+                error_code = rsp.header.errorCode
+            logger.error("{login} failed with error {%s}", error_code)
+            raise ServiceError(error_code)
+        self._start()
 
     def logout(self):
         """Terminates the session by logging out of the account.
         """
         if self._heartbeat:
             self._heartbeat.stop()
-            self._heartbeat.join()
         self._heartbeat = None
+        standby, self._standby = self._standby, None
+        if standby is not None and standby.is_active:
+            standby.logout()
         BFGlobalService.logout(self._request_header)
-        self._request_header.sessionToken = None
+        self._set_token(None)
+        if self.token_file and os.path.exists(self.token_file):
+            os.remove(self.token_file)
+
+    def save_token(self):
+        """Writes the session token to `token_file`.
+        """
+        header = self._request_header
+        state = {
+            "username": self.username,
+            "productId": self.product_id,
+            "sessionToken": header.sessionToken,
+            "clientStamp": header.clientStamp,
+            "saved": time.time(),
+        }
+        with self._save_lock:
+            # Written to a temporary file first so that a crash does not
+            # leave a truncated file behind.
+            tmp = self.token_file + ".tmp"
+            # The token gives access to the account, so only the user may
+            # read it.
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            os.fchmod(fd, 0600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.rename(tmp, self.token_file)
+            self._token_saved = state["saved"]
 
     @property
     def is_active(self):
@@ -155,12 +453,93 @@ class Session(object):
         """Sends a 'keepalive' message to prevent that the established session
         is timed out.
         """
-        req = BFGlobalFactory.create("ns1:KeepAliveReq")
+        req = self._requests.create(BFGlobalFactory, "ns1:KeepAliveReq")
         rsp = self._soapcall(BFGlobalService.keepAlive, req)
         if rsp.header.errorCode != APIErrorEnum.OK:
             logger.error("{keepAlive} failed with error {%s}",
                          rsp.header.errorCode)
-
+            return False
+        if self.token_file:
+            self.save_token()
+        return True
+
+    def _resume(self):
+        """Restores the token of `token_file` and returns True if the session
+        is still valid.
+        """
+        try:
+            with open(self.token_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if state.get("username") != self.username or \
+                state.get("productId") != self.product_id or \
+                not state.get("sessionToken") or \
+                time.time() - state.get("saved", 0) > SESSION_TIMEOUT:
+            return False
+        self._request_header.clientStamp = state.get("clientStamp") or 0
+        self._set_token(state["sessionToken"])
+        if self.keep_alive():
+            return True
+        self._set_token(None)
+        return False
+
+    def _start(self):
+        """Starts the heartbeat and standby session after a login.
+        """
+        if self._heartbeat:
+            self._heartbeat.stop()
+        self._heartbeat = heartbeat_scheduler.start(self.keep_alive)
+        if self.token_file:
+            self.save_token()
+        if self.standby and self._standby is None:
+            self._start_standby()
+
+    def _start_standby(self):
+        standby = Session(self.username, self.password, self.product_id,
+                          self.vendor_id)
+        # The logins of the standby count against the budgets of the session.
+        standby.rate_limiter = self.rate_limiter
+        self._standby = standby
+
+        def login():
+            try:
+                standby.login()
+            except Exception:
+                logger.exception("{login} of standby session failed")
+                return
+            if self._standby is not standby:
+                # The session logged out during the login.
+                standby.logout()
+        thread = threading.Thread(target=login, name="StandbyLogin")
+        thread.daemon = True
+        thread.start()
+
+    def _take_standby(self, token):
+        """Replaces the expired `token` by that of the standby session.
+        Returns True if the call that failed with `token` should be retried.
+        """
+        with self._token_lock:
+            if self._request_header.sessionToken != token:
+                # Another call already replaced the token.
+                return self._request_header.sessionToken is not None
+            standby = self._standby
+            if standby is None or not standby.is_active:
+                return False
+            # The session now keeps the standby token alive.
+            standby._heartbeat.stop()
+            self._token_seq = next(self._call_seq)
+            self._request_header.sessionToken = \
+                standby._request_header.sessionToken
+            self._standby = None
+        logger.warning("session expired; switched to the standby session")
+        if self.token_file:
+            self.save_token()
+        self._start_standby()
+        return True
+
+    @_cached
+    @_coalesced
     def get_event_types(self, active=True, locale=None):
         """Returns a list that is the root all categories of sporting events.
 
@@ -177,7 +556,7 @@ class Session(object):
         -------
         A list of `EventType` objects.
         """
-        req = BFGlobalFactory.create("ns1:GetEventTypesReq")
+        req = self._requests.create(BFGlobalFactory, "ns1:GetEventTypesReq")
         if locale:
             req.locale = locale
         if active:
@@ -200,6 +579,8 @@ class Session(object):
             rsp = []
         return rsp
 
+    @_cached
+    @_coalesced
     def get_event_info(self, event_id, locale=None):
         """Allows navigating of the event hierarchy.
 
@@ -219,7 +600,7 @@ class Session(object):
         An EventInfo object or None if there are no results for the
         requested event_id.
         """
-        req = BFGlobalFactory.create("ns1:GetEventsReq")
+        req = self._requests.create(BFGlobalFactory, "ns1:GetEventsReq")
         req.eventParentId = event_id
         if locale:
             req.locale = locale
@@ -249,10 +630,12 @@ class Session(object):
         if self.product_id == FREE_API:
             raise ServiceError("Free API does not support get_currencies")
         if v2:
-            req = BFGlobalFactory.create("ns1:GetCurrenciesV2Req")
+            req = self._requests.create(BFGlobalFactory,
+                                        "ns1:GetCurrenciesV2Req")
             srv = BFGlobalService.getAllCurrenciesV2
         else:
-            req = BFGlobalFactory.create("ns1:GetCurrenciesReq")
+            req = self._requests.create(BFGlobalFactory,
+                                        "ns1:GetCurrenciesReq")
             srv = BFGlobalService.getAllCurrencies
         rsp = self._soapcall(srv, req)
         if rsp.header.errorCode != APIErrorEnum.OK:
@@ -265,7 +648,7 @@ class Session(object):
     def convert_currency(self, amount, from_currency, to_currency):
         if self.product_id == FREE_API:
             raise ServiceError("Free API does not support convert_currency")
-        req = BFGlobalFactory.create("ns1:ConvertCurrencyReq")
+        req = self._requests.create(BFGlobalFactory, "ns1:ConvertCurrencyReq")
         req.amount = amount
         req.fromCurrency = from_currency
         req.toCurrency = to_currency
@@ -298,7 +681,7 @@ class Session(object):
             if locale:
                 raise ServiceError("Locale is not supported when lite=True")
             return self._get_bet_info_lite(bet_id)
-        req = BFGlobalFactory.create("ns1:GetBetReq")
+        req = self._requests.create(BFGlobalFactory, "ns1:GetBetReq")
         req.betId = bet_id
         if locale:
             req.locale = locale
@@ -317,6 +700,8 @@ class Session(object):
         rsp = BetInfo(**{k: v for k, v in rsp.bet})
         return rsp
 
+    @_cached
+    @_coalesced
     def get_market_info(self, market_id, lite=True, coupon_links=False,
                         locale=None):
         """Returns static market information for a single market.
@@ -335,7 +720,7 @@ class Session(object):
         -------
         An instance of MarketInfo.
         """
-        req = BFExchangeFactory.create("ns1:GetMarketReq")
+        req = self._requests.create(BFExchangeFactory, "ns1:GetMarketReq")
         req.marketId = market_id
         req.includeCouponLinks = coupon_links
         if locale:
@@ -357,11 +742,13 @@ class Session(object):
         hierarchies = market.eventHierarchy[0] if market.eventHierarchy else []
         hierarchies = [evt for evt in hierarchies]
         rsp = MarketInfo(**{k: v for k, v in market})
-        info.eventHierarchy = hierarchies
+        rsp.eventHierarchy = hierarchies
         rsp.couponLinks = coupons
         rsp.runners = runners
         return rsp
 
+    @_cached
+    @_coalesced
     def get_market_info_lite(self, market_id):
         """Returns market information for a single market.
 
@@ -374,7 +761,7 @@ class Session(object):
         -------
         An instance of MarketInfoLite.
         """
-        req = BFExchangeFactory.create("ns1:GetMarketInfoReq")
+        req = self._requests.create(BFExchangeFactory, "ns1:GetMarketInfoReq")
         req.marketId = market_id
         rsp = self._soapcall(BFExchangeService.getMarketInfo, req)
         if rsp.errorCode != GetMarketErrorEnum.OK:
@@ -386,9 +773,11 @@ class Session(object):
         info = MarketInfoLite(**{k: v for k, v in rsp.marketLite})
         return info
 
+    @_coalesced
     def get_market_traded_volume(self, market_id, selection_id,
                                  asian_line_id=None, currency=None):
-        req = BFExchangeFactory.create("ns1:GetMarketTradedVolumeReq")
+        req = self._requests.create(BFExchangeFactory,
+                                    "ns1:GetMarketTradedVolumeReq")
         req.marketId = market_id
         req.selectionId = selection_id
         if asian_line_id is not None:
@@ -397,7 +786,7 @@ class Session(object):
             req.currencyCode = currency
         rsp = self._soapcall(BFExchangeService.getMarketTradedVolume, req)
         if rsp.errorCode != GetMarketTradedVolumeErrorEnum.OK:
-            error_code == rsp.errorCode
+            error_code = rsp.errorCode
             if error_code == GetMarketTradedVolumeErrorEnum.NO_RESULTS:
                 return None
             if error_code == GetMarketErrorEnum.API_ERROR:
@@ -416,21 +805,190 @@ class Session(object):
     def get_market_traded_volume_compressed(self):
         pass
 
-    @not_implemented
-    def cancel_bets(self):
-        pass
+    def cancel_bets(self, bets, chunk_size=MAX_CANCEL_BETS, max_workers=8):
+        """Cancels unmatched bets.
 
-    @not_implemented
-    def cancel_bets_by_market(self):
-        pass
+        Bets are sent in requests of at most `chunk_size` bets, several of
+        which are sent concurrently, each with its own request header.
+
+        Parameters
+        ----------
+        bets : sequence of `CancelBet` or `int`
+            Bets, or bet ids, to cancel.
+        chunk_size : `int`
+            Maximum number of bets per request.  Default is MAX_CANCEL_BETS.
+        max_workers : `int`
+            Maximum number of requests that are in flight at the same time.
+
+        Returns
+        -------
+        A list with a `CancelBetResult` for each bet, in the order of `bets`.
+        If a request fails while others succeed, the bets of the failed
+        request have a result with `success` False and the error code, or
+        the name of the exception, as `resultCode`.  The error is raised if
+        all requests fail.
+        """
+        bets = [bet if isinstance(bet, CancelBet) else CancelBet(betId=bet)
+                for bet in bets]
+        return self._batched(
+            self._cancel_bets, bets, _chunks(range(len(bets)), chunk_size),
+            max_workers,
+            lambda bet, error_code: CancelBetResult(
+                betId=bet.betId, resultCode=error_code, success=False))
+
+    def cancel_bets_by_market(self, market_ids):
+        """Cancels all unmatched bets on markets with one request.
 
-    @untested
-    def place_bets(self, bets):
-        req = BFExchangeFactory.create("ns1:PlaceBetsReq")
-        req.bets[0].extend(bets)
-        rsp = self._soapcall(BFExchangeService.placeBets)
+        Parameters
+        ----------
+        market_ids : sequence of `int`
+            Ids of the markets.
+
+        Returns
+        -------
+        A list with a `CancelBetsByMarketResult` for each market.
+        """
+        req = self._requests.create(BFExchangeFactory,
+                                    "ns1:CancelBetsByMarketReq")
+        req.markets[0].extend(market_ids)
+        t0 = time.time()
+        rsp = self._soapcall(BFExchangeService.cancelBetsByMarket, req)
+        self.bet_latency.add("cancelBetsByMarket", time.time() - t0,
+                             len(market_ids))
+        if rsp.errorCode != CancelBetsByMarketErrorEnum.OK:
+            error_code = rsp.errorCode
+            if error_code == CancelBetsByMarketErrorEnum.API_ERROR:
+                error_code = rsp.header.errorCode
+            logger.error("{cancelBetsByMarket} failed with error {%s}",
+                         error_code)
+            raise ServiceError(error_code)
+        results = rsp.results[0] if rsp.results else []
+        results = [CancelBetsByMarketResult(**{k: v for k, v in res})
+                   for res in results]
+        return results
+
+    def cancel_all(self, market_ids, max_workers=8):
+        """Cancels all unmatched bets on markets with one concurrent
+        cancelBetsByMarket request per market.  Every request has its own
+        request header.
+
+        Parameters
+        ----------
+        market_ids : sequence of `int`
+            Ids of the markets.
+        max_workers : `int`
+            Maximum number of requests that are in flight at the same time.
+
+        Returns
+        -------
+        A list with a `CancelBetsByMarketResult` for each market, in the
+        order of `market_ids`.  The result of a market whose request failed
+        has the error code, or the name of the exception, as `resultCode`.
+        The error is raised if all requests fail.
+        """
+        market_ids = list(market_ids)
+        return self._batched(
+            self.cancel_bets_by_market, market_ids,
+            [[i] for i in xrange(len(market_ids))], max_workers,
+            lambda market_id, error_code: CancelBetsByMarketResult(
+                marketId=market_id, resultCode=error_code))
+
+    def place_bets(self, bets, chunk_size=MAX_PLACE_BETS, max_workers=8):
+        """Places bets.
+
+        Bets are grouped by market and sent in requests of at most
+        `chunk_size` bets.  Several requests are sent concurrently, each with
+        its own request header.  Request latencies are recorded in
+        `bet_latency`.
+
+        Parameters
+        ----------
+        bets : sequence of `PlaceBet`
+            Bets to place.
+        chunk_size : `int`
+            Maximum number of bets per request.  Default is MAX_PLACE_BETS.
+        max_workers : `int`
+            Maximum number of requests that are in flight at the same time.
+
+        Returns
+        -------
+        A list with a `PlaceBetResult` for each bet, in the order of `bets`.
+        If a request fails while others succeed, the bets of the failed
+        request have a result with `success` False and the error code, or
+        the name of the exception, as `resultCode`.  Bets of a request that
+        failed with a transport error such as a timeout may have been placed
+        nonetheless.  The error is raised if all requests fail.
+        """
+        bets = list(bets)
+        by_market = {}
+        for i, bet in enumerate(bets):
+            by_market.setdefault(bet.marketId, []).append(i)
+        chunks = [chunk for indexes in by_market.itervalues()
+                  for chunk in _chunks(indexes, chunk_size)]
+        return self._batched(
+            self._place_bets, bets, chunks, max_workers,
+            lambda bet, error_code: PlaceBetResult(resultCode=error_code,
+                                                   success=False))
+
+    def _batched(self, func, items, chunks, max_workers, failed):
+        """Calls `func` with the items of each chunk, as lists of indexes into
+        `items`, from a pool of worker threads.  Returns the results of
+        `func` in the order of `items`; the items of a chunk that failed get
+        the result of ``failed(item, error_code)``.  The error code of a
+        chunk that failed with another exception than ServiceError, e.g. a
+        timeout, is the name of the exception.  The exception of the first
+        chunk is raised if all chunks fail.  Concurrent chunks get their own
+        request headers, also if the session is not thread safe.
+        """
+        if not items:
+            return []
+
+        def call(indexes):
+            try:
+                return func([items[i] for i in indexes]), None
+            except ServiceError as e:
+                return None, e
+            except Exception as e:
+                logger.error("{%s} failed with error {%r}", func.__name__, e)
+                return None, e
+
+        if len(chunks) == 1:
+            outcomes = [call(chunks[0])]
+        else:
+            pool = ThreadPool(min(max_workers, len(chunks)))
+            try:
+                with self._fan_out():
+                    outcomes = pool.map(call, chunks)
+            finally:
+                pool.close()
+        errors = [e for _, e in outcomes if e is not None]
+        if len(errors) == len(outcomes):
+            raise errors[0]
+        results = [None] * len(items)
+        for indexes, (chunk_results, error) in izip(chunks, outcomes):
+            if error is not None:
+                if isinstance(error, ServiceError):
+                    error_code = error.args[0]
+                else:
+                    error_code = type(error).__name__
+                chunk_results = [failed(items[i], error_code)
+                                 for i in indexes]
+            for i, result in izip(indexes, chunk_results):
+                results[i] = result
+        return results
+
+    def _place_bets(self, bets):
+        req = self._requests.create(BFExchangeFactory, "ns1:PlaceBetsReq")
+        for bet in bets:
+            place_bet = BFExchangeFactory.create("ns1:PlaceBets")
+            for attr in bet.__slots__:
+                setattr(place_bet, attr, getattr(bet, attr))
+            req.bets[0].append(place_bet)
+        t0 = time.time()
+        rsp = self._soapcall(BFExchangeService.placeBets, req)
+        self.bet_latency.add("placeBets", time.time() - t0, len(bets))
         if rsp.errorCode != PlaceBetsErrorEnum.OK:
-            error_code == rsp.errorCode
+            error_code = rsp.errorCode
             if error_code == PlaceBetsErrorEnum.API_ERROR:
                 error_code = rsp.header.errorCode
             logger.error("{placeBets} failed with error {%s}",
@@ -441,31 +999,206 @@ class Session(object):
                    for res in results]
         return results
 
+    def _cancel_bets(self, bets):
+        req = self._requests.create(BFExchangeFactory, "ns1:CancelBetsReq")
+        for bet in bets:
+            cancel_bet = BFExchangeFactory.create("ns1:CancelBets")
+            cancel_bet.betId = bet.betId
+            req.bets[0].append(cancel_bet)
+        t0 = time.time()
+        rsp = self._soapcall(BFExchangeService.cancelBets, req)
+        self.bet_latency.add("cancelBets", time.time() - t0, len(bets))
+        if rsp.errorCode != CancelBetsErrorEnum.OK:
+            error_code = rsp.errorCode
+            if error_code == CancelBetsErrorEnum.API_ERROR:
+                error_code = rsp.header.errorCode
+            logger.error("{cancelBets} failed with error {%s}", error_code)
+            raise ServiceError(error_code)
+        results = rsp.betResults[0] if rsp.betResults else []
+        results = dict((res.betId, CancelBetResult(**{k: v for k, v in res}))
+                       for res in results)
+        return [results.get(bet.betId) for bet in bets]
+
+    def _update_bets(self, bets):
+        req = self._requests.create(BFExchangeFactory, "ns1:UpdateBetsReq")
+        for bet in bets:
+            update_bet = BFExchangeFactory.create("ns1:UpdateBets")
+            for attr in bet.__slots__:
+                setattr(update_bet, attr, getattr(bet, attr))
+            req.bets[0].append(update_bet)
+        t0 = time.time()
+        rsp = self._soapcall(BFExchangeService.updateBets, req)
+        self.bet_latency.add("updateBets", time.time() - t0, len(bets))
+        if rsp.errorCode != UpdateBetsErrorEnum.OK:
+            error_code = rsp.errorCode
+            if error_code == UpdateBetsErrorEnum.API_ERROR:
+                error_code = rsp.header.errorCode
+            logger.error("{updateBets} failed with error {%s}", error_code)
+            raise ServiceError(error_code)
+        results = rsp.betResults[0] if rsp.betResults else []
+        results = dict((res.betId, UpdateBetResult(**{k: v for k, v in res}))
+                       for res in results)
+        return [results.get(bet.betId) for bet in bets]
+
+    def update_bets(self, bets, chunk_size=MAX_UPDATE_BETS, max_workers=8):
+        """Changes the price, size or persistence of unmatched bets.
 
-    @not_implemented
-    def update_bets(self):
-        pass
+        Bets are sent in requests of at most `chunk_size` bets, several of
+        which are sent concurrently, each with its own request header.
+
+        Parameters
+        ----------
+        bets : sequence of `UpdateBet`
+            Changes to make.
+        chunk_size : `int`
+            Maximum number of bets per request.  Default is MAX_UPDATE_BETS.
+        max_workers : `int`
+            Maximum number of requests that are in flight at the same time.
+
+        Returns
+        -------
+        A list with an `UpdateBetResult` for each bet, in the order of
+        `bets`.  If a request fails while others succeed, the bets of the
+        failed request have a result with `success` False and the error code,
+        or the name of the exception, as `resultCode`.  The error is raised
+        if all requests fail.
+        """
+        bets = list(bets)
+        return self._batched(
+            self._update_bets, bets, _chunks(range(len(bets)), chunk_size),
+            max_workers,
+            lambda bet, error_code: UpdateBetResult(
+                betId=bet.betId, resultCode=error_code, success=False))
 
     @not_implemented
     def get_bet_history(self):
         pass
 
-    @not_implemented
-    def get_bet_matches_lite(self):
-        pass
+    def get_bet_matches_lite(self, bet_id):
+        """Returns the matched portions of a bet.
+
+        Parameters
+        ----------
+        bet_id : `int`
+            Bet id.
+
+        Returns
+        -------
+        A list of `MatchLite` objects.
+        """
+        req = self._requests.create(BFExchangeFactory,
+                                    "ns1:GetBetMatchesLiteReq")
+        req.betId = bet_id
+        rsp = self._soapcall(BFExchangeService.getBetMatchesLite, req)
+        if rsp.errorCode != GetBetErrorEnum.OK:
+            error_code = rsp.errorCode
+            if error_code == GetBetErrorEnum.NO_RESULTS:
+                return []
+            if error_code == GetBetErrorEnum.API_ERROR:
+                error_code = rsp.header.errorCode
+            logger.error("{getBetMatchesLite} failed with error {%s}",
+                         error_code)
+            raise ServiceError(error_code)
+        matches = rsp.matchLites[0] if rsp.matchLites else []
+        return [MatchLite(**{k: v for k, v in m}) for m in matches if m]
 
     # Betfair advice to use get_matched_unmatched_bets instead.
     @not_implemented
     def get_current_bets(self):
         pass
 
-    @not_implemented
-    def get_current_bets_lite(self):
-        pass
+    def get_current_bets_lite(self, market_id=0, bet_status="U",
+                              record_count=MAX_RECORDS):
+        """Returns the current bets with their matched and remaining sizes.
 
-    @not_implemented
-    def get_matched_and_unmatched_bets(self):
-        pass
+        Parameters
+        ----------
+        market_id : `int`
+            Market id, or 0 for the bets on all markets.
+        bet_status : `str`
+            "U" for unmatched bets, "M" for matched bets or "C" for
+            cancelled bets.
+        record_count : `int`
+            Number of bets per request.  All bets are returned; more than
+            `record_count` bets take several requests.
+
+        Returns
+        -------
+        A list of `BetLite` objects.
+        """
+        req = self._requests.create(BFExchangeFactory,
+                                    "ns1:GetCurrentBetsLiteReq")
+        req.marketId = market_id
+        req.betStatus = bet_status
+        req.orderBy = "BET_ID"
+        req.recordCount = record_count
+        req.noTotalRecordCount = False
+        return [BetLite(**{k: v for k, v in b}) for b in self._get_records(
+            BFExchangeService.getCurrentBetsLite, req, "betLites",
+            GetCurrentBetsErrorEnum)]
+
+    def get_matched_and_unmatched_bets(self, market_id=0, bet_status="MU",
+                                       bet_ids=None, matched_since=None,
+                                       record_count=MAX_RECORDS):
+        """Returns matched and unmatched bets.  A bet that is partly matched
+        is returned as one `MUBet` per matched portion and one for the
+        remaining unmatched size.
+
+        Parameters
+        ----------
+        market_id : `int`
+            Market id, or 0 for the bets on all markets.
+        bet_status : `str`
+            "M" for matched bets, "U" for unmatched bets or "MU" for both.
+        bet_ids : sequence of `int` or `None`
+            Ids of the bets to return.  None returns all bets.
+        matched_since : `datetime` or `None`
+            Only return bets that were matched since.
+        record_count : `int`
+            Number of bets per request.  All bets are returned; more than
+            `record_count` bets take several requests.
+
+        Returns
+        -------
+        A list of `MUBet` objects.
+        """
+        req = self._requests.create(BFExchangeFactory, "ns1:GetMUBetsReq")
+        req.marketId = market_id
+        req.betStatus = bet_status
+        if bet_ids:
+            req.betIds[0].extend(bet_ids)
+        if matched_since is not None:
+            req.matchedSince = matched_since
+        req.orderBy = "BET_ID"
+        req.sortOrder = "ASC"
+        req.recordCount = record_count
+        req.excludeLastSecond = False
+        return [MUBet(**{k: v for k, v in b}) for b in self._get_records(
+            BFExchangeService.getMUBets, req, "bets", GetMUBetsErrorEnum)]
+
+    def _get_records(self, soapfunc, req, field, error_enum):
+        """Pages through the records of a request with `startRecord` and
+        `recordCount` and returns them.
+        """
+        records = []
+        while True:
+            req.startRecord = len(records)
+            rsp = self._soapcall(soapfunc, req)
+            if rsp.errorCode != error_enum.OK:
+                error_code = rsp.errorCode
+                if error_code == error_enum.NO_RESULTS:
+                    break
+                if error_code == error_enum.API_ERROR:
+                    error_code = rsp.header.errorCode
+                logger.error("{%s} failed with error {%s}",
+                             _operation_name(soapfunc), error_code)
+                raise ServiceError(error_code)
+            items = getattr(rsp, field)
+            items = [r for r in items[0] if r] if items else []
+            records.extend(items)
+            if not items or len(records) >= rsp.totalRecordCount:
+                break
+        return records
 
     @not_implemented
     def get_market_profit_loss(self):
@@ -483,10 +1216,12 @@ class Session(object):
     def get_sliks_v2(self):
         pass
 
+    @_coalesced
     def get_inplay_markets(self, locale=None):
         if self.product_id == FREE_API:
             raise ServiceError("Free API does not support get_inplay_markets")
-        req = BFExchangeFactory.create("ns1:GetInPlayMarketsReq")
+        req = self._requests.create(BFExchangeFactory,
+                                    "ns1:GetInPlayMarketsReq")
         if locale: req.locale = locale
         rsp = self._soapcall(BFExchangeService.getInPlayMarkets, req)
         if rsp.errorCode != GetInPlayMarketsErrorEnum.OK:
@@ -498,33 +1233,218 @@ class Session(object):
             raise ServiceError(error_code)
         return uncompress_markets(rsp.marketData)
 
-    def get_markets(self, event_ids=None, countries=None, date_range=None):
-        req = BFExchangeFactory.create("ns1:GetAllMarketsReq")
-        if event_ids:
-            req.eventTypeIds[0].extend(list(iter(event_ids)))
-        if countries:
-            req.countries[0].extend(list(iter(countries)))
+    @_cached
+    @_coalesced
+    def get_markets(self, event_ids=None, countries=None, date_range=None,
+                    split_event_types=False, windows=None, max_workers=8):
+        """Returns the markets that are available on the exchange.
+
+        The request can be split into shards, one per event type and/or date
+        window, which are fetched and decoded concurrently.  Markets that are
+        returned by several shards are included once.
+
+        Parameters
+        ----------
+        event_ids : sequence of `int` or `None`
+            Ids of the event types of the markets.  None for all.
+        countries : sequence of `str` or `None`
+            ISO3 country codes of the markets.  None for all.
+        date_range : sequence of `datetime` or `None`
+            ``(from_date,)`` or ``(from_date, to_date)`` of the markets.
+        split_event_types : `bool`
+            If True the request is split by event type.  Without `event_ids`
+            the active event types are used.
+        windows : `int`, `timedelta` or `None`
+            Number or length of the date windows by which the request is
+            split.  Requires a `date_range` with both dates.
+        max_workers : `int`
+            Maximum number of shards that are requested at the same time.
+
+        Returns
+        -------
+        A list of `Market` objects.
+        """
+        shards = self._market_shards(event_ids, date_range, split_event_types,
+                                     windows)
+        if len(shards) == 1:
+            return self._get_markets(event_ids, countries, date_range)
+        pool = ThreadPool(min(max_workers, len(shards)))
+        try:
+            with self._fan_out():
+                results = pool.map(
+                    lambda shard: self._get_markets(shard[0], countries,
+                                                    shard[1]),
+                    shards)
+        finally:
+            pool.close()
+        merged = {}
+        order = []
+        for markets in results:
+            for market in markets:
+                old = merged.get(market.marketId)
+                if old is None:
+                    order.append(market.marketId)
+                elif old.lastRefresh >= market.lastRefresh:
+                    continue
+                merged[market.marketId] = market
+        return [merged[market_id] for market_id in order]
+
+    def _get_markets(self, event_ids, countries, date_range):
+        market_data = self._get_all_markets(event_ids, countries, date_range)
+        if self.payload_cache is None:
+            return uncompress_markets(market_data)
+        # Old rolling windows are evicted by the bound of the cache.
+        key = ("getAllMarkets", _freeze(event_ids), _freeze(countries),
+               _freeze(date_range))
+        markets, _ = self.payload_cache.decode(key, market_data,
+                                               uncompress_markets)
+        return markets
+
+    def _market_shards(self, event_ids, date_range, split_event_types,
+                       windows):
+        """Returns a list of ``(event_ids, date_range)`` per shard.
+        """
+        event_groups = [event_ids]
+        if split_event_types:
+            if not event_ids:
+                event_ids = [et.id for et in self.get_event_types()]
+            event_groups = [[event_id] for event_id in event_ids]
+        date_ranges = [date_range]
+        if windows:
+            bounds = list(date_range or [])
+            if len(bounds) < 2:
+                raise ValueError("windows requires a date_range with a "
+                                 "from date and a to date")
+            start, end = bounds[0], bounds[-1]
+            if isinstance(windows, timedelta):
+                step = windows
+            else:
+                step = (end - start) / windows
+            if step <= timedelta(0):
+                raise ValueError("Invalid date windows")
+            date_ranges = []
+            while start < end:
+                date_ranges.append((start, min(start + step, end)))
+                start += step
+        return [(ids, window) for ids in event_groups
+                for window in date_ranges]
+
+    def iter_markets(self, event_ids=None, countries=None, date_range=None):
+        """Same as `get_markets` but returns an iterator that decodes the
+        markets one at a time.
+
+        Markets that are not needed can be skipped without ever holding the
+        complete list of decoded markets in memory, e.g.::
+
+            uk = (m for m in session.iter_markets() if m.countryISO3 == "GBR")
+        """
+        market_data = self._get_all_markets(event_ids, countries, date_range)
+        return uncompress_markets.iter(market_data)
+
+    def _get_all_markets(self, event_ids, countries, date_range):
+        from_date = to_date = None
         if date_range:
-            date_range = list(iter(date_range))
-            req.fromDate = date_range[0]
+            date_range = list(date_range)
+            from_date = date_range[0]
             if len(date_range) > 1:
-                req.toDate = date_range.end[-1]
-        rsp = self._soapcall(BFExchangeService.getAllMarkets, req)
+                to_date = date_range[-1]
+        if self.raw_xml:
+            rsp = self._rawcall(_raw.getAllMarkets,
+                                eventTypeIds=list(event_ids or []),
+                                countries=list(countries or []),
+                                fromDate=from_date, toDate=to_date)
+        else:
+            req = self._requests.create(BFExchangeFactory,
+                                        "ns1:GetAllMarketsReq")
+            if event_ids:
+                req.eventTypeIds[0].extend(list(iter(event_ids)))
+            if countries:
+                req.countries[0].extend(list(iter(countries)))
+            if from_date is not None:
+                req.fromDate = from_date
+            if to_date is not None:
+                req.toDate = to_date
+            rsp = self._soapcall(BFExchangeService.getAllMarkets, req)
         if rsp.errorCode != GetAllMarketsErrorEnum.OK:
             error_code = rsp.errorCode
             if error_code == GetAllMarketsErrorEnum.API_ERROR:
                 error_code = rsp.header.errorCode
             logger.error("{getAllMarkets} failed with error {%s}", error_code)
             raise ServiceError(error_code)
-        markets = uncompress_markets(rsp.marketData)
-        return markets
+        return rsp.marketData
 
-    def get_market_prices(self, market_id, currency=None):
-        req = BFExchangeFactory.create("ns1:GetMarketPricesCompressedReq")
-        req.marketId = market_id
-        if currency:
-            req.currencyCode = currency
-        rsp = self._soapcall(BFExchangeService.getMarketPricesCompressed, req)
+    @_coalesced
+    def get_market_prices(self, market_id, currency=None, columnar=False,
+                          only_modified=False):
+        """Returns the best prices for the runners in a market.
+
+        Parameters
+        ----------
+        market_id : `int`
+            Id of the market.
+        currency : `str` or `None`
+            Currency of the amounts.  If None the currency of the account is
+            used.
+        columnar : `bool`
+            If True `runnerPrices` of the result is a `RunnerPriceColumns`
+            with NumPy arrays instead of a list of `RunnerPrice` objects.
+        only_modified : `bool`
+            If True and the session was created with `reuse_unchanged`,
+            `NOT_MODIFIED` is returned instead of the previous result when
+            the prices did not change.
+
+        Returns
+        -------
+        An instance of MarketPrices or NOT_MODIFIED.
+        """
+        market_prices = self._get_market_prices_compressed(market_id,
+                                                           currency)
+        if self.payload_cache is None:
+            prices = uncompress_market_prices(market_prices,
+                                              columnar=columnar)
+        else:
+            key = ("getMarketPricesCompressed", market_id, currency, columnar)
+            prices, modified = self.payload_cache.decode(
+                key, market_prices, uncompress_market_prices,
+                columnar=columnar)
+            if only_modified and not modified:
+                return NOT_MODIFIED
+        if self.metadata_cache is not None:
+            self.metadata_cache.market_status(market_id, prices.marketStatus)
+        return prices
+
+    @_coalesced
+    def get_market_prices_compressed(self, market_id, currency=None):
+        """Returns the best prices for the runners in a market as the
+        compressed string of getMarketPricesCompressed, e.g. to update a
+        `MarketBook`.
+
+        Parameters
+        ----------
+        market_id : `int`
+            Id of the market.
+        currency : `str` or `None`
+            Currency of the amounts.  If None the currency of the account is
+            used.
+
+        Returns
+        -------
+        A `str`.
+        """
+        return self._get_market_prices_compressed(market_id, currency)
+
+    def _get_market_prices_compressed(self, market_id, currency):
+        if self.raw_xml:
+            rsp = self._rawcall(_raw.getMarketPricesCompressed,
+                                marketId=market_id, currencyCode=currency)
+        else:
+            req = self._requests.create(BFExchangeFactory,
+                                        "ns1:GetMarketPricesCompressedReq")
+            req.marketId = market_id
+            if currency:
+                req.currencyCode = currency
+            rsp = self._soapcall(BFExchangeService.getMarketPricesCompressed,
+                                 req)
         if rsp.errorCode != GetMarketPricesErrorEnum.OK:
             error_code = rsp.errorCode
             if error_code == GetMarketPricesErrorEnum.API_ERROR:
@@ -532,8 +1452,64 @@ class Session(object):
             logger.error("{getMarketPricesCompressed} failed with error {%s}",
                          error_code)
             raise ServiceError(error_code)
-        prices = uncompress_market_prices(rsp.marketPrices)
-        return prices
+        return rsp.marketPrices
+
+    def get_market_prices_many(self, market_ids, currency=None, max_workers=8,
+                               deadline=None):
+        """Returns the prices of several markets.  The requests are sent and
+        decoded concurrently by a pool of worker threads, each with its own
+        request header.
+
+        Parameters
+        ----------
+        market_ids : iterable of `int`
+            Ids of the markets.
+        currency : `str` or `None`
+            Currency of the amounts.
+        max_workers : `int`
+            Maximum number of requests that are in flight at the same time.
+        deadline : `float` or `None`
+            Time, as returned by `time.time()`, after which markets that have
+            not been received are given up on.  None waits for all markets.
+
+        Returns
+        -------
+        A tuple ``(prices, errors)``.  `prices` maps market ids to
+        MarketPrices and `errors` maps the ids of markets that failed to the
+        exception that was raised.  Markets that missed the deadline fail
+        with ServiceError("DEADLINE_EXCEEDED").
+        """
+        market_ids = list(market_ids)
+        prices, errors = {}, {}
+        if not market_ids:
+            return prices, errors
+
+        def fetch(market_id):
+            # Requests that are still queued at the deadline are not sent.
+            if deadline is not None and time.time() > deadline:
+                raise ServiceError("DEADLINE_EXCEEDED")
+            # Requests that missed the deadline may outlive this call.
+            with self._fan_out():
+                return self.get_market_prices(market_id, currency)
+
+        pool = ThreadPool(min(max_workers, len(market_ids)))
+        try:
+            pending = [(market_id, pool.apply_async(fetch, (market_id,)))
+                       for market_id in market_ids]
+            for market_id, result in pending:
+                timeout = None
+                if deadline is not None:
+                    timeout = max(0.0, deadline - time.time())
+                try:
+                    prices[market_id] = result.get(timeout)
+                except TimeoutError:
+                    errors[market_id] = ServiceError("DEADLINE_EXCEEDED")
+                except Exception as e:
+                    errors[market_id] = e
+        finally:
+            # Requests that missed the deadline finish in the background.
+            pool.close()
+        return prices, errors
 
     # Betfair recommend to use getCompleteMarketPricesCompressed instead
     #def get_detail_available_market_depth(self, market_id, selection_id, currency=None,
@@ -554,11 +1530,35 @@ class Session(object):
     #        raise ServiceError(rsp.errorCode)
     #    return [AvailabilityInfo(*p) for p in rsp.priceItems[0]]
 
-    def get_market_depth(self, market_id, currency):
-        req = BFExchangeFactory.create("ns1:GetCompleteMarketPricesCompressedReq")
-        req.marketId = market_id
-        req.currencyCode = currency
-        rsp = self._soapcall(BFExchangeService.getCompleteMarketPricesCompressed, req)
+    @_coalesced
+    def get_market_depth(self, market_id, currency, columnar=False):
+        """Returns all prices available for the runners in a market.
+
+        Parameters
+        ----------
+        market_id : `int`
+            Id of the market.
+        currency : `str`
+            Currency of the amounts.
+        columnar : `bool`
+            If True the prices of each runner are a NumPy array with one row
+            of `AvailabilityInfo` fields per price instead of a list of
+            `AvailabilityInfo` objects.
+
+        Returns
+        -------
+        An instance of CompleteMarketPrices.
+        """
+        if self.raw_xml:
+            rsp = self._rawcall(_raw.getCompleteMarketPricesCompressed,
+                                marketId=market_id, currencyCode=currency)
+        else:
+            req = self._requests.create(
+                BFExchangeFactory, "ns1:GetCompleteMarketPricesCompressedReq")
+            req.marketId = market_id
+            req.currencyCode = currency
+            rsp = self._soapcall(
+                BFExchangeService.getCompleteMarketPricesCompressed, req)
         if rsp.errorCode != GetCompleteMarketPricesErrorEnum.OK:
             error_code = rsp.errorCode
             if rsp.errorCode == GetCompleteMarketPricesErrorEnum.API_ERROR:
@@ -566,7 +1566,8 @@ class Session(object):
             logger.error("{getCompleteMarketPricesCompressed} failed with "
                          "error {%s}", error_code)
             raise ServiceError(error_code)
-        return uncompress_complete_market_depth(rsp.completeMarketPrices)
+        return uncompress_complete_market_depth(rsp.completeMarketPrices,
+                                                columnar=columnar)
 
     @not_implemented
     def add_payment_card(self):
@@ -649,7 +1650,7 @@ class Session(object):
         pass
 
     def _get_bet_info_lite(self, bet_id):
-        req = BFGlobalFactory.create("ns1:GetBetLiteReq")
+        req = self._requests.create(BFGlobalFactory, "ns1:GetBetLiteReq")
         req.betId = bet_id
         self._soapcall(BFExchangeService.getBetLite, req)
         if rsp.errorCode != GetBetErrorEnum.OK:
@@ -664,15 +1665,234 @@ class Session(object):
         return rsp
 
     def _soapcall(self, soapfunc, req):
-        if hasattr(req, 'header'):
-            req.header = self._request_header
-        if self._heartbeat:
-            self._heartbeat.reset()
-        rsp = soapfunc(req)
+        self.rate_limiter.acquire(_operation_name(soapfunc))
+        while True:
+            seq = next(self._call_seq)
+            header = self._header()
+            token = header.sessionToken
+            if hasattr(req, 'header'):
+                req.header = header
+            heartbeat = self._heartbeat
+            if heartbeat:
+                heartbeat.reset()
+            rsp = soapfunc(req)
+            if self._standby is None or not _is_no_session(rsp) or \
+                    not self._take_standby(token):
+                break
+        self._update_token(rsp, seq)
+        return rsp
+
+    def _rawcall(self, operation, **values):
+        self.rate_limiter.acquire(operation.name)
+        while True:
+            seq = next(self._call_seq)
+            header = self._header()
+            token = header.sessionToken
+            heartbeat = self._heartbeat
+            if heartbeat:
+                heartbeat.reset()
+            rsp = operation(header, **values)
+            if self._standby is None or not _is_no_session(rsp) or \
+                    not self._take_standby(token):
+                break
+        self._update_token(rsp, seq)
+        return rsp
+
+    @contextlib.contextmanager
+    def _fan_out(self):
+        """Gives every call its own request header while the block runs, so
+        that worker threads can share a session that is not thread safe.
+        """
+        with self._fan_out_lock:
+            self._fan_outs += 1
+        try:
+            yield
+        finally:
+            with self._fan_out_lock:
+                self._fan_outs -= 1
+
+    def _header(self):
+        """Returns the request header for a call.
+        """
+        if not self.thread_safe and not self._fan_outs:
+            return self._request_header
+        header = self._requests.create(BFGlobalFactory, "ns1:APIRequestHeader")
+        header.clientStamp = self._request_header.clientStamp
+        header.sessionToken = self._request_header.sessionToken
+        return header
+
+    def _update_token(self, rsp, seq):
         try:
             token = rsp.header.sessionToken
-            if token:
-                self._request_header.sessionToken = token
         except AttributeError:
-            pass
-        return rsp
+            return
+        # Reading the current token does not need the lock.
+        if not token or token == self._request_header.sessionToken:
+            return
+        with self._token_lock:
+            if seq <= self._token_seq:
+                return
+            self._token_seq = seq
+            self._request_header.sessionToken = token
+        if self.token_file and \
+                time.time() - self._token_saved >= _TOKEN_SAVE_INTERVAL:
+            self.save_token()
+
+    def _set_token(self, token):
+        with self._token_lock:
+            # Calls that are still in flight must not restore the old token.
+            self._token_seq = next(self._call_seq)
+            self._request_header.sessionToken = token
+
+
+class AsyncSession(object):
+    """Issues the calls of a `Session` concurrently from a pool of worker
+    threads.
+
+    Every public method of `Session` is available on `AsyncSession`.  Instead
+    of blocking, a call returns a `multiprocessing.pool.AsyncResult` whose
+    `get` method returns the result or raises the exception of the call.
+    All calls share the login of the wrapped session, which must be created
+    with ``thread_safe=True`` unless `max_workers` is 1::
+
+        with AsyncSession(session, max_workers=16) as pending:
+            results = [pending.get_market_prices(m) for m in market_ids]
+            prices = [r.get() for r in results]
+    """
+
+    def __init__(self, session, max_workers=8):
+        """Constructor.
+
+        Parameters
+        ----------
+        session : `Session`
+            Session that is used for the calls.
+        max_workers : `int`
+            Maximum number of calls that are in flight at the same time.
+            ValueError is raised if it is larger than 1 and `session` is not
+            thread safe.
+        """
+        super(AsyncSession, self).__init__()
+        if max_workers > 1 and not session.thread_safe:
+            raise ValueError("AsyncSession requires a session that is "
+                             "created with thread_safe=True")
+        self.session = session
+        self.max_workers = max_workers
+        self._pool = ThreadPool(max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        func = getattr(self.session, name)
+        if name.startswith("_") or not callable(func):
+            return func
+
+        def call(*args, **kwargs):
+            return self._pool.apply_async(func, args, kwargs)
+        call.__name__ = name
+        call.__doc__ = func.__doc__
+        return call
+
+    def close(self):
+        """Waits for the pending calls and stops the worker threads.
+        """
+        self._pool.close()
+        self._pool.join()
+
+
+class SessionPool(object):
+    """Spreads calls over several logins of one account to go beyond the
+    limits of a single session.
+
+    All sessions must be of the same account, so that bets placed through
+    one session can be updated and cancelled through any other.
+
+    Every public method of `Session` is available on `SessionPool`.  A call
+    is made with the active session that has the fewest calls in flight and,
+    among those, the fewest calls so far::
+
+        pool = SessionPool([Session(user, password) for _ in range(4)])
+        pool.login()
+        prices = pool.get_market_prices(market_id)
+    """
+
+    def __init__(self, sessions):
+        """Constructor.
+
+        Parameters
+        ----------
+        sessions : sequence of `Session`
+            Sessions of the pool, all with the same username.  Sessions that
+            are shared between threads should be created with
+            ``thread_safe=True``.
+        """
+        super(SessionPool, self).__init__()
+        self.sessions = list(sessions)
+        if len(set(s.username for s in self.sessions)) > 1:
+            raise ValueError("Sessions of a SessionPool must be of the same "
+                             "account")
+        self._lock = threading.Lock()
+        self._in_flight = dict((id(s), 0) for s in self.sessions)
+        self._calls = dict((id(s), 0) for s in self.sessions)
+
+    @property
+    def thread_safe(self):
+        """True if all sessions of the pool are thread safe.
+        """
+        return all(s.thread_safe for s in self.sessions)
+
+    def login(self):
+        """Logs in the sessions that are not active.
+        """
+        for session in self.sessions:
+            if not session.is_active:
+                session.login()
+
+    def logout(self):
+        for session in self.sessions:
+            if session.is_active:
+                session.logout()
+
+    def acquire(self):
+        """Returns the least loaded active session.  It must be handed back
+        with `release`.
+        """
+        with self._lock:
+            active = [s for s in self.sessions if s.is_active]
+            if not active:
+                raise ServiceError("No active session")
+            session = min(active, key=lambda s: (self._in_flight[id(s)],
+                                                 self._calls[id(s)]))
+            self._in_flight[id(session)] += 1
+            self._calls[id(session)] += 1
+        return session
+
+    def release(self, session):
+        with self._lock:
+            self._in_flight[id(session)] -= 1
+
+    def stats(self):
+        """Returns a list with the number of calls in flight and the number
+        of calls so far per session.
+        """
+        with self._lock:
+            return [(self._in_flight[id(s)], self._calls[id(s)])
+                    for s in self.sessions]
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not callable(getattr(Session, name, None)):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            session = self.acquire()
+            try:
+                return getattr(session, name)(*args, **kwargs)
+            finally:
+                self.release(session)
+        call.__name__ = name
+        call.__doc__ = getattr(Session, name).__doc__
+        return call
@@ -21,6 +21,7 @@ setup(
     version = "0.1",
     packages = find_packages(exclude = ["tests"]),
     install_requires = ["suds>=0.4"],
+    extras_require = {"numpy": ["numpy"]},
     tests_require=["pytest"],
 
     author = "Tjerk Santegoeds",
@@ -0,0 +1,110 @@
+"""In-process stand-ins for the Betfair SOAP services.
+
+`install(monkeypatch)` replaces the suds services, factories and error
+enumerations that bfair.session uses with fakes, so that Session can be
+exercised without network access or WSDLs.
+"""
+
+import itertools
+import threading
+import time
+
+from suds import sudsobject
+
+from bfair import _soap
+
+
+class Obj(object):
+    """Stand-in for suds objects."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __iter__(self):
+        return iter(sorted(self.__dict__.items()))
+
+
+class Enum(object):
+
+    def __getattr__(self, name):
+        return name
+
+
+class FakeFactory(object):
+
+    lists = ("eventTypeIds", "countries", "bets", "betIds", "marketIds",
+             "markets")
+
+    def create(self, name):
+        name = name.split(":")[-1]
+        if name.endswith("Enum"):
+            return Enum()
+        if name == "APIRequestHeader":
+            return Obj(clientStamp=0, sessionToken=None)
+        req = sudsobject.Factory.object(name, {"header": None, "type": name})
+        for attr in self.lists:
+            array = sudsobject.Factory.object("ArrayOf", {"item": []})
+            setattr(req, attr, array)
+        return req
+
+
+class FakeService(object):
+    """Answers every SOAP operation with an OK response after `latency`
+    seconds.  Operation specific responses are produced by `handlers`, which
+    map an operation name to a function of the request.
+    """
+
+    def __init__(self, latency=0.0, **handlers):
+        self.latency = latency
+        self.handlers = handlers
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._tokens = itertools.count(1)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def operation(req):
+            with self._lock:
+                self.calls.append((name, req))
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                token = "token-%d" % next(self._tokens)
+            try:
+                if self.latency:
+                    time.sleep(self.latency)
+                rsp = Obj(errorCode="OK",
+                          header=Obj(errorCode="OK", sessionToken=token))
+                handler = self.handlers.get(name)
+                if handler is not None:
+                    handler(req, rsp)
+                return rsp
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+        operation.__name__ = name
+        return operation
+
+    def count(self, name):
+        return sum(1 for op, _ in self.calls if op == name)
+
+
+def install(monkeypatch, global_service=None, exchange_service=None):
+    """Replaces the SOAP layer of bfair.session and returns the fake global
+    and exchange services.
+    """
+    import bfair.session
+
+    global_service = global_service or FakeService()
+    exchange_service = exchange_service or FakeService()
+    for name in _soap.__all__:
+        if name.endswith("Enum"):
+            monkeypatch.setattr(bfair.session, name, Enum())
+    monkeypatch.setattr(bfair.session, "BFGlobalFactory", FakeFactory())
+    monkeypatch.setattr(bfair.session, "BFExchangeFactory", FakeFactory())
+    monkeypatch.setattr(bfair.session, "BFGlobalService", global_service)
+    monkeypatch.setattr(bfair.session, "BFExchangeService", exchange_service)
+    return global_service, exchange_service
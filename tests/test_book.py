@@ -0,0 +1,79 @@
+from os import path
+
+from bfair.book import MarketBook
+from bfair._util import uncompress_market_prices
+
+
+DATA_DIR = path.join(path.dirname(__file__), "data")
+
+HEADER = "1~GBP~ACTIVE~0~1~~true~5.0~1318539294326~~N"
+
+
+def payload(*runners):
+    return ":".join((HEADER,) + runners)
+
+
+def test_market_book_matches_decoder():
+    with open(path.join(DATA_DIR, "market_prices.dump")) as f:
+        line = f.readline()
+    book = MarketBook()
+    delta = book.update(line)
+    expected = uncompress_market_prices(line)
+    assert delta.marketStatus == "ACTIVE"
+    assert len(delta.runners) == len(expected.runnerPrices)
+    for rp, ep in zip(book.prices.runnerPrices, expected.runnerPrices):
+        assert list(rp)[:10] == list(ep)[:10]
+        assert [list(p) for p in rp.bestPricesToBack] == \
+               [list(p) for p in ep.bestPricesToBack]
+        assert [list(p) for p in rp.bestPricesToLay] == \
+               [list(p) for p in ep.bestPricesToLay]
+
+    # An identical payload changes nothing and keeps every object.
+    runners = list(book.prices.runnerPrices)
+    delta = book.update(line)
+    assert not delta
+    assert all(a is b for a, b in zip(runners, book.prices.runnerPrices))
+
+
+def test_market_book_delta():
+    book = MarketBook()
+    book.update(payload("7~0~10.0~2.0~~~false~~~~|2.0~5.0~L~1~1.9~3.0~L~2~|2.1~4.0~B~1~",
+                        "8~1~0.0~~~~false~~~~|3.0~1.0~L~1~|"))
+    old = book.prices.runnerPrices
+
+    delta = book.update(payload("7~0~10.0~2.0~~~false~~~~|2.0~5.0~L~1~1.9~6.0~L~2~|",
+                                "9~2~0.0~~~~false~~~~||"))
+    assert delta.marketStatus is None
+    assert [r.selectionId for r in delta.runners] == [9]
+    assert delta.removedRunners == [8]
+    changes = set((c.selectionId, c.side, c.price, c.oldAmount, c.newAmount)
+                  for c in delta.ladderChanges)
+    assert changes == set([
+        (7, "back", 1.9, 3.0, 6.0),
+        (7, "lay", 2.1, 4.0, 0.0),
+        (8, "back", 3.0, 1.0, 0.0),
+    ])
+
+    runner = book.prices.runnerPrices[0]
+    assert runner is not old[0]
+    assert runner.bestPricesToBack[0] is old[0].bestPricesToBack[0]
+    assert runner.bestPricesToLay == []
+
+
+def test_market_book_from_session(monkeypatch):
+    from bfair.session import Session
+    from tests import fakes
+
+    payloads = [payload("7~0~10.0~2.0~~~false~~~~|2.0~5.0~L~1~|"),
+                payload("7~0~10.0~2.0~~~false~~~~|2.0~6.0~L~1~|")]
+
+    def handler(req, rsp):
+        rsp.marketPrices = payloads.pop(0)
+    fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        getMarketPricesCompressed=handler))
+    session = Session("user", "password", rate_limits={})
+    book = MarketBook(1)
+    book.update(session.get_market_prices_compressed(1))
+    delta = book.update(session.get_market_prices_compressed(1))
+    assert [(c.price, c.oldAmount, c.newAmount)
+            for c in delta.ladderChanges] == [(2.0, 5.0, 6.0)]
@@ -0,0 +1,125 @@
+import time
+
+from datetime import datetime
+from os import path
+
+from bfair._types import Market
+from bfair.cache import MetadataCache, MetadataStore
+
+
+def test_ttl():
+    cache = MetadataCache(ttls={"get_event_types": 0.05})
+    key = cache.key("get_event_types", (), {"locale": "en"})
+    assert cache.get(key) is None
+    cache.put(key, [1])
+    assert cache.get(key) == [1]
+    assert cache.get(cache.key("get_event_types", (), {})) is None
+    time.sleep(0.06)
+    assert cache.get(key) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["expirations"]) == (1, 3, 1)
+    assert stats["entries"] == 0
+
+
+def test_methods_without_ttl_are_not_cached():
+    cache = MetadataCache(ttls={})
+    key = cache.key("get_event_types", (), {})
+    cache.put(key, [1])
+    assert cache.get(key) is None
+
+
+def test_lru_eviction():
+    cache = MetadataCache(max_entries=2)
+    keys = [cache.key("get_event_info", (i,), {}) for i in range(3)]
+    cache.put(keys[0], "a")
+    cache.put(keys[1], "b")
+    cache.get(keys[0])
+    cache.put(keys[2], "c")
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == "a"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_max_bytes():
+    cache = MetadataCache(max_bytes=2000)
+    for i in range(10):
+        cache.put(cache.key("get_event_info", (i,), {}), range(50))
+    stats = cache.stats()
+    assert 0 < stats["entries"] < 10
+    assert stats["bytes"] <= 2000
+    assert stats["evictions"] == 10 - stats["entries"]
+
+
+def test_invalidate():
+    cache = MetadataCache()
+    for method in ("get_event_info", "get_market_info"):
+        for i in range(2):
+            cache.put(cache.key(method, (i,), {}), i)
+    assert cache.invalidate("get_event_info", 0) == 1
+    assert cache.invalidate("get_event_info") == 1
+    assert cache.invalidate() == 2
+    assert cache.stats()["invalidations"] == 4
+
+
+def test_market_status_change():
+    cache = MetadataCache()
+    cache.put(cache.key("get_market_info", (1,), {}), "info")
+    cache.put(cache.key("get_market_info_lite", (), {"market_id": 1}), "lite")
+    cache.put(cache.key("get_market_info", (2,), {}), "other")
+    cache.market_status(1, "ACTIVE")
+    cache.market_status(1, "ACTIVE")
+    assert cache.stats()["entries"] == 3
+    cache.market_status(1, "SUSPENDED")
+    assert cache.stats()["entries"] == 1
+    assert cache.get(cache.key("get_market_info", (2,), {})) == "other"
+
+
+def test_market_status_is_bounded():
+    cache = MetadataCache(max_entries=2)
+    for market_id in range(5):
+        cache.market_status(market_id, "ACTIVE")
+    assert list(cache._market_status) == [3, 4]
+    cache.put(cache.key("get_market_info", (4,), {}), "info")
+    cache.market_status(4, "SUSPENDED")
+    assert cache.stats()["entries"] == 0
+
+
+def test_store(tmpdir):
+    filename = str(tmpdir.join("metadata.db"))
+    store = MetadataStore(filename)
+    key = ("get_markets", (), ())
+    new = [Market(marketId=1, lastRefresh=datetime(2011, 10, 17, 12, 0))]
+    old = [Market(marketId=1, lastRefresh=datetime(2011, 10, 17, 11, 0))]
+    assert store.save(key, new)
+    assert not store.save(key, old)
+    store.close()
+
+    store = MetadataStore(filename)
+    value, fetched = store.load(key)
+    assert value[0].lastRefresh == new[0].lastRefresh
+    assert time.time() - fetched < 5
+    store.delete([key])
+    assert store.load(key) is None
+
+
+def test_cache_with_store(tmpdir):
+    filename = str(tmpdir.join("metadata.db"))
+    cache = MetadataCache(store=MetadataStore(filename))
+    info = cache.key("get_market_info", (1,), {})
+    events = cache.key("get_event_info", (1,), {"locale": "en"})
+    cache.put(info, "info")
+    cache.put(events, "events")
+
+    restarted = MetadataCache(store=MetadataStore(filename))
+    assert restarted.get(events) == "events"
+    assert restarted.stats()["restored"] == 1
+    restarted.market_status(1, "ACTIVE")
+    restarted.market_status(1, "CLOSED")
+    assert restarted.get(info) is None
+    assert restarted.get_stale(info) is None
+
+    expired = MetadataCache(ttls={"get_event_info": 0.01},
+                            store=MetadataStore(filename))
+    time.sleep(0.02)
+    assert expired.get(events) is None
+    assert expired.get_stale(events) == "events"
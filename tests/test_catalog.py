@@ -0,0 +1,96 @@
+import copy
+
+from datetime import datetime, timedelta
+from os import path
+
+from bfair._util import uncompress_markets
+from bfair.catalog import MarketCatalog
+
+
+DATA_DIR = path.join(path.dirname(__file__), "data")
+
+with open(path.join(DATA_DIR, "markets.dump")) as f:
+    MARKETS = uncompress_markets(f.readline())
+
+
+def scan(**criteria):
+    return sorted(m.marketId for m in MARKETS if all(
+        f(m) for f in criteria.values()))
+
+
+def ids(markets):
+    return [m.marketId for m in markets]
+
+
+def test_find():
+    catalog = MarketCatalog(MARKETS)
+    assert len(catalog) == len(MARKETS)
+    assert ids(catalog.find()) == scan()
+
+    market = [m for m in MARKETS if m.countryISO3 == "GBR"][100]
+    ancestor = market.eventHierarchy[-2]
+    start = market.marketTime
+    end = start + timedelta(days=1)
+    prefix = market.menuPath.rsplit("\\", 1)[0]
+
+    assert ids(catalog.find(ancestor=1)) == \
+        scan(a=lambda m: 1 in m.eventHierarchy)
+    found = ids(catalog.find(country="GBR", ancestor=ancestor))
+    assert market.marketId in found
+    assert found == scan(a=lambda m: ancestor in m.eventHierarchy[:-1],
+                         c=lambda m: m.countryISO3 == "GBR")
+    assert ids(catalog.find(start=start, end=end)) == \
+        scan(t=lambda m: start <= m.marketTime < end)
+    assert ids(catalog.find(menu_path=prefix)) == \
+        scan(p=lambda m: m.menuPath.startswith(prefix))
+    assert ids(catalog.find(turning_in_play=True, bsp=False)) == scan(
+        i=lambda m: m.turningInPlay, b=lambda m: not m.bspMarket)
+    assert market in catalog.find(ancestor=ancestor, start=start,
+                                  menu_path=prefix)
+
+
+def test_merge():
+    catalog = MarketCatalog(MARKETS)
+    newer = [copy.copy(m) for m in MARKETS[1:]]
+    for m in newer:
+        m.lastRefresh += timedelta(seconds=30)
+    moved = newer[0]
+    moved.marketTime = datetime(2030, 1, 1)
+    moved.countryISO3 = "XYZ"
+    added = copy.copy(MARKETS[0])
+    added.marketId = 1
+    stale = copy.copy(newer[1])
+    stale.lastRefresh -= timedelta(minutes=1)
+    stale.countryISO3 = "STALE"
+    newer[1] = stale
+
+    result = catalog.merge(newer + [added])
+    assert result[0] == [1]
+    assert len(result[1]) == len(newer) - 1
+    assert result[2] == [MARKETS[0].marketId]
+    assert ids(catalog.find(country="XYZ")) == [moved.marketId]
+    assert ids(catalog.find(start=datetime(2029, 1, 1))) == [moved.marketId]
+    assert catalog.find(country="STALE") == []
+    assert catalog.get(MARKETS[0].marketId) is None
+    assert catalog.get(moved.marketId) is moved
+
+    # Merging a filtered result does not remove markets.
+    assert catalog.merge([added], complete=False)[2] == []
+    assert len(catalog) == len(MARKETS)
+
+    # Markets whose lastRefresh did not change are not updated.
+    unchanged = [copy.copy(m) for m in newer]
+    assert catalog.merge(unchanged + [added]) == ([], [], [])
+    assert catalog.get(moved.marketId) is moved
+
+
+def test_small_merge_updates_sorted_indexes():
+    catalog = MarketCatalog(MARKETS)
+    catalog.find(start=datetime(2000, 1, 1))
+    moved = copy.copy(MARKETS[0])
+    moved.lastRefresh += timedelta(seconds=30)
+    moved.marketTime = datetime(2030, 1, 1)
+    moved.menuPath = "\\New"
+    catalog.merge([moved], complete=False)
+    assert ids(catalog.find(start=datetime(2029, 1, 1))) == [moved.marketId]
+    assert ids(catalog.find(menu_path="\\New")) == [moved.marketId]
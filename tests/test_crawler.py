@@ -0,0 +1,107 @@
+import pytest
+
+from bfair._types import Market
+from bfair.crawler import EventCrawler
+from bfair.session import Session
+from tests import fakes
+
+
+def make_tree():
+    # event id: (child event ids, market ids)
+    return {
+        1: ([10, 11], []),
+        10: ([100], [1000]),
+        11: ([], [1100]),
+        100: ([], [10000, 10001]),
+        2: ([20], []),
+        20: ([], [2000]),
+    }
+
+
+def paths(tree):
+    """Returns the event hierarchy of every market in `tree`."""
+    parents = dict((child, parent) for parent, (children, _) in tree.items()
+                   for child in children)
+    result = {}
+    for event_id, (_, market_ids) in tree.items():
+        path = [event_id]
+        while path[0] in parents:
+            path.insert(0, parents[path[0]])
+        for market_id in market_ids:
+            result[market_id] = [0] + path + [market_id]
+    return result
+
+
+def install(monkeypatch, tree):
+    def get_events(req, rsp):
+        children, market_ids = tree.get(req.eventParentId, ([], []))
+        rsp.eventParentId = req.eventParentId
+        rsp.couponLinks = None
+        rsp.eventItems = [[fakes.Obj(eventId=e, eventName=str(e))
+                           for e in children]]
+        rsp.marketItems = [[fakes.Obj(marketId=m,
+                                      eventParentId=req.eventParentId)
+                            for m in market_ids]]
+    service = fakes.FakeService(latency=0.02, getEvents=get_events)
+    fakes.install(monkeypatch, global_service=service)
+    return service
+
+
+def markets(tree):
+    return [Market(marketId=market_id, eventHierarchy=path)
+            for market_id, path in paths(tree).items()]
+
+
+def test_crawl(monkeypatch):
+    tree = make_tree()
+    service = install(monkeypatch, tree)
+    crawler = EventCrawler(Session("user", "password", thread_safe=True,
+                                   rate_limits={}), max_workers=4)
+    roots = crawler.crawl([1, 2])
+    assert [root.event_id for root in roots] == [1, 2]
+    assert sorted(crawler.nodes) == sorted(tree)
+    assert service.count("getEvents") == len(tree)
+    assert service.max_in_flight > 1
+    node = crawler.nodes[100]
+    assert node.parent.event_id == 10
+    assert node.event.eventName == "100"
+    assert [m.marketId for m in node.markets] == [10000, 10001]
+    assert sorted(m.marketId for _, m in crawler.iter_markets()) == \
+        sorted(paths(tree))
+
+
+def test_crawl_requires_thread_safe_session(monkeypatch):
+    tree = make_tree()
+    service = install(monkeypatch, tree)
+    session = Session("user", "password", rate_limits={})
+    with pytest.raises(ValueError):
+        EventCrawler(session)
+    crawler = EventCrawler(session, max_workers=1)
+    crawler.crawl([1, 2])
+    assert sorted(crawler.nodes) == sorted(tree)
+    assert service.max_in_flight == 1
+
+
+def test_recrawl(monkeypatch):
+    tree = make_tree()
+    service = install(monkeypatch, tree)
+    crawler = EventCrawler(Session("user", "password", thread_safe=True,
+                                   rate_limits={}), max_workers=4)
+    crawler.crawl([1, 2])
+    calls = service.count("getEvents")
+
+    assert crawler.recrawl(markets(tree)) == []
+    assert service.count("getEvents") == calls
+
+    tree[100][1].append(10002)
+    tree[1] = ([10, 12], [])
+    tree[12] = ([], [1200])
+    del tree[11]
+    visited = crawler.recrawl(markets(tree))
+    assert sorted(node.event_id for node in visited) == [1, 11, 12, 100]
+    assert service.count("getEvents") == calls + 4
+    assert sorted(crawler.nodes) == sorted(tree)
+    assert [m.marketId for m in crawler.nodes[100].markets] == \
+        [10000, 10001, 10002]
+    assert sorted(m.marketId for _, m in crawler.iter_markets()) == \
+        sorted(paths(tree))
@@ -0,0 +1,179 @@
+from bfair._types import (
+    CancelBetResult, MUBet, PlaceBet, PlaceBetResult, UpdateBetResult,
+)
+from bfair.positions import PositionTracker
+from bfair.session import Session
+from tests import fakes
+
+
+class Exchange(object):
+    """Bets as ``bet_id: [market_id, selection_id, bet_type, price,
+    unmatched, matches]`` with matches as ``(price, size)``.
+    """
+
+    def __init__(self):
+        self.bets = {
+            1: [10, 100, "B", 3.0, 5.0, [(3.0, 5.0)]],
+            2: [10, 101, "L", 2.0, 10.0, []],
+            3: [20, 200, "B", 1.5, 0.0, [(1.6, 4.0), (1.5, 6.0)]],
+        }
+
+    def service(self):
+        return fakes.FakeService(getMUBets=self.get_mu_bets,
+                                 getCurrentBetsLite=self.get_current_bets_lite,
+                                 getBetMatchesLite=self.get_bet_matches_lite)
+
+    def _select(self, req):
+        bet_ids = req.betIds.item if hasattr(req, "betIds") else []
+        return [(bet_id, bet) for bet_id, bet in sorted(self.bets.items())
+                if req.marketId in (0, bet[0]) and
+                (not bet_ids or bet_id in bet_ids)]
+
+    def get_mu_bets(self, req, rsp):
+        records = []
+        for bet_id, (market_id, selection_id, bet_type, price, unmatched,
+                     matches) in self._select(req):
+            common = dict(betId=bet_id, marketId=market_id,
+                          selectionId=selection_id, betType=bet_type)
+            for i, (p, size) in enumerate(matches):
+                records.append(fakes.Obj(betStatus="M", price=p, size=size,
+                                         transactionId=i, **common))
+            if unmatched:
+                records.append(fakes.Obj(betStatus="U", price=price,
+                                         size=unmatched, **common))
+        rsp.totalRecordCount = len(records)
+        rsp.bets = [records[req.startRecord:
+                            req.startRecord + req.recordCount]]
+
+    def get_current_bets_lite(self, req, rsp):
+        lites = [fakes.Obj(betId=bet_id, marketId=bet[0], betStatus="U",
+                           matchedSize=sum(s for _, s in bet[5]),
+                           remainingSize=bet[4])
+                 for bet_id, bet in self._select(req) if bet[4]]
+        rsp.totalRecordCount = len(lites)
+        rsp.betLites = [lites[req.startRecord:
+                              req.startRecord + req.recordCount]]
+
+    def get_bet_matches_lite(self, req, rsp):
+        rsp.matchLites = [[fakes.Obj(betStatus="M", priceMatched=p,
+                                     sizeMatched=s, transactionId=i)
+                           for i, (p, s) in
+                           enumerate(self.bets[req.betId][5])]]
+
+
+def install(monkeypatch, exchange):
+    _, service = fakes.install(monkeypatch, exchange_service=exchange.service())
+    session = Session("user", "password", rate_limits={})
+    return session, service
+
+
+def test_get_matched_and_unmatched_bets(monkeypatch):
+    exchange = Exchange()
+    session, service = install(monkeypatch, exchange)
+    bets = session.get_matched_and_unmatched_bets(record_count=2)
+    assert [(b.betId, b.betStatus) for b in bets] == \
+        [(1, "M"), (1, "U"), (2, "U"), (3, "M"), (3, "M")]
+    assert all(isinstance(b, MUBet) for b in bets)
+    assert service.count("getMUBets") == 3
+    assert len(session.get_current_bets_lite(market_id=10)) == 2
+    assert [m.sizeMatched for m in session.get_bet_matches_lite(3)] == \
+        [4.0, 6.0]
+
+
+def test_refresh(monkeypatch):
+    session, _ = install(monkeypatch, Exchange())
+    tracker = PositionTracker(session)
+    tracker.refresh()
+    assert len(tracker) == 3
+    back = tracker.position(10, 100)
+    assert (back.matched_back, back.unmatched_back) == (5.0, 5.0)
+    assert (back.if_win, back.if_lose) == (10.0, -5.0)
+    lay = tracker.position(10, 101)
+    assert (lay.unmatched_lay, lay.unmatched_liability) == (10.0, 10.0)
+    market = tracker.position(10)
+    assert market.liability == 5.0 + 5.0 + 10.0
+    assert abs(tracker.position(20).if_win - (4.0 * 0.6 + 6.0 * 0.5)) < 1e-9
+    assert tracker.position(30).liability == 0.0
+
+
+def test_own_results():
+    tracker = PositionTracker()
+    market = tracker.position(10)
+    bets = [PlaceBet(marketId=10, selectionId=100, betType="L", price=4.0,
+                     size=10.0),
+            PlaceBet(marketId=10, selectionId=100, betType="B", price=2.0,
+                     size=10.0)]
+    tracker.placed(bets, [
+        PlaceBetResult(betId=1, averagePriceMatched=4.0, sizeMatched=2.0,
+                       success=True),
+        PlaceBetResult(resultCode="MARKET_STATUS_INVALID", success=False)])
+    assert len(tracker) == 1
+    position = tracker.position(10, 100)
+    assert (position.matched_lay, position.unmatched_lay) == (2.0, 8.0)
+    assert position.liability == 2.0 * 3 + 8.0 * 3
+    # Positions that were handed out before the first bet are kept up to
+    # date.
+    assert market is tracker.position(10)
+    assert market.liability == position.liability
+
+    tracker.updated([UpdateBetResult(betId=1, newBetId=2, newPrice=5.0,
+                                     newSize=8.0, sizeCancelled=8.0,
+                                     success=True)])
+    assert tracker.bet(1).unmatched == 0.0
+    assert tracker.bet(2).price == 5.0
+    assert position.liability == 2.0 * 3 + 8.0 * 4
+
+    tracker.cancelled([CancelBetResult(betId=2, sizeCancelled=5.0,
+                                       sizeMatched=3.0, success=True)])
+    assert (position.matched_lay, position.unmatched_lay) == (5.0, 0.0)
+    assert position.matched_liability == 2.0 * 3 + 3.0 * 4
+    assert tracker.position(10).matched_liability == \
+        position.matched_liability
+
+
+def test_update(monkeypatch):
+    exchange = Exchange()
+    session, service = install(monkeypatch, exchange)
+    tracker = PositionTracker(session)
+    tracker.refresh()
+
+    # Bet 1 is matched completely, bet 2 partly and bet 4 is placed
+    # elsewhere.
+    exchange.bets[1][4:] = [0.0, [(3.0, 5.0), (3.2, 5.0)]]
+    exchange.bets[2][4:] = [6.0, [(2.0, 4.0)]]
+    exchange.bets[4] = [20, 201, "L", 3.0, 2.0, []]
+    changed = tracker.update()
+    assert sorted(changed) == [1, 2, 4]
+    assert service.count("getBetMatchesLite") == 2
+
+    position = tracker.position(10, 100)
+    assert (position.matched_back, position.unmatched_back) == (10.0, 0.0)
+    assert abs(position.if_win - (5.0 * 2.0 + 5.0 * 2.2)) < 1e-9
+    position = tracker.position(10, 101)
+    assert (position.matched_lay, position.unmatched_lay) == (4.0, 6.0)
+    assert tracker.position(20, 201).unmatched_liability == 4.0
+
+    # Nothing changed.
+    assert tracker.update() == []
+    assert service.count("getBetMatchesLite") == 2
+
+
+def test_update_keeps_bets_placed_during_the_request(monkeypatch):
+    exchange = Exchange()
+    session, _ = install(monkeypatch, exchange)
+    tracker = PositionTracker(session)
+    tracker.refresh()
+    get_current_bets_lite = session.get_current_bets_lite
+
+    def place_during_request(**kwargs):
+        lites = get_current_bets_lite(**kwargs)
+        # Placed after the exchange answered, so it is not among `lites`.
+        bet = PlaceBet(marketId=10, selectionId=102, betType="B", price=2.0,
+                       size=4.0)
+        tracker.placed([bet], [PlaceBetResult(betId=9, sizeMatched=0.0,
+                                              success=True)])
+        return lites
+    session.get_current_bets_lite = place_during_request
+    assert tracker.update() == []
+    assert tracker.bet(9).unmatched == 4.0
+    assert tracker.position(10, 102).unmatched_back == 4.0
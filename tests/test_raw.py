@@ -0,0 +1,155 @@
+import threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from os import path
+from xml.sax.saxutils import escape
+
+import pytest
+
+from suds import WebFault
+from suds.transport import TransportError
+
+from bfair import _raw
+from bfair.session import ServiceError, Session
+from tests import fakes
+
+
+DATA_DIR = path.join(path.dirname(__file__), "data")
+
+RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    xmlns:n2="http://www.betfair.com/publicapi/types/exchange/v5/">
+<soap:Body>
+<n:getMarketPricesCompressedResponse
+    xmlns:n="http://www.betfair.com/publicapi/v5/BFExchangeService/">
+<n:Result xsi:type="n2:GetMarketPricesCompressedResp">
+<header xsi:type="n2:APIResponseHeader">
+<errorCode xsi:type="n2:APIErrorEnum">OK</errorCode>
+<minorErrorCode xsi:nil="1"></minorErrorCode>
+<sessionToken xsi:type="xsd:string">%(token)s</sessionToken>
+<timestamp xsi:type="xsd:dateTime">2011-10-13T20:54:54.326Z</timestamp>
+</header>
+<errorCode xsi:type="n2:GetMarketPricesErrorEnum">%(error)s</errorCode>
+<minorErrorCode xsi:nil="1"></minorErrorCode>
+<marketPrices xsi:type="xsd:string">%(prices)s</marketPrices>
+</n:Result>
+</n:getMarketPricesCompressedResponse>
+</soap:Body>
+</soap:Envelope>"""
+
+FAULT = """<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+<soap:Body><soap:Fault><faultcode>soap:Server</faultcode>
+<faultstring>Internal error</faultstring></soap:Fault></soap:Body>
+</soap:Envelope>"""
+
+with open(path.join(DATA_DIR, "market_prices.dump")) as f:
+    MARKET_PRICES = f.readline().strip()
+ESCAPED_PRICES = escape(MARKET_PRICES)
+
+
+class Header(object):
+    clientStamp = 0
+    sessionToken = "abc<&>"
+
+
+def test_render():
+    xml = _raw.getMarketPricesCompressed.render(Header(), marketId=12,
+                                                currencyCode=None)
+    assert "<sessionToken>abc&lt;&amp;&gt;</sessionToken>" in xml
+    assert "<marketId>12</marketId>" in xml
+    assert "currencyCode" not in xml
+
+    xml = _raw.getAllMarkets.render(Header(), eventTypeIds=[1, 7],
+                                    countries=["GBR"])
+    assert "<eventTypeIds><int>1</int><int>7</int></eventTypeIds>" in xml
+    assert "<countries><Country>GBR</Country></countries>" in xml
+    assert "fromDate" not in xml
+
+
+def test_parse():
+    rsp = _raw.getMarketPricesCompressed.parse(RESPONSE % dict(
+        token="new-token", error="OK", prices=ESCAPED_PRICES))
+    assert rsp.errorCode == "OK"
+    assert rsp.minorErrorCode is None
+    assert rsp.marketPrices == MARKET_PRICES
+    assert rsp.header.errorCode == "OK"
+    assert rsp.header.sessionToken == "new-token"
+    assert rsp.fault is None
+
+    rsp = _raw.getMarketPricesCompressed.parse(FAULT)
+    assert rsp.fault.faultstring == "Internal error"
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    responses_ = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        status, body = self.responses_.pop(0)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server(monkeypatch):
+    fakes.install(monkeypatch)
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setattr(_raw, "BFExchangeServiceEndpoint",
+                        "http://127.0.0.1:%d/" % server.server_address[1])
+    Handler.responses_ = []
+    yield Handler.responses_
+    server.shutdown()
+    server.server_close()
+
+
+def test_session_raw_xml(server):
+    session = Session("user", "password", raw_xml=True)
+    server.append((200, RESPONSE % dict(token="t1", error="OK",
+                                        prices=ESCAPED_PRICES)))
+    prices = session.get_market_prices(97383)
+    assert prices.marketId == 97383
+    assert len(prices.runnerPrices) == 61
+    assert session._request_header.sessionToken == "t1"
+
+    server.append((200, RESPONSE % dict(token="t2", error="INVALID_MARKET",
+                                        prices="")))
+    with pytest.raises(ServiceError):
+        session.get_market_prices(1)
+    assert session._request_header.sessionToken == "t2"
+
+    server.append((500, FAULT))
+    with pytest.raises(WebFault):
+        session.get_market_prices(1)
+
+
+def test_session_raw_xml_http_error(server):
+    session = Session("user", "password", raw_xml=True)
+    page = "<html><body><h1>503 Service Unavailable</h1></body>"
+    server.append((503, page))
+    with pytest.raises(TransportError) as e:
+        session.get_market_prices(1)
+    assert e.value.httpcode == 503
+    assert e.value.fp.read() == page
+
+    server.append((500, page))
+    with pytest.raises(TransportError) as e:
+        session.get_market_prices(1)
+    assert e.value.httpcode == 500
@@ -14,12 +14,42 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import os
 import pytest
+import socket
+import threading
+import time
 from datetime import datetime
 from itertools import izip
-from bfair.session import ServiceError
+from os import path
+from bfair.cache import MetadataCache, MetadataStore
+from bfair.session import AsyncSession, HeartBeatScheduler, ServiceError, \
+    Session, SessionPool, heartbeat_scheduler
+from bfair._util import uncompress_markets
 
 from bfair._types import *
+from tests import fakes
+
+
+DATA_DIR = path.join(path.dirname(__file__), "data")
+
+with open(path.join(DATA_DIR, "market_prices.dump")) as f:
+    MARKET_PRICES = [line.strip() for line in f]
+
+
+def market_prices_handler(req, rsp):
+    rsp.marketPrices = MARKET_PRICES[req.marketId % len(MARKET_PRICES)]
+
+
+def place_bets_handler(req, rsp):
+    bets = req.bets.item
+    if any(bet.marketId == 13 for bet in bets):
+        rsp.errorCode = "MARKET_STATUS_INVALID"
+        return
+    rsp.betResults = [[fakes.Obj(averagePriceMatched=0.0,
+                                 betId=bet.selectionId, resultCode="OK",
+                                 sizeMatched=0.0, success=True)
+                       for bet in bets]]
 
 
 def test_logout_and_keepalive(session):
@@ -396,3 +426,636 @@ def assert_market_traded_volume(volume):
         assert isinstance(priceitem.totalBspBackMatchedAmount, float)
         assert isinstance(priceitem.totalBspMatchedAmount, float)
         assert isinstance(priceitem.reconciled, bool)
+
+
+def test_async_session(monkeypatch):
+    _, exchange = fakes.install(
+        monkeypatch,
+        exchange_service=fakes.FakeService(
+            latency=0.05, getMarketPricesCompressed=market_prices_handler))
+    session = Session("user", "password", thread_safe=True)
+    with AsyncSession(session, max_workers=10) as pending:
+        results = [pending.get_market_prices(i) for i in range(20)]
+        prices = [r.get(timeout=10) for r in results]
+    assert [p.marketId for p in prices] == \
+           [int(MARKET_PRICES[i % 10].split("~")[0]) for i in range(20)]
+    assert exchange.max_in_flight > 1
+
+
+def test_async_session_error(monkeypatch):
+    def fail(req, rsp):
+        rsp.errorCode = "INVALID_MARKET"
+    fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        getMarketPricesCompressed=fail))
+    with AsyncSession(Session("user", "password",
+                              thread_safe=True)) as pending:
+        result = pending.get_market_prices(1)
+        with pytest.raises(ServiceError):
+            result.get(timeout=10)
+
+
+def test_async_session_requires_thread_safe_session(monkeypatch):
+    fakes.install(monkeypatch)
+    session = Session("user", "password")
+    with pytest.raises(ValueError):
+        AsyncSession(session)
+    with pytest.raises(ValueError):
+        AsyncSession(SessionPool([session]))
+    AsyncSession(session, max_workers=1).close()
+
+
+def test_get_market_prices_many(monkeypatch):
+    headers = []
+
+    def handler(req, rsp):
+        headers.append(req.header)
+        if req.marketId == 3:
+            rsp.errorCode = "INVALID_MARKET"
+        else:
+            market_prices_handler(req, rsp)
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        latency=0.05, getMarketPricesCompressed=handler))
+    session = Session("user", "password")
+    prices, errors = session.get_market_prices_many(range(10), max_workers=5)
+    assert sorted(prices) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert prices[1].marketId == int(MARKET_PRICES[1].split("~")[0])
+    assert list(errors) == [3]
+    assert isinstance(errors[3], ServiceError)
+    assert exchange.max_in_flight == 5
+    # The session is not thread safe, but the workers have their own headers.
+    assert all(header is not session._request_header for header in headers)
+
+
+def test_get_market_prices_many_deadline(monkeypatch):
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        latency=0.5, getMarketPricesCompressed=market_prices_handler))
+    session = Session("user", "password")
+    t0 = time.time()
+    prices, errors = session.get_market_prices_many(
+        range(4), max_workers=2, deadline=time.time() + 0.1)
+    assert time.time() - t0 < 0.4
+    assert prices == {}
+    assert sorted(errors) == [0, 1, 2, 3]
+    assert errors[0].args == ("DEADLINE_EXCEEDED",)
+    time.sleep(0.5)
+    # Requests that were queued at the deadline are never sent.
+    assert exchange.count("getMarketPricesCompressed") == 2
+
+
+def test_thread_safe_session_stress(monkeypatch):
+    lock = threading.Lock()
+    in_flight = set()
+    shared, tokens = [], []
+
+    def handler(req, rsp):
+        header = req.header
+        with lock:
+            if id(header) in in_flight:
+                shared.append(header)
+            in_flight.add(id(header))
+            tokens.append(header.sessionToken)
+        time.sleep(0.001)
+        with lock:
+            in_flight.discard(id(header))
+        market_prices_handler(req, rsp)
+
+    global_service, exchange = fakes.install(
+        monkeypatch, exchange_service=fakes.FakeService(
+            latency=0.001, getMarketPricesCompressed=handler))
+    session = Session("user", "password", thread_safe=True, rate_limits={})
+    session.login()
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(50):
+                prices = session.get_market_prices(n + i)
+                assert prices.marketId == \
+                    int(MARKET_PRICES[(n + i) % 10].split("~")[0])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    session.logout()
+
+    assert not errors
+    assert not shared
+    assert exchange.count("getMarketPricesCompressed") == 16 * 50
+    assert exchange.max_in_flight > 1
+    issued = set("token-%d" % i for i in range(1, len(exchange.calls) + 1))
+    assert set(tokens) <= issued
+    assert session._request_header.sessionToken is None
+
+
+def test_stale_token_is_ignored(monkeypatch):
+    fakes.install(monkeypatch)
+    session = Session("user", "password")
+    rsp = lambda token: fakes.Obj(header=fakes.Obj(sessionToken=token))
+    session._update_token(rsp("new"), 2)
+    session._update_token(rsp("old"), 1)
+    assert session._request_header.sessionToken == "new"
+    session._update_token(rsp("newer"), 3)
+    assert session._request_header.sessionToken == "newer"
+
+
+def test_rate_limits(monkeypatch):
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        getMarketPricesCompressed=market_prices_handler))
+    session = Session("user", "password",
+                      rate_limits={"getMarketPricesCompressed": (2, 0.2)})
+    t0 = time.time()
+    for i in range(3):
+        session.get_market_prices(i)
+    assert time.time() - t0 >= 0.09
+    stats = session.rate_limiter.stats()
+    assert stats["calls"] == 3
+    assert stats["delayed"] == 1
+    assert stats["wait_time"] >= 0.09
+
+
+def test_coalesce(monkeypatch):
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        latency=0.05, getMarketPricesCompressed=market_prices_handler))
+    session = Session("user", "password", thread_safe=True, coalesce=True)
+    with AsyncSession(session, max_workers=8) as pending:
+        results = [pending.get_market_prices(1) for _ in range(8)]
+        prices = [r.get(timeout=10) for r in results]
+    assert all(p is prices[0] for p in prices)
+    assert exchange.count("getMarketPricesCompressed") < 8
+    assert session.single_flight.shared == 8 - session.single_flight.calls
+    session.get_market_prices(2)
+    assert exchange.count("getMarketPricesCompressed") == \
+        session.single_flight.calls
+
+
+def test_freshness(monkeypatch):
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        getMarketPricesCompressed=market_prices_handler))
+    session = Session("user", "password", freshness=0.1)
+    first = session.get_market_prices(1)
+    assert session.get_market_prices(1) is first
+    assert session.get_market_prices(2) is not first
+    assert exchange.count("getMarketPricesCompressed") == 2
+    time.sleep(0.11)
+    assert session.get_market_prices(1) is not first
+    assert exchange.count("getMarketPricesCompressed") == 3
+
+
+def test_metadata_cache(monkeypatch):
+    status = ["ACTIVE"]
+
+    def market_info(req, rsp):
+        rsp.marketLite = fakes.Obj(marketStatus="ACTIVE", delay=0)
+
+    def market_prices(req, rsp):
+        market_prices_handler(req, rsp)
+        rsp.marketPrices = rsp.marketPrices.replace("ACTIVE", status[0], 1)
+
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        getMarketInfo=market_info, getMarketPricesCompressed=market_prices))
+    session = Session("user", "password", metadata_cache=MetadataCache())
+    info = session.get_market_info_lite(1)
+    assert session.get_market_info_lite(1) is info
+    assert exchange.count("getMarketInfo") == 1
+
+    session.get_market_prices(1)
+    assert session.get_market_info_lite(1) is info
+    status[0] = "SUSPENDED"
+    assert session.get_market_prices(1).marketStatus == "SUSPENDED"
+    assert session.get_market_info_lite(1) is not info
+    assert exchange.count("getMarketInfo") == 2
+    stats = session.metadata_cache.stats()
+    assert (stats["hits"], stats["misses"]) == (2, 2)
+
+
+def test_metadata_store_warm_restart(monkeypatch, tmpdir):
+    with open(path.join(DATA_DIR, "markets.dump")) as f:
+        market_data = ":".join(f.read().split(":")[:4])
+
+    def all_markets(req, rsp):
+        rsp.marketData = market_data
+
+    def new_session(ttl):
+        cache = MetadataCache(ttls={"get_markets": ttl},
+                              store=MetadataStore(str(tmpdir.join("md.db"))))
+        exchange = fakes.FakeService(latency=0.05, getAllMarkets=all_markets)
+        fakes.install(monkeypatch, exchange_service=exchange)
+        return Session("user", "password", metadata_cache=cache), exchange
+
+    session, exchange = new_session(60)
+    markets = session.get_markets()
+    assert len(markets) == 3
+    assert exchange.count("getAllMarkets") == 1
+
+    # Fresh results are served from disk.
+    session, exchange = new_session(60)
+    assert [m.marketId for m in session.get_markets()] == \
+        [m.marketId for m in markets]
+    assert exchange.count("getAllMarkets") == 0
+
+    # Expired results are served from disk and refreshed in the background.
+    time.sleep(0.02)
+    session, exchange = new_session(0.01)
+    t0 = time.time()
+    assert len(session.get_markets()) == 3
+    assert time.time() - t0 < 0.05
+    for _ in range(100):
+        if session.metadata_cache.stats()["entries"]:
+            break
+        time.sleep(0.01)
+    assert exchange.count("getAllMarkets") == 1
+    assert session.metadata_cache.stats()["entries"] == 1
+
+
+def market_records():
+    with open(path.join(DATA_DIR, "markets.dump")) as f:
+        records = uncompress_markets.separator.split(f.readline().strip())
+    return [(r, uncompress_markets.decode(r)) for r in records if r][:2000]
+
+
+def all_markets_handler(records):
+    def all_markets(req, rsp):
+        ids = req.eventTypeIds[0]
+        start = getattr(req, "fromDate", None)
+        end = getattr(req, "toDate", None)
+        rsp.marketData = ":" + ":".join(
+            r for r, m in records
+            if (not ids or m.eventHierarchy[1] in ids) and
+            (start is None or m.marketTime >= start) and
+            (end is None or m.marketTime <= end))
+    return all_markets
+
+
+def test_get_markets_sharded(monkeypatch):
+    records = market_records()
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        getAllMarkets=all_markets_handler(records)))
+    session = Session("user", "password", thread_safe=True, rate_limits={})
+
+    everything = [m.marketId for m in session.get_markets()]
+    assert everything == [m.marketId for _, m in records]
+
+    event_ids = sorted(set(m.eventHierarchy[1] for _, m in records))
+    markets = session.get_markets(event_ids, split_event_types=True)
+    assert sorted(m.marketId for m in markets) == sorted(everything)
+    assert exchange.count("getAllMarkets") == 1 + len(event_ids)
+
+    times = sorted(m.marketTime for _, m in records)
+    date_range = (times[10], times[-10])
+    expected = session.get_markets(date_range=date_range)
+    assert exchange.calls[-1][1].toDate == times[-10]
+    markets = session.get_markets(event_ids, date_range=date_range,
+                                  windows=5, split_event_types=True)
+    assert sorted(m.marketId for m in markets) == \
+        sorted(m.marketId for m in expected)
+    assert len(markets) == len(set(m.marketId for m in markets))
+
+    with pytest.raises(ValueError):
+        session.get_markets(windows=2)
+
+
+def test_get_markets_reuse_unchanged(monkeypatch):
+    records = market_records()[:200]
+    fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        getAllMarkets=all_markets_handler(records)))
+    session = Session("user", "password", reuse_unchanged=True,
+                      rate_limits={})
+    times = sorted(m.marketTime for _, m in records)
+    early, late = (times[0], times[50]), (times[50], times[-1])
+    markets = session.get_markets(date_range=early)
+    assert session.get_markets(date_range=late) != markets
+    # Each date range is compared with its own previous payload.
+    assert session.get_markets(date_range=early) is markets
+    cache = session.payload_cache
+    assert (cache.hits, cache.misses, len(cache)) == (1, 2, 2)
+
+
+def test_get_markets_reuse_unchanged_windows(monkeypatch):
+    records = market_records()[:200]
+    headers = []
+
+    def all_markets(req, rsp):
+        headers.append(req.header)
+        handler(req, rsp)
+    handler = all_markets_handler(records)
+    fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        getAllMarkets=all_markets))
+    session = Session("user", "password", reuse_unchanged=True,
+                      rate_limits={})
+    times = sorted(m.marketTime for _, m in records)
+    date_range = (times[0], times[-1])
+    markets = session.get_markets(date_range=date_range, windows=4)
+    # Every window is cached under its own key and found again.
+    assert session.get_markets(date_range=date_range, windows=4) == markets
+    cache = session.payload_cache
+    assert (cache.hits, cache.misses, len(cache)) == (4, 4, 4)
+    assert all(header is not session._request_header for header in headers)
+
+
+def test_heartbeat_scheduler_is_shared(monkeypatch):
+    fakes.install(monkeypatch)
+    active = len(heartbeat_scheduler)
+    sessions = [Session("user", "password") for _ in range(20)]
+    for session in sessions:
+        session.login()
+    assert len(heartbeat_scheduler) == active + 20
+    threads = [t for t in threading.enumerate()
+               if t.name == "HeartBeatScheduler"]
+    assert len(threads) == 1
+    for session in sessions:
+        session.logout()
+    assert len(heartbeat_scheduler) == active
+
+
+def test_heartbeat_scheduler_keep_alive():
+    calls = []
+    scheduler = HeartBeatScheduler()
+    # Intervals are in minutes.
+    idle = scheduler.start(lambda: calls.append("idle"), interval=0.001)
+    busy = scheduler.start(lambda: calls.append("busy"), interval=0.005)
+    t0 = time.time()
+    while time.time() - t0 < 0.5:
+        busy.reset()
+        time.sleep(0.01)
+    idle.stop()
+    busy.stop()
+    assert calls.count("idle") > 2
+    assert "busy" not in calls
+
+
+def test_session_pool(monkeypatch):
+    _, exchange = fakes.install(
+        monkeypatch,
+        exchange_service=fakes.FakeService(
+            latency=0.05, getMarketPricesCompressed=market_prices_handler))
+    pool = SessionPool([Session("user", "password", thread_safe=True,
+                                rate_limits={}) for _ in range(4)])
+    with pytest.raises(ServiceError):
+        pool.get_market_prices(1)
+    pool.login()
+    with AsyncSession(pool, max_workers=8) as pending:
+        results = [pending.get_market_prices(i) for i in range(16)]
+        prices = [r.get(timeout=10) for r in results]
+    assert len(prices) == 16
+    assert exchange.max_in_flight > 4
+    calls = [calls for _, calls in pool.stats()]
+    assert sum(calls) == 16
+    assert min(calls) >= 2
+    pool.logout()
+
+    with pytest.raises(ValueError):
+        SessionPool([Session("user", "password"), Session("other", "password")])
+
+
+def test_token_file(monkeypatch, tmpdir):
+    token_file = str(tmpdir.join("token.json"))
+    global_service, _ = fakes.install(monkeypatch)
+    session = Session("user", "password", token_file=token_file)
+    session.login()
+    token = session._request_header.sessionToken
+    assert global_service.count("login") == 1
+    assert os.stat(token_file).st_mode & 0777 == 0600
+    session._heartbeat.stop()
+
+    # A new process resumes the saved session without logging in.
+    restarted = Session("user", "password", token_file=token_file,
+                        thread_safe=True)
+    restarted.login()
+    assert global_service.count("login") == 1
+    assert global_service.calls[-1][0] == "keepAlive"
+    assert global_service.calls[-1][1].header.sessionToken == token
+    restarted.logout()
+    assert not tmpdir.join("token.json").check()
+
+    # An expired saved session is replaced by a new login.
+    def no_session(req, rsp):
+        rsp.header.errorCode = "NO_SESSION"
+    global_service, _ = fakes.install(
+        monkeypatch, global_service=fakes.FakeService(keepAlive=no_session))
+    session = Session("user", "password", token_file=token_file)
+    session.login()
+    session._heartbeat.stop()
+    restarted = Session("user", "password", token_file=token_file)
+    restarted.login()
+    assert global_service.count("login") == 2
+    restarted.logout()
+
+
+def test_standby_session(monkeypatch):
+    expired = set()
+
+    def handler(req, rsp):
+        if req.header.sessionToken in expired:
+            rsp.header.errorCode = "NO_SESSION"
+            rsp.errorCode = "API_ERROR"
+        else:
+            market_prices_handler(req, rsp)
+    global_service, exchange = fakes.install(
+        monkeypatch, exchange_service=fakes.FakeService(
+            getMarketPricesCompressed=handler))
+    session = Session("user", "password", standby=True, thread_safe=True)
+    session.login()
+    t0 = time.time()
+    while not session._standby.is_active and time.time() - t0 < 5:
+        time.sleep(0.01)
+    standby_token = session._standby._request_header.sessionToken
+    assert global_service.count("login") == 2
+
+    expired.add(session._request_header.sessionToken)
+    prices = session.get_market_prices(1)
+    assert prices.marketId == int(MARKET_PRICES[1].split("~")[0])
+    assert exchange.calls[-1][1].header.sessionToken == standby_token
+    assert exchange.count("getMarketPricesCompressed") == 2
+    # A new standby is logged in for the next expiry.
+    t0 = time.time()
+    while global_service.count("login") < 3 and time.time() - t0 < 5:
+        time.sleep(0.01)
+    assert global_service.count("login") == 3
+    session.logout()
+
+
+def test_place_bets_chunked(monkeypatch):
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        latency=0.05, placeBets=place_bets_handler))
+    session = Session("user", "password", thread_safe=True, rate_limits={})
+    sizes = {1: 100, 2: 30, 3: 20}
+    bets = [PlaceBet(marketId=market_id, selectionId=market_id * 1000 + i,
+                     price=2.0, size=2.0)
+            for i in range(100) for market_id in sizes if i < sizes[market_id]]
+    results = session.place_bets(bets)
+    assert [r.betId for r in results] == [b.selectionId for b in bets]
+    assert all(isinstance(r, PlaceBetResult) and r.success for r in results)
+    requests = [req for op, req in exchange.calls if op == "placeBets"]
+    assert sorted(len(req.bets.item) for req in requests) == [20, 30, 40, 60]
+    for req in requests:
+        assert len(set(bet.marketId for bet in req.bets.item)) == 1
+    assert exchange.max_in_flight > 1
+    stats = session.bet_latency.stats()["placeBets"]
+    assert stats["requests"] == 4
+    assert stats["items"] == 150
+    assert stats["mean_time"] >= 0.05
+
+    # Bets of a failed request get a failed result.
+    bets = [PlaceBet(marketId=13, selectionId=1, price=2.0, size=2.0),
+            PlaceBet(marketId=1, selectionId=2, price=2.0, size=2.0)]
+    results = session.place_bets(bets)
+    assert [r.resultCode for r in results] == ["MARKET_STATUS_INVALID", "OK"]
+    assert [r.success for r in results] == [False, True]
+    with pytest.raises(ServiceError):
+        session.place_bets(bets[:1])
+
+
+def test_place_bets_transport_error(monkeypatch):
+    def handler(req, rsp):
+        if req.bets.item[0].marketId == 2:
+            raise socket.timeout("timed out")
+        place_bets_handler(req, rsp)
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        placeBets=handler))
+    session = Session("user", "password", thread_safe=True, rate_limits={})
+    bets = [PlaceBet(marketId=market_id, selectionId=i, price=2.0, size=2.0)
+            for i, market_id in enumerate([1, 2, 1])]
+    results = session.place_bets(bets)
+    assert exchange.count("placeBets") == 2
+    assert [r.success for r in results] == [True, False, True]
+    assert [r.betId for r in results] == [0, None, 2]
+    assert results[1].resultCode == "timeout"
+    with pytest.raises(socket.timeout):
+        session.place_bets(bets[1:2])
+
+
+def test_place_bets_default_session(monkeypatch):
+    headers = []
+
+    def handler(req, rsp):
+        headers.append((req.header, req.header.sessionToken))
+        place_bets_handler(req, rsp)
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        latency=0.05, placeBets=handler))
+    session = Session("user", "password", rate_limits={})
+    session._request_header.sessionToken = "token"
+    bets = [PlaceBet(marketId=market_id, selectionId=market_id, price=2.0,
+                     size=2.0) for market_id in [1, 2, 3]]
+    results = session.place_bets(bets)
+    assert [r.betId for r in results] == [1, 2, 3]
+    assert exchange.max_in_flight == 3
+    # Concurrent chunks do not share the request header of the session.
+    assert len(set(id(header) for header, _ in headers)) == 3
+    assert all(header is not session._request_header
+               for header, _ in headers)
+    assert [token for _, token in headers] == ["token"] * 3
+    assert session._header() is session._request_header
+
+
+def test_cancel_and_update_bets(monkeypatch):
+    def cancel_bets(req, rsp):
+        bets = req.bets.item
+        if any(bet.betId == 13 for bet in bets):
+            rsp.errorCode = "API_ERROR"
+            rsp.header.errorCode = "INTERNAL_ERROR"
+            return
+        # Results do not have to be in the order of the request.
+        rsp.betResults = [[fakes.Obj(betId=bet.betId,
+                                     resultCode="REMAINING_CANCELLED",
+                                     sizeCancelled=2.0, sizeMatched=0.0,
+                                     success=True)
+                           for bet in reversed(bets)]]
+
+    def update_bets(req, rsp):
+        rsp.betResults = [[fakes.Obj(betId=bet.betId, newBetId=bet.betId + 1,
+                                     newPrice=bet.newPrice, newSize=2.0,
+                                     resultCode="OK", sizeCancelled=0.0,
+                                     success=True)
+                           for bet in req.bets.item]]
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        latency=0.05, cancelBets=cancel_bets, updateBets=update_bets))
+    session = Session("user", "password", thread_safe=True, rate_limits={})
+
+    results = session.cancel_bets(range(100, 200))
+    assert [r.betId for r in results] == range(100, 200)
+    assert all(isinstance(r, CancelBetResult) and r.success for r in results)
+    assert sorted(len(req.bets.item) for _, req in exchange.calls) == \
+        [20, 40, 40]
+    assert exchange.max_in_flight == 3
+
+    # Partial failures are reported per bet.
+    results = session.cancel_bets([CancelBet(betId=i) for i in range(45)])
+    assert [r.success for r in results] == [False] * 40 + [True] * 5
+    assert results[0].resultCode == "INTERNAL_ERROR"
+    assert results[0].betId == 0
+
+    bets = [UpdateBet(betId=i, newPrice=3.0, oldPrice=2.0, newSize=2.0,
+                      oldSize=2.0) for i in range(0, 40, 2)]
+    results = session.update_bets(bets)
+    assert [r.newBetId for r in results] == range(1, 41, 2)
+    assert sorted(len(req.bets.item) for op, req in exchange.calls
+                  if op == "updateBets") == [5, 15]
+    assert session.bet_latency.stats()["updateBets"]["items"] == 20
+
+
+def test_cancel_all(monkeypatch):
+    def cancel_bets_by_market(req, rsp):
+        market_id, = req.markets.item
+        if market_id == 13:
+            rsp.errorCode = "MARKET_STATUS_INVALID"
+            return
+        if market_id == 14:
+            raise socket.error(104, "Connection reset by peer")
+        rsp.results = [[fakes.Obj(marketId=market_id, resultCode="OK")]]
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        latency=0.05, cancelBetsByMarket=cancel_bets_by_market))
+    session = Session("user", "password", thread_safe=True, rate_limits={})
+    market_ids = [1, 13, 2, 14, 3, 4]
+    t0 = time.time()
+    results = session.cancel_all(market_ids)
+    assert time.time() - t0 < 0.25
+    assert [r.marketId for r in results] == market_ids
+    assert [r.resultCode for r in results] == \
+        ["OK", "MARKET_STATUS_INVALID", "OK", "error", "OK", "OK"]
+    assert exchange.max_in_flight == 6
+    with pytest.raises(ServiceError):
+        session.cancel_all([13])
+    with pytest.raises(socket.error):
+        session.cancel_all([14])
+
+
+def test_cancel_all_default_session(monkeypatch):
+    headers = []
+
+    def cancel_bets_by_market(req, rsp):
+        headers.append(req.header)
+        market_id, = req.markets.item
+        rsp.results = [[fakes.Obj(marketId=market_id, resultCode="OK")]]
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        latency=0.05, cancelBetsByMarket=cancel_bets_by_market))
+    session = Session("user", "password", rate_limits={})
+    results = session.cancel_all([1, 2, 3, 4])
+    assert [r.resultCode for r in results] == ["OK"] * 4
+    assert exchange.max_in_flight == 4
+    assert len(set(id(header) for header in headers)) == 4
+    assert all(header is not session._request_header for header in headers)
+
+
+def test_get_market_info_cached(monkeypatch):
+    def get_market(req, rsp):
+        rsp.market = fakes.Obj(
+            marketId=req.marketId, name="Match Odds", marketStatus="ACTIVE",
+            eventHierarchy=[[1, 10, req.marketId]],
+            runners=[[fakes.Obj(asianLineId=0, handicap=0.0, name="Home",
+                                selectionId=7)]],
+            couponLinks=None)
+    _, exchange = fakes.install(monkeypatch, exchange_service=fakes.FakeService(
+        getMarket=get_market))
+    session = Session("user", "password", rate_limits={},
+                      metadata_cache=MetadataCache())
+    info = session.get_market_info(5)
+    assert isinstance(info, MarketInfo)
+    assert info.eventHierarchy == [1, 10, 5]
+    assert [r.name for r in info.runners] == ["Home"]
+    assert info.couponLinks == []
+    assert session.get_market_info(5) is info
+    assert exchange.count("getMarket") == 1
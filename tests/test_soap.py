@@ -0,0 +1,92 @@
+import os
+import subprocess
+import sys
+import threading
+
+from suds import sudsobject
+
+from bfair import _soap
+
+
+def test_import_does_not_load_wsdl():
+    script = "import bfair.session, bfair._soap as s; print(len(s._clients))"
+    out = subprocess.check_output([sys.executable, "-c", script])
+    assert out.strip() == b"0"
+
+
+def test_lazy_proxy():
+    calls = []
+
+    class Obj(object):
+        value = 1
+
+    def factory():
+        calls.append(1)
+        return Obj()
+
+    proxy = _soap._Lazy(factory)
+    assert not calls
+    assert proxy.value == 1
+    proxy.value = 2
+    assert proxy.value == 2
+    assert len(calls) == 1
+
+
+class CountingFactory(object):
+
+    def __init__(self):
+        self.created = 0
+
+    def create(self, name):
+        self.created += 1
+        header = sudsobject.Factory.object("APIRequestHeader",
+                                           {"sessionToken": None})
+        ids = sudsobject.Factory.object("ArrayOfInt", {"int": []})
+        return sudsobject.Factory.object(name, {"header": header,
+                                                "marketId": None,
+                                                "eventTypeIds": ids})
+
+
+def test_request_pool_reuses_and_resets():
+    factory = CountingFactory()
+    pool = _soap.RequestPool()
+    req = pool.create(factory, "ns1:Req")
+    header = req.header
+    req.header = sudsobject.Factory.object("APIRequestHeader",
+                                           {"sessionToken": "token"})
+    req.marketId = 1
+    req.eventTypeIds[0].extend([1, 2])
+    header.sessionToken = "modified"
+    req.extra = 2
+
+    again = pool.create(factory, "ns1:Req")
+    assert again is req
+    assert factory.created == 1
+    assert again.header is header and header.sessionToken is None
+    assert again.marketId is None
+    assert again.eventTypeIds[0] == []
+    assert not hasattr(again, "extra")
+    assert pool.create(factory, "ns1:Other") is not req
+    assert factory.created == 2
+
+
+def test_request_pool_is_per_thread():
+    factory = CountingFactory()
+    pool = _soap.RequestPool()
+    reqs = [pool.create(factory, "ns1:Req")]
+    thread = threading.Thread(
+        target=lambda: reqs.append(pool.create(factory, "ns1:Req")))
+    thread.start()
+    thread.join()
+    assert reqs[0] is not reqs[1]
+    assert factory.created == 2
+
+
+def test_cache_dir(tmpdir):
+    directory = str(tmpdir.join("a", "bfair"))
+    assert _soap._cache_dir(directory) == directory
+    assert os.stat(directory).st_mode & 0777 == 0700
+
+    shared = tmpdir.mkdir("shared")
+    shared.chmod(0777)
+    assert _soap._cache_dir(str(shared)) is None
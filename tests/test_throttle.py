@@ -0,0 +1,65 @@
+import threading
+import time
+
+from bfair._throttle import RateLimiter, RATE_LIMITS
+
+
+def test_budget():
+    limiter = RateLimiter({"op": (2, 0.2)})
+    t0 = time.time()
+    waits = [limiter.acquire("op") for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert 0.08 < waits[2] < 0.15
+    assert time.time() - t0 >= 0.18
+    assert limiter.acquire("other") == 0.0
+    stats = limiter.stats()
+    assert stats["calls"] == 5
+    assert stats["delayed"] == 2
+    assert stats["queue_depth"] == 0
+    assert stats["max_queue_depth"] == 1
+
+
+def test_shared_budget_priority():
+    limiter = RateLimiter({"*": (1, 0.2)})
+    limiter.acquire("getMarketPricesCompressed")
+    order = []
+
+    def call(operation):
+        limiter.acquire(operation)
+        order.append(operation)
+
+    threads = []
+    for operation in ("getMarketPricesCompressed", "getAllMarkets",
+                      "placeBets"):
+        threads.append(threading.Thread(target=call, args=(operation,)))
+        threads[-1].start()
+        time.sleep(0.02)
+    assert limiter.stats()["queue_depth"] == 3
+    for thread in threads:
+        thread.join()
+    assert order == ["placeBets", "getMarketPricesCompressed",
+                     "getAllMarkets"]
+    assert limiter.stats()["max_queue_depth"] == 3
+
+
+def test_free_api_limits():
+    limits = RATE_LIMITS[82]
+    assert limits["getAllMarkets"] == (5, 60.0)
+    assert limits["*"] == (20, 1.0)
+
+
+def test_throttled_operation_does_not_hold_back_others():
+    limiter = RateLimiter({"*": (20, 1.0), "getAllMarkets": (1, 3.0)})
+    limiter.acquire("getAllMarkets")
+    waited = []
+    thread = threading.Thread(
+        target=lambda: waited.append(limiter.acquire("getAllMarkets")))
+    thread.start()
+    time.sleep(0.1)
+    # The queued getAllMarkets call waits for its own budget, which the
+    # price poll does not draw from.
+    t0 = time.time()
+    limiter.acquire("getMarketPricesCompressed")
+    assert time.time() - t0 < 0.1
+    thread.join()
+    assert waited[0] > 2.5
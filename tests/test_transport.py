@@ -0,0 +1,186 @@
+import httplib
+import socket
+import threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import pytest
+
+from suds.transport import Request, TransportError
+
+from bfair._transport import ConnectionPool, PooledTransport
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        status = 500 if body == "fault" else 200
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def url():
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:%d/service" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_connections_are_reused(url):
+    pool = ConnectionPool(max_connections=2)
+    transport = PooledTransport(pool)
+    for i in range(10):
+        reply = transport.send(Request(url, "message %d" % i))
+        assert reply.code == 200
+        assert reply.message == "message %d" % i
+    stats = pool.stats()
+    assert stats["requests"] == 10
+    assert stats["open"] == 1
+    assert stats["idle"] == 1
+    assert stats["reuse_ratio"] == 0.9
+
+
+def test_concurrent_requests_are_bounded(url):
+    pool = ConnectionPool(max_connections=3)
+    transport = PooledTransport(pool)
+    errors = []
+
+    def worker():
+        try:
+            for i in range(20):
+                assert transport.send(Request(url, "x")).message == "x"
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    stats = pool.stats()
+    assert stats["requests"] == 160
+    assert stats["open"] <= 3
+    assert stats["reuse_ratio"] > 0.9
+
+
+def test_http_error(url):
+    transport = PooledTransport(ConnectionPool())
+    with pytest.raises(TransportError) as e:
+        transport.send(Request(url, "fault"))
+    assert e.value.httpcode == 500
+    assert e.value.fp.read() == "fault"
+
+
+def test_stale_connection_is_replaced(url):
+    pool = ConnectionPool(max_connections=1)
+    transport = PooledTransport(pool)
+    assert transport.send(Request(url, "a")).message == "a"
+    # Simulate the server dropping the idle connection.
+    for conns in pool._idle.values():
+        for conn in conns:
+            conn.sock.shutdown(2)
+    assert transport.send(Request(url, "b")).message == "b"
+    assert pool.stats()["open"] == 1
+
+
+class ShortBodyHandler(Handler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", "100")
+        self.end_headers()
+        self.wfile.write("short")
+        self.wfile.flush()
+        self.close_connection = 1
+
+
+def test_failed_read_releases_connection():
+    server = Server(("127.0.0.1", 0), ShortBodyHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d/service" % server.server_address[1]
+    try:
+        pool = ConnectionPool(max_connections=1, acquire_timeout=1.0)
+        for _ in range(2):
+            with pytest.raises(httplib.IncompleteRead):
+                pool.request("POST", url, "x")
+            assert pool.stats()["open"] == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_acquire_timeout(url):
+    pool = ConnectionPool(max_connections=1, acquire_timeout=0.1)
+    conn, _ = pool._acquire(("http", url.split("/")[2]))
+    with pytest.raises(socket.timeout):
+        pool.request("POST", url, "x")
+    pool._release(("http", url.split("/")[2]), conn, False)
+    assert pool.request("POST", url, "x")[3] == "x"
+
+
+class DropHandler(Handler):
+    """Closes the connection without a response the first time it reads a
+    request with a body starting with "drop".
+    """
+
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.received.append(body)
+        if body.startswith("drop") and self.received.count(body) == 1:
+            self.close_connection = 1
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_non_idempotent_request_is_not_sent_twice():
+    server = Server(("127.0.0.1", 0), DropHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d/service" % server.server_address[1]
+    del DropHandler.received[:]
+    try:
+        transport = PooledTransport(ConnectionPool(max_connections=1),
+                                    non_idempotent=("placeBets",))
+        assert transport.send(Request(url, "a")).message == "a"
+        # A read whose response is lost is sent again on a new connection.
+        request = Request(url, "drop read")
+        request.headers["SOAPAction"] = '"getMarketPrices"'
+        assert transport.send(request).message == "drop read"
+        assert DropHandler.received.count("drop read") == 2
+        request = Request(url, "drop bets")
+        request.headers["SOAPAction"] = '"placeBets"'
+        with pytest.raises(httplib.BadStatusLine):
+            transport.send(request)
+        assert DropHandler.received.count("drop bets") == 1
+        assert transport.pool.stats()["open"] == 0
+    finally:
+        server.shutdown()
+        server.server_close()
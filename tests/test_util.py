@@ -1,11 +1,15 @@
 #!/usr/bin/env python 
 import pytest
+import threading
+import time
 
 from os import path
 from bfair._util import (
+    PayloadCache,
+    SingleFlight,
+    uncompress_complete_market_depth,
     uncompress_market_prices,
     uncompress_markets,
-#   uncompress_market_depth,
 )
 
 not_implemented = pytest.mark.xfail
@@ -23,10 +27,199 @@ def test_uncompress_markets():
     with open(path.join(DATA_DIR, "markets.dump")) as f:
         for line in f:
             uncompress_markets(line)
-        
-@not_implemented
+
+
 def test_uncompress_market_depth():
     with open(path.join(DATA_DIR, "complete_market_prices.dump")) as f:
         for line in f:
-            uncompress_market_depth(line)
+            uncompress_complete_market_depth(line)
+
+
+def test_uncompress_market_depth_fields():
+    with open(path.join(DATA_DIR, "complete_market_prices.dump")) as f:
+        cmp = uncompress_complete_market_depth(f.readline())
+    assert cmp.marketId == 97383
+    assert cmp.delay == 0
+    assert cmp.removedRunners == ""
+
+    rp = cmp.runnerPrices[0]
+    assert rp.selectionId == 52247
+    assert rp.sortOrder == 34
+    assert rp.totalAmountMatched == 1118.18
+    assert rp.lastPriceMatched == 1000.0
+    assert rp.vacant is False
+    assert rp.asianLineId == 0
+    assert len(rp.prices) == 23
+    assert list(rp.prices[0]) == [1.01, 505.99, 0.0, 0.0, 0.0]
+    assert list(rp.prices[-1]) == [810.0, 0.02, 0.0, 0.0, 0.0]
+
+
+def test_uncompress_market_depth_columnar():
+    pytest.importorskip("numpy")
+    with open(path.join(DATA_DIR, "complete_market_prices.dump")) as f:
+        for line in f:
+            cmp = uncompress_complete_market_depth(line)
+            cols = uncompress_complete_market_depth(line, columnar=True)
+            assert len(cols.runnerPrices) == len(cmp.runnerPrices)
+            for rp, rc in zip(cmp.runnerPrices, cols.runnerPrices):
+                assert list(rp)[:-1] == list(rc)[:-1]
+                assert rc.prices.shape == (len(rp.prices), 5)
+                assert [list(p) for p in rp.prices] == rc.prices.tolist()
+
+
+def test_uncompress_market_prices_ladder():
+    with open(path.join(DATA_DIR, "market_prices.dump")) as f:
+        mp = uncompress_market_prices(f.readline())
+    assert mp.marketId == 97383
+    assert mp.currency == "GBP"
+    assert mp.marketStatus == "ACTIVE"
+    assert len(mp.runnerPrices) == 61
+
+    rp = mp.runnerPrices[0]
+    assert rp.selectionId == 563519
+    assert rp.totalAmountMatched == 36271.47
+    assert rp.lastPriceMatched == 4.7
+    assert [(p.price, p.amountAvailable, p.betType, p.depth)
+            for p in rp.bestPricesToBack] == [
+        (4.6, 2.0, "L", 1), (4.5, 3.0, "L", 2), (4.4, 3486.81, "L", 3)]
+    assert [(p.price, p.amountAvailable, p.betType, p.depth)
+            for p in rp.bestPricesToLay] == [
+        (4.7, 27.0, "B", 1), (4.8, 27.0, "B", 2), (4.9, 25.87, "B", 3)]
+
+
+def test_uncompress_market_prices_escaped():
+    data = r"1~GBP~ACTIVE~0~1~a\:b\~c~true~5.0~0~~N:7~0~1.0~2.0~~~false~~~~|2.0~1.0~L~1~|"
+    mp = uncompress_market_prices(data)
+    assert mp.marketInfo == "a:b~c"
+    assert mp.bspMarket is False
+    assert len(mp.runnerPrices) == 1
+    assert mp.runnerPrices[0].selectionId == 7
+    assert len(mp.runnerPrices[0].bestPricesToBack) == 1
+    assert mp.runnerPrices[0].bestPricesToLay == []
+
+
+def test_uncompress_market_prices_columnar():
+    np = pytest.importorskip("numpy")
+    with open(path.join(DATA_DIR, "market_prices.dump")) as f:
+        for line in f:
+            mp = uncompress_market_prices(line)
+            cols = uncompress_market_prices(line, columnar=True).runnerPrices
+            assert len(cols) == len(mp.runnerPrices)
+            for i, rp in enumerate(mp.runnerPrices):
+                assert cols.selectionId[i] == rp.selectionId
+                assert cols.sortOrder[i] == rp.sortOrder
+                assert cols.totalAmountMatched[i] == rp.totalAmountMatched
+                assert cols.lastPriceMatched[i] == rp.lastPriceMatched
+                assert cols.vacant[i] == rp.vacant
+                assert cols.actualBSP[i] == rp.actualBSP
+                for prices, price, amount, depth in (
+                        (rp.bestPricesToBack, cols.backPrice, cols.backAmount,
+                         cols.backDepth),
+                        (rp.bestPricesToLay, cols.layPrice, cols.layAmount,
+                         cols.layDepth)):
+                    assert depth[i] == len(prices)
+                    for j, p in enumerate(prices):
+                        assert price[i, j] == p.price
+                        assert amount[i, j] == p.amountAvailable
+                    assert np.isnan(price[i, len(prices):]).all()
+                    assert (amount[i, len(prices):] == 0).all()
+
+
+def test_uncompress_markets_iter():
+    with open(path.join(DATA_DIR, "markets.dump")) as f:
+        data = f.read()
+    markets = uncompress_markets(data)
+    it = uncompress_markets.iter(data)
+    assert iter(it) is it
+    n = 0
+    for expected, market in zip(markets, it):
+        assert list(market) == list(expected)
+        n += 1
+    assert n == len(markets)
+    assert list(it) == []
+
+
+def test_payload_cache():
+    with open(path.join(DATA_DIR, "market_prices.dump")) as f:
+        first, second = f.readline(), f.readline()
+    cache = PayloadCache()
+    mp, modified = cache.decode(1, first, uncompress_market_prices)
+    assert modified
+    assert cache.decode(1, first, uncompress_market_prices) == (mp, False)
+    assert cache.decode(2, first, uncompress_market_prices)[1]
+    other, modified = cache.decode(1, second, uncompress_market_prices)
+    assert modified and other is not mp
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_payload_cache_is_bounded():
+    cache = PayloadCache(max_entries=2)
+    for key in (1, 2, 1, 3):
+        cache.decode(key, "data", len)
+    assert len(cache) == 2
+    assert cache.evictions == 1
+    # Key 2 was the least recently used.
+    assert cache.decode(1, "data", len)[1] is False
+    assert cache.decode(2, "data", len)[1] is True
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    started = threading.Event()
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        started.set()
+        time.sleep(0.05)
+        return [value]
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(flight.do("k", slow, 1)))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(
+        target=lambda: results.append(flight.do("k", slow, 2)))
+        for _ in range(4)]
+    for t in followers:
+        t.start()
+    for t in [leader] + followers:
+        t.join()
+    assert calls == [1]
+    assert len(results) == 5 and all(r is results[0] for r in results)
+    assert (flight.calls, flight.shared) == (1, 4)
+    # Nothing is kept once the call completed.
+    assert flight.do("k", slow, 3) == [3]
+
+
+def test_single_flight_error():
+    flight = SingleFlight()
+    errors = []
+
+    def fail():
+        time.sleep(0.05)
+        raise ValueError("failed")
+
+    def call():
+        try:
+            flight.do("k", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(errors) == 3
+    assert flight.calls + flight.shared == 3
+
 
+def test_single_flight_freshness():
+    flight = SingleFlight(freshness=0.05)
+    first = flight.do("k", list)
+    assert flight.do("k", list) is first
+    assert flight.fresh == 1
+    time.sleep(0.06)
+    assert flight.do("k", list) is not first